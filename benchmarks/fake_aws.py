@@ -0,0 +1,362 @@
+import copy
+import datetime
+import json
+import time
+
+"""
+A small stateful stand-in for the AWS APIs the ecosystem switch calls.
+
+Each fake client looks up a method named <service>_<operation> on FakeAwsBackend, sleeps for the configured
+simulated latency and counts the call.  Operations the fake does not know about raise NotImplementedError, so a
+handler that starts calling something new fails loudly here instead of silently hitting AWS.
+"""
+
+REGION = 'us-west-2'
+
+
+class FakeClientError(Exception):
+    pass
+
+
+class _FakeExceptions:
+
+    def __init__(self):
+        self._exceptions = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._exceptions:
+            self._exceptions[name] = type(name, (FakeClientError,), {})
+        return self._exceptions[name]
+
+
+class FakeClient:
+
+    def __init__(self, backend, service_name):
+        self._backend = backend
+        self._service_name = service_name
+        self.exceptions = backend.exceptions(service_name)
+
+    def __getattr__(self, operation):
+        if operation.startswith('_'):
+            raise AttributeError(operation)
+        method = getattr(self._backend, f"{self._service_name.replace('-', '_')}_{operation}", None)
+        if method is None:
+            raise NotImplementedError(f"fake AWS does not implement {self._service_name}.{operation}")
+
+        def call(**kwargs):
+            self._backend.record(self._service_name, operation)
+            return copy.deepcopy(method(**kwargs))
+        return call
+
+
+class FakeCursor:
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._result = None
+        self.description = None
+
+    def execute(self, sql, params=()):
+        self._backend.record('postgres', 'execute')
+        self._result = self._backend.sql_result(sql, params)
+        self.description = None if self._result is None else ()
+
+    def fetchone(self):
+        return self._result
+
+    def mogrify(self, sql, params=()):
+        # Client side in psycopg2, so not a call.
+        return (sql % tuple(repr(x) for x in params)).encode()
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self, backend):
+        self._backend = backend
+        self.autocommit = False
+        self.closed = 0
+
+    def cursor(self):
+        return FakeCursor(self._backend)
+
+    def rollback(self):
+        pass
+
+    def cancel(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakeAwsBackend:
+    """
+    In-memory state for one benchmark scenario.  latency is the simulated round trip of every API call in seconds.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = []
+        self.clusters = {}
+        self.instances = {}
+        self.snapshots = []
+        self.event_source_mappings = {}
+        self.function_concurrency = {}
+        self.queues = {}
+        self.secrets = {}
+        self.executions = []
+        self.etl_jobs_running = 0
+        self.metrics = {}
+        self.alarms = {}
+        self.items = {}
+        self._exceptions = {}
+
+    # Harness plumbing
+
+    def client(self, service_name, region_name=None, **kwargs):
+        return FakeClient(self, service_name)
+
+    def connect(self, **kwargs):
+        self.record('postgres', 'connect')
+        return FakeConnection(self)
+
+    def exceptions(self, service_name):
+        if service_name not in self._exceptions:
+            self._exceptions[service_name] = _FakeExceptions()
+        return self._exceptions[service_name]
+
+    def record(self, service_name, operation):
+        self.calls.append(f"{service_name}.{operation}")
+        if self.latency:
+            time.sleep(self.latency)
+
+    def sql_result(self, sql, params):
+        sql = sql.decode() if isinstance(sql, bytes) else str(sql)
+        if 'pg_tables' in sql:
+            return ('public', None)
+        if 'batch_job_execution' in sql:
+            return (self.etl_jobs_running > 0,)
+        return None
+
+    # Scenario setup
+
+    def add_cluster(self, cluster_id, status='available'):
+        self.clusters[cluster_id] = {'DBClusterIdentifier': cluster_id, 'Status': status, 'DBClusterMembers': []}
+
+    def add_instance(self, instance_id, instance_class, status='available', cluster_id=None):
+        self.instances[instance_id] = {
+            'DBInstanceIdentifier': instance_id,
+            'DBInstanceClass': instance_class,
+            'DBInstanceStatus': status,
+            'DBClusterIdentifier': cluster_id,
+            'PendingModifiedValues': {},
+            'InstanceCreateTime': datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        }
+        if cluster_id in self.clusters:
+            members = self.clusters[cluster_id]['DBClusterMembers']
+            members.append({'DBInstanceIdentifier': instance_id, 'IsClusterWriter': not members})
+
+    def add_trigger(self, function_name, state='Enabled', concurrency=10, mappings=1):
+        self.function_concurrency[function_name] = concurrency
+        for i in range(mappings):
+            uuid = f"{function_name}-mapping-{i}"
+            self.event_source_mappings[uuid] = {'UUID': uuid, 'FunctionName': function_name, 'State': state}
+
+    def add_queue(self, queue_name, messages=0, in_flight=0):
+        self.queues[queue_name] = {'messages': messages, 'in_flight': in_flight}
+
+    def add_metric(self, metric_name, values):
+        """
+        values are newest first, the way get_metric_data returns them with ScanBy=TimestampDescending.
+        """
+        self.metrics[metric_name] = list(values)
+
+    def add_secret(self, secret_id, values):
+        self.secrets[secret_id] = values
+
+    def add_state(self, key, value, version=1, expires_at=None):
+        expires_at = expires_at if expires_at is not None else time.time() + 3600
+        self.items[key] = {'pk': {'S': key}, 'version': {'N': str(version)}, 'value': {'S': json.dumps(value)},
+                           'expiresAt': {'N': str(int(expires_at))}}
+
+    def add_alarm(self, alarm_name, state='OK', reason_data=None):
+        self.alarms[alarm_name] = {'AlarmName': alarm_name, 'StateValue': state,
+                                   'StateReasonData': json.dumps(reason_data or {})}
+
+    # rds
+
+    def rds_describe_db_clusters(self, DBClusterIdentifier=None, Filters=None, Marker=None, MaxRecords=None):
+        if DBClusterIdentifier is not None:
+            if DBClusterIdentifier not in self.clusters:
+                raise self.exceptions('rds').DBClusterNotFoundFault(DBClusterIdentifier)
+            return {'DBClusters': [self.clusters[DBClusterIdentifier]]}
+        return {'DBClusters': list(self.clusters.values())}
+
+    def rds_describe_db_instances(self, DBInstanceIdentifier=None, Filters=None, Marker=None, MaxRecords=None):
+        if DBInstanceIdentifier is not None:
+            if DBInstanceIdentifier not in self.instances:
+                raise self.exceptions('rds').DBInstanceNotFoundFault(DBInstanceIdentifier)
+            return {'DBInstances': [self.instances[DBInstanceIdentifier]]}
+        return {'DBInstances': list(self.instances.values())}
+
+    def rds_describe_events(self, SourceIdentifier=None, SourceType=None, **kwargs):
+        return {'Events': []}
+
+    def rds_describe_db_snapshots(self, DBInstanceIdentifier=None, **kwargs):
+        return {'DBSnapshots': [{'DBSnapshotIdentifier': x} for x in self.snapshots]}
+
+    def rds_start_db_cluster(self, DBClusterIdentifier):
+        self.clusters[DBClusterIdentifier]['Status'] = 'starting'
+        return {'DBCluster': self.clusters[DBClusterIdentifier]}
+
+    def rds_stop_db_cluster(self, DBClusterIdentifier):
+        self.clusters[DBClusterIdentifier]['Status'] = 'stopping'
+        return {'DBCluster': self.clusters[DBClusterIdentifier]}
+
+    def rds_start_db_instance(self, DBInstanceIdentifier):
+        return {'DBInstance': {'DBInstanceIdentifier': DBInstanceIdentifier, 'DBInstanceStatus': 'starting'}}
+
+    def rds_stop_db_instance(self, DBInstanceIdentifier):
+        return {'DBInstance': {'DBInstanceIdentifier': DBInstanceIdentifier, 'DBInstanceStatus': 'stopping'}}
+
+    def rds_modify_db_instance(self, DBInstanceIdentifier, ApplyImmediately=False, DBInstanceClass=None,
+                               MasterUserPassword=None):
+        instance = self.instances.setdefault(DBInstanceIdentifier, {'DBInstanceIdentifier': DBInstanceIdentifier})
+        if DBInstanceClass is not None:
+            instance['PendingModifiedValues'] = {'DBInstanceClass': DBInstanceClass}
+            instance['DBInstanceStatus'] = 'modifying'
+        return {'DBInstance': instance}
+
+    def rds_modify_db_cluster(self, DBClusterIdentifier, **kwargs):
+        return {'DBCluster': self.clusters.get(DBClusterIdentifier, {})}
+
+    def rds_create_db_instance(self, DBInstanceIdentifier, DBInstanceClass, DBClusterIdentifier=None, **kwargs):
+        self.add_instance(DBInstanceIdentifier, DBInstanceClass, status='creating', cluster_id=DBClusterIdentifier)
+        return {'DBInstance': self.instances[DBInstanceIdentifier]}
+
+    def rds_delete_db_instance(self, DBInstanceIdentifier, **kwargs):
+        if DBInstanceIdentifier not in self.instances:
+            raise self.exceptions('rds').DBInstanceNotFoundFault(DBInstanceIdentifier)
+        for cluster in self.clusters.values():
+            cluster['DBClusterMembers'] = [x for x in cluster['DBClusterMembers']
+                                           if x['DBInstanceIdentifier'] != DBInstanceIdentifier]
+        return {'DBInstance': self.instances.pop(DBInstanceIdentifier)}
+
+    def rds_failover_db_cluster(self, DBClusterIdentifier, TargetDBInstanceIdentifier=None):
+        cluster = self.clusters[DBClusterIdentifier]
+        for member in cluster['DBClusterMembers']:
+            member['IsClusterWriter'] = member['DBInstanceIdentifier'] == TargetDBInstanceIdentifier
+        return {'DBCluster': cluster}
+
+    def rds_delete_db_cluster(self, DBClusterIdentifier, **kwargs):
+        return {'DBCluster': self.clusters.pop(DBClusterIdentifier, {})}
+
+    def rds_restore_db_cluster_from_snapshot(self, DBClusterIdentifier, **kwargs):
+        self.add_cluster(DBClusterIdentifier, status='creating')
+        return {'DBCluster': self.clusters[DBClusterIdentifier]}
+
+    def rds_restore_db_instance_from_db_snapshot(self, DBInstanceIdentifier, DBInstanceClass=None, **kwargs):
+        self.add_instance(DBInstanceIdentifier, DBInstanceClass, status='creating')
+        return {'DBInstance': self.instances[DBInstanceIdentifier]}
+
+    # lambda
+
+    def lambda_list_event_source_mappings(self, FunctionName=None, Marker=None, MaxItems=None):
+        return {'EventSourceMappings': [x for x in self.event_source_mappings.values()
+                                        if FunctionName is None or x['FunctionName'] == FunctionName]}
+
+    def lambda_get_event_source_mapping(self, UUID):
+        return self.event_source_mappings[UUID]
+
+    def lambda_update_event_source_mapping(self, UUID, Enabled=None, **kwargs):
+        if Enabled is not None:
+            self.event_source_mappings[UUID]['State'] = 'Enabled' if Enabled else 'Disabled'
+        return self.event_source_mappings[UUID]
+
+    def lambda_get_function_concurrency(self, FunctionName):
+        return {'ReservedConcurrentExecutions': self.function_concurrency[FunctionName]}
+
+    def lambda_put_function_concurrency(self, FunctionName, ReservedConcurrentExecutions):
+        self.function_concurrency[FunctionName] = ReservedConcurrentExecutions
+        return {'ReservedConcurrentExecutions': ReservedConcurrentExecutions}
+
+    # sqs, secretsmanager, stepfunctions, cloudwatch
+
+    def sqs_get_queue_url(self, QueueName):
+        return {'QueueUrl': f"https://sqs.{REGION}.amazonaws.com/000000000000/{QueueName}"}
+
+    def sqs_get_queue_attributes(self, QueueUrl, AttributeNames):
+        queue = self.queues.setdefault(QueueUrl.rsplit('/', 1)[-1], {'messages': 0, 'in_flight': 0})
+        return {'Attributes': {
+            'ApproximateNumberOfMessages': str(queue.get('messages', 0)),
+            'ApproximateNumberOfMessagesNotVisible': str(queue.get('in_flight', 0))
+        }}
+
+    def sqs_purge_queue(self, QueueUrl):
+        self.queues.setdefault(QueueUrl.rsplit('/', 1)[-1], {})['messages'] = 0
+        return {}
+
+    def secretsmanager_get_secret_value(self, SecretId):
+        return {'SecretString': json.dumps(self.secrets[SecretId])}
+
+    def stepfunctions_start_execution(self, stateMachineArn, input=None, name=None):
+        execution_arn = f"{stateMachineArn}:execution-{len(self.executions)}"
+        self.executions.append({'executionArn': execution_arn, 'stateMachineArn': stateMachineArn,
+                                'status': 'RUNNING', 'input': input})
+        return {'executionArn': execution_arn}
+
+    def stepfunctions_list_executions(self, stateMachineArn, statusFilter=None, **kwargs):
+        return {'executions': [{'executionArn': x['executionArn'], 'stateMachineArn': x['stateMachineArn'],
+                                'status': x['status']} for x in self.executions
+                               if x['stateMachineArn'] == stateMachineArn and statusFilter in (None, x['status'])]}
+
+    def stepfunctions_stop_execution(self, executionArn, error=None, cause=None):
+        for execution in self.executions:
+            if execution['executionArn'] == executionArn:
+                execution['status'] = 'ABORTED'
+        return {'stopDate': datetime.datetime.now(datetime.timezone.utc)}
+
+    def cloudwatch_get_metric_data(self, MetricDataQueries, StartTime=None, EndTime=None, ScanBy=None, **kwargs):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        results = []
+        for query in MetricDataQueries:
+            values = list(self.metrics.get(query['MetricStat']['Metric']['MetricName'], []))
+            period = datetime.timedelta(seconds=query['MetricStat']['Period'])
+            timestamps = [now - period * i for i in range(len(values))]
+            results.append({'Id': query['Id'], 'Values': values, 'Timestamps': timestamps})
+        return {'MetricDataResults': results}
+
+    def cloudwatch_describe_alarms(self, AlarmNames=None, **kwargs):
+        names = AlarmNames if AlarmNames is not None else list(self.alarms)
+        return {'MetricAlarms': [self.alarms[x] for x in names if x in self.alarms]}
+
+    # dynamodb, just the single-item calls and the conditions src/state.py uses
+
+    def dynamodb_get_item(self, TableName, Key, ConsistentRead=False):
+        item = self.items.get(Key['pk']['S'])
+        return {'Item': item} if item is not None else {}
+
+    def dynamodb_put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+        current = self.items.get(Item['pk']['S'])
+        if ConditionExpression == 'attribute_not_exists(pk)':
+            ok = current is None
+        elif ConditionExpression == 'version = :version':
+            ok = current is not None and current['version'] == ExpressionAttributeValues[':version']
+        else:
+            ok = ConditionExpression is None
+        if not ok:
+            raise self.exceptions('dynamodb').ConditionalCheckFailedException(ConditionExpression)
+        self.items[Item['pk']['S']] = Item
+        return {}
+
+    def dynamodb_delete_item(self, TableName, Key):
+        self.items.pop(Key['pk']['S'], None)
+        return {}
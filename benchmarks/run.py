@@ -0,0 +1,170 @@
+import argparse
+import importlib
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import time
+from unittest import mock
+
+"""
+Cold-start and per-handler latency benchmark.
+
+Runs every Lambda entry point against the fake AWS backend in benchmarks/fake_aws.py and reports the cold import
+time of its module, its wall time with simulated API latency, and how many AWS/Postgres calls it made.  Exits
+non-zero when a handler goes over the call or wall-time budget recorded in benchmarks/budgets.json.
+
+    python -m benchmarks.run                   # check against the recorded budgets
+    python -m benchmarks.run --latency-ms 50   # what-if with a slower AWS; wall budgets are not enforced
+    python -m benchmarks.run --record          # re-record budgets after an intentional change
+"""
+
+BUDGETS_FILE = os.path.join(os.path.dirname(__file__), 'budgets.json')
+DEFAULT_LATENCY_MS = 10
+IMPORT_SAMPLES = 5
+# Headroom applied when recording wall-time budgets so scheduler noise on a CI box does not fail the build.
+RECORD_HEADROOM = 1.5
+RECORD_SLACK_MS = 25
+
+SERVICES = ['rds', 'lambda', 'sqs', 'secretsmanager', 'stepfunctions', 'cloudwatch', 'cloudformation', 'kms',
+            'efs', 'ec2', 'dynamodb']
+
+IMPORT_SNIPPET = "import time, importlib; t = time.perf_counter(); importlib.import_module('{module}'); " \
+                 "print(time.perf_counter() - t)"
+
+
+class FakeContext:
+    """
+    Just enough of the Lambda context object for the handlers.
+    """
+
+    def __init__(self, timeout_in_millis=90000):
+        self._deadline = time.monotonic() + timeout_in_millis / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+def measure_import_time(module, env, samples=IMPORT_SAMPLES):
+    """
+    Median import time of module in a fresh interpreter, in milliseconds.
+    """
+    child_env = dict(os.environ)
+    child_env.update(env)
+    # Dummy credentials so nothing blocks on the instance metadata service.
+    child_env.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    child_env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    results = []
+    for _ in range(samples):
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SNIPPET.format(module=module)],
+                                         env=child_env, cwd=os.path.dirname(os.path.dirname(__file__)))
+        results.append(float(output) * 1000)
+    return statistics.median(results)
+
+
+def resolve_handler(dotted_name):
+    module_name, function_name = dotted_name.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+def run_scenario(scenario, latency_ms):
+    """
+    Run one scenario against a fresh fake backend.  Returns (wall time in ms, list of calls made).
+    """
+    from benchmarks.fake_aws import FakeAwsBackend
+    from src.clients import set_client, clear_clients
+    from src.state import clear_handled_events
+    from src.rds import clear_connections
+
+    backend = FakeAwsBackend(latency=latency_ms / 1000)
+    scenario.setup(backend)
+    handler = resolve_handler(scenario.handler)
+    clear_clients()
+    clear_handled_events()
+    clear_connections()
+    for service_name in SERVICES:
+        set_client(service_name, backend.client(service_name), scenario.env['AWS_DEPLOYMENT_REGION'])
+    try:
+        with mock.patch.dict(os.environ, scenario.env), mock.patch('src.rds.connect', side_effect=backend.connect):
+            start = time.perf_counter()
+            handler(scenario.event, FakeContext())
+            wall_ms = (time.perf_counter() - start) * 1000
+    finally:
+        clear_clients()
+    return wall_ms, backend.calls
+
+
+def load_budgets(path=BUDGETS_FILE):
+    if not os.path.exists(path):
+        return {'latency_ms': DEFAULT_LATENCY_MS, 'handlers': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_budget(name, calls, wall_ms, budgets, check_wall):
+    """
+    Returns a list of human readable budget violations for one scenario.
+    """
+    budget = budgets['handlers'].get(name)
+    if budget is None:
+        return [f"{name}: no budget recorded"]
+    problems = []
+    if calls > budget['max_calls']:
+        problems.append(f"{name}: {calls} calls exceeds budget of {budget['max_calls']}")
+    if check_wall and wall_ms > budget['max_wall_ms']:
+        problems.append(f"{name}: {wall_ms:.1f} ms exceeds budget of {budget['max_wall_ms']} ms")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Cold-start and per-handler latency benchmark')
+    parser.add_argument('--latency-ms', type=float, default=None,
+                        help='simulated round trip for every API call (default: the latency the budgets used)')
+    parser.add_argument('--record', action='store_true', help='write the measured results as the new budgets')
+    parser.add_argument('--skip-import', action='store_true', help='skip the cold import measurements')
+    parser.add_argument('--budgets', default=BUDGETS_FILE)
+    args = parser.parse_args(argv)
+
+    from benchmarks.scenarios import build_scenarios
+
+    budgets = load_budgets(args.budgets)
+    latency_ms = budgets['latency_ms'] if args.latency_ms is None else args.latency_ms
+    check_wall = latency_ms == budgets['latency_ms']
+    scenarios = build_scenarios()
+
+    import_times = {}
+    if not args.skip_import:
+        for module in sorted({x.handler.rsplit('.', 1)[0] for x in scenarios}):
+            import_times[module] = measure_import_time(module, scenarios[0].env)
+
+    recorded = {}
+    problems = []
+    print(f"{'handler':40} {'import ms':>10} {'wall ms':>10} {'calls':>6}")
+    for scenario in scenarios:
+        wall_ms, calls = run_scenario(scenario, latency_ms)
+        import_ms = import_times.get(scenario.handler.rsplit('.', 1)[0])
+        import_column = f"{import_ms:10.1f}" if import_ms is not None else f"{'-':>10}"
+        print(f"{scenario.name:40} {import_column} {wall_ms:10.1f} {len(calls):6d}")
+        recorded[scenario.name] = {
+            'max_calls': len(calls),
+            'max_wall_ms': math.ceil(wall_ms * RECORD_HEADROOM + RECORD_SLACK_MS)
+        }
+        problems.extend(check_budget(scenario.name, len(calls), wall_ms, budgets, check_wall))
+
+    if args.record:
+        with open(args.budgets, 'w') as f:
+            json.dump({'latency_ms': latency_ms, 'handlers': recorded}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Recorded budgets to {args.budgets}")
+        return 0
+    if not check_wall:
+        print(f"Wall-time budgets were recorded at {budgets['latency_ms']} ms latency, only call budgets checked")
+    for problem in problems:
+        print(f"OVER BUDGET {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+import datetime
+from collections import namedtuple
+
+"""
+One scenario per Lambda entry point in serverless.yml.  Each scenario names the handler, the event it receives and
+a setup function that puts the fake AWS backend into the state the handler expects on its normal (hot) path.
+"""
+
+Scenario = namedtuple('Scenario', ['name', 'handler', 'event', 'setup', 'env'])
+
+ALARM_EVENT = {"id": "00000000-0000-0000-0000-000000000001",
+               "detail": {"alarmName": "alarm", "state": {"value": "ALARM", "timestamp": "2026-01-01T00:00:00.000+0000"}}}
+OK_EVENT = {"id": "00000000-0000-0000-0000-000000000002",
+            "detail": {"alarmName": "alarm", "state": {"value": "OK", "timestamp": "2026-01-01T00:05:00.000+0000"}}}
+
+SHRINK_STATE_MACHINE_ARN = 'arn:aws:states:us-west-2:000000000000:stateMachine:shrink'
+GROW_STATE_MACHINE_ARN = 'arn:aws:states:us-west-2:000000000000:stateMachine:grow'
+
+
+def scenario_env(stage):
+    return {
+        'STAGE': stage,
+        'AWS_DEPLOYMENT_REGION': 'us-west-2',
+        'CAN_DELETE_DB': 'true',
+        'SHRINK_STATE_MACHINE_ARN': SHRINK_STATE_MACHINE_ARN,
+        'GROW_STATE_MACHINE_ARN': GROW_STATE_MACHINE_ARN,
+        'DB_HOST': 'observations.example',
+        'DB_USER': 'wqp_user',
+        'DB_NAME': 'wqp_db',
+        'DB_PASSWORD': 'password'
+    }
+
+
+def build_scenarios():
+    from src import handler, db_resize_handler, db_create_handler, utils, state
+
+    stage = utils.STAGE
+    cluster_id = db_resize_handler.DEFAULT_DB_CLUSTER_IDENTIFIER
+    instance_id = db_resize_handler.DEFAULT_DB_INSTANCE_IDENTIFIER
+    trigger = handler.TRIGGER[stage][0]
+    ob_instance_id = handler.OBSERVATIONS_DB[stage]
+    env = scenario_env(stage)
+    standby_id = f"{instance_id}{db_resize_handler.RESIZE_STANDBY_SUFFIX}"
+    failover_event = {'mode': db_resize_handler.RESIZE_MODE_FAILOVER, 'resize': {
+        'targetClass': db_resize_handler.SMALL_DB_SIZE, 'instance': standby_id, 'oldInstance': instance_id}}
+
+    capture_secret = {
+        'POSTGRES_PASSWORD': 'postgres', 'SCHEMA_OWNER_PASSWORD': 'owner', 'DB_SUBGROUP_NAME': 'subgroup',
+        'VPC_SECURITY_GROUP_ID': 'sg-0', 'DATABASE_ADDRESS': 'capture.example', 'DATABASE_NAME': 'capture'
+    }
+    observation_secret = {
+        'POSTGRES_PASSWORD': 'postgres', 'DB_SUBGROUP_NAME': 'subgroup', 'VPC_SECURITY_GROUP_ID': 'sg-0',
+        'DATABASE_ADDRESS': 'observations.example', 'DATABASE_NAME': 'wqp_db', 'DB_OWNER_PASSWORD': 'a',
+        'WQP_READ_ONLY_PASSWORD': 'b', 'ARS_SCHEMA_OWNER_PASSWORD': 'c', 'NWIS_SCHEMA_OWNER_PASSWORD': 'd',
+        'EPA_SCHEMA_OWNER_PASSWORD': 'e', 'WDFN_DB_READ_ONLY_PASSWORD': 'f'
+    }
+
+    def capture_running(backend):
+        backend.add_cluster(cluster_id, 'available')
+        backend.add_instance(instance_id, db_resize_handler.BIG_DB_SIZE, cluster_id=cluster_id)
+        backend.add_trigger(trigger, 'Enabled', concurrency=10)
+
+    def capture_stopped(backend):
+        backend.add_cluster(cluster_id, 'stopped')
+        backend.add_trigger(trigger, 'Disabled', concurrency=10)
+
+    def capture_small(backend):
+        capture_running(backend)
+        backend.instances[instance_id]['DBInstanceClass'] = db_resize_handler.SMALL_DB_SIZE
+
+    def capture_trigger_disabled(backend):
+        capture_running(backend)
+        for mapping in backend.event_source_mappings.values():
+            mapping['State'] = 'Disabled'
+
+    def capture_throttled(backend):
+        capture_running(backend)
+        backend.function_concurrency[trigger] = 5
+
+    def capture_throttled_alarm_ok(backend):
+        capture_throttled(backend)
+        backend.add_alarm(handler.ERROR_HANDLER_ALARM, 'OK', {'recentDatapoints': [3.0], 'threshold': 100.0})
+
+    def capture_running_flow_rate_cached(backend):
+        capture_running(backend)
+        backend.add_state(state.FLOW_RATE_STATE, {'flowRate': 10})
+
+    def capture_running_alarm_handled(backend):
+        capture_running(backend)
+        backend.add_state(state.get_event_key(ALARM_EVENT), {'handledAt': 0})
+
+    def capture_shrinking(backend):
+        capture_small(backend)
+        backend.stepfunctions_start_execution(SHRINK_STATE_MACHINE_ARN)
+
+    def capture_failover_ready(backend):
+        capture_running(backend)
+        backend.add_instance(standby_id, db_resize_handler.SMALL_DB_SIZE, cluster_id=cluster_id)
+
+    def capture_failed_over(backend):
+        capture_failover_ready(backend)
+        backend.rds_failover_db_cluster(cluster_id, standby_id)
+
+    def capture_small_and_busy(backend):
+        capture_small(backend)
+        backend.add_metric('CPUUtilization', [60.0] * 288 + [20.0] * 1728)
+
+    def observations_big(backend):
+        backend.add_instance(ob_instance_id, db_resize_handler.BIG_OB_DB_SIZE)
+
+    def observations_small(backend):
+        backend.add_instance(ob_instance_id, db_resize_handler.SMALL_OB_DB_SIZE)
+
+    def create_capture(backend):
+        capture_stopped(backend)
+        backend.add_instance(instance_id, db_resize_handler.BIG_DB_SIZE, cluster_id=cluster_id)
+        backend.add_secret(db_create_handler.CAPTURE_DB_SECRET_KEY, capture_secret)
+        backend.add_queue(db_create_handler.CAPTURE_TRIGGER_QUEUE)
+        backend.add_queue(db_create_handler.ERROR_QUEUE)
+
+    def create_observations(backend):
+        observations_big(backend)
+        backend.add_secret(db_create_handler.OBSERVATION_REAL, observation_secret)
+        two_days_ago = datetime.datetime.now() - datetime.timedelta(2)
+        date_str = db_create_handler._get_date_string(two_days_ago)
+        backend.snapshots.append(f"rds:observations-db-legacy-production-external-{date_str}-08-33")
+
+    def nothing(backend):
+        pass
+
+    return [
+        Scenario('start_capture_db', 'src.handler.start_capture_db', {}, capture_stopped, env),
+        Scenario('stop_capture_db', 'src.handler.stop_capture_db', {}, capture_running, env),
+        Scenario('start_observations_db', 'src.handler.start_observations_db', {}, observations_big, env),
+        Scenario('stop_observations_db', 'src.handler.stop_observations_db', {}, observations_big, env),
+        Scenario('circuit_breaker_alarm', 'src.handler.circuit_breaker', ALARM_EVENT, capture_running, env),
+        Scenario('circuit_breaker_ok', 'src.handler.circuit_breaker', OK_EVENT, capture_throttled, env),
+        Scenario('circuit_breaker_alarm_cached', 'src.handler.circuit_breaker', ALARM_EVENT,
+                 capture_running_flow_rate_cached, env),
+        Scenario('circuit_breaker_alarm_redelivered', 'src.handler.circuit_breaker', ALARM_EVENT,
+                 capture_running_alarm_handled, env),
+        Scenario('circuit_breaker_tick', 'src.handler.circuit_breaker', {}, capture_throttled_alarm_ok, env),
+        Scenario('troubleshoot_change_flow_rate', 'src.handler.troubleshoot',
+                 {'action': 'change_flow_rate', 'flow_rate': 5}, capture_running, env),
+        Scenario('disable_trigger', 'src.db_resize_handler.disable_trigger', {}, capture_running, env),
+        Scenario('drain_trigger', 'src.db_resize_handler.drain_trigger', {}, capture_running, env),
+        Scenario('check_resize', 'src.db_resize_handler.check_resize',
+                 {'resize': {'targetClass': db_resize_handler.SMALL_DB_SIZE}}, capture_small, env),
+        Scenario('enable_trigger', 'src.db_resize_handler.enable_trigger', {}, capture_trigger_disabled, env),
+        Scenario('shrink_db', 'src.db_resize_handler.shrink_db', {}, capture_trigger_disabled, env),
+        Scenario('grow_db', 'src.db_resize_handler.grow_db', {}, capture_small, env),
+        Scenario('shrink_db_failover_mode', 'src.db_resize_handler.shrink_db',
+                 {'mode': db_resize_handler.RESIZE_MODE_FAILOVER}, capture_running, env),
+        Scenario('failover_db', 'src.db_resize_handler.failover_db', failover_event, capture_failover_ready, env),
+        Scenario('check_failover', 'src.db_resize_handler.check_failover', failover_event, capture_failed_over, env),
+        Scenario('delete_old_instance', 'src.db_resize_handler.delete_old_instance', failover_event,
+                 capture_failed_over, env),
+        Scenario('forecast_resize', 'src.forecast_handler.forecast_resize', {}, capture_small_and_busy, env),
+        Scenario('execute_shrink_machine', 'src.db_resize_handler.execute_shrink_machine', ALARM_EVENT,
+                 capture_running, env),
+        Scenario('execute_grow_machine', 'src.db_resize_handler.execute_grow_machine', ALARM_EVENT,
+                 capture_small, env),
+        Scenario('execute_grow_machine_preempts_shrink', 'src.db_resize_handler.execute_grow_machine', ALARM_EVENT,
+                 capture_shrinking, env),
+        Scenario('shrink_observations_db', 'src.db_resize_handler.shrink_observations_db', ALARM_EVENT,
+                 observations_big, env),
+        Scenario('grow_observations_db', 'src.db_resize_handler.grow_observations_db', ALARM_EVENT,
+                 observations_small, env),
+        Scenario('restore_db_cluster', 'src.db_create_handler.restore_db_cluster', {}, create_capture, env),
+        Scenario('modify_postgres_password', 'src.db_create_handler.modify_postgres_password', {},
+                 create_capture, env),
+        Scenario('create_db_instance', 'src.db_create_handler.create_db_instance', {}, nothing, env),
+        Scenario('modify_schema_owner_password', 'src.db_create_handler.modify_schema_owner_password', {},
+                 create_capture, env),
+        Scenario('delete_capture_db', 'src.db_create_handler.delete_capture_db', {}, create_capture, env),
+        Scenario('create_observation_db', 'src.db_create_handler.create_observation_db', {},
+                 create_observations, env),
+        Scenario('delete_observation_db', 'src.db_create_handler.delete_observation_db', {},
+                 create_observations, env),
+        Scenario('modify_observation_postgres_password',
+                 'src.db_create_handler.modify_observation_postgres_password', {}, create_observations, env),
+        Scenario('modify_observation_passwords', 'src.db_create_handler.modify_observation_passwords', {},
+                 create_observations, env),
+        Scenario('create_etl_probe_index', 'src.db_create_handler.create_etl_probe_index', {}, create_observations,
+                 env),
+    ]
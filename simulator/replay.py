@@ -0,0 +1,266 @@
+import re
+from collections import namedtuple
+
+import numpy as np
+
+from src.db_resize_handler import _next_size
+from src.handler import next_flow_rate, next_backlog_flow_rate, health_score, FLOW_RATE_FLOOR, FLOW_RATE_CEILING, \
+    FLOW_RATE_STEP, FLOW_RATE_DECREASE, FLOW_RATE_BACKLOG_STEP, FLOW_HEALTH_RECOVER
+
+"""
+Replays exported CloudWatch series through the ecosystem switch's resize and circuit breaker policies.
+
+The capture load is recovered from the recorded CPU as vCPUs in use (CPU percent times the vCPUs of the class it was
+recorded on), so the same load can be replayed against whatever class the simulated policy would have picked.
+Everything that does not depend on a decision is computed for the whole series at once.  The Python loops are over
+alarm events, of which a year of data has a few hundred at most, and over the circuit breaker ticks after each one
+until the flow rate settles at the floor or the ceiling.
+
+While the error handler alarm is OK the circuit breaker steers by a health score and the trigger queue backlog.  The
+score is modelled from the CPU the load would put on the simulated class and the error handler invocations.  The
+series have no connections, trigger throttles or dead letters, so those count as no pressure, the way a missing
+signal does in health_score, and the max_connections cap on the flow rate is not modelled.  The backlog is the
+period's largest queue depth; there is no oldest message age.
+"""
+
+# The defaults mirror the alarms and state machines in serverless.yml.
+Policy = namedtuple('Policy', [
+    'period_minutes',       # CloudWatch alarm period
+    'high_threshold',       # rdsHighCpuAlarm threshold, percent
+    'high_periods',         # rdsHighCpuAlarm evaluation periods
+    'low_threshold',        # rdsLowCpuAlarm threshold, percent
+    'low_periods',          # rdsLowCpuAlarm evaluation periods
+    'resize_minutes',       # trigger-off time of a resize: drain, modification and readiness polling
+    'resize_cooldown_minutes',  # RESIZE_COOLDOWN_SECONDS, between resizes in the same direction
+    'resize_dwell_minutes',     # RESIZE_DWELL_SECONDS, between resizes in opposite directions
+    'noop_minutes',         # trigger-off time of a resize machine that finds nothing to do
+    'error_threshold',      # error handler invocations per period that put the circuit breaker alarm in ALARM
+    'error_periods',        # circuit breaker alarm evaluation periods
+    'saturation_threshold', # CPU percent counted as saturated
+    'flow_floor',           # circuit breaker FLOW_RATE_FLOOR
+    'flow_ceiling',         # circuit breaker FLOW_RATE_CEILING
+    'flow_step',            # circuit breaker FLOW_RATE_STEP, added per period while the error alarm is OK
+    'flow_decrease',        # circuit breaker FLOW_RATE_DECREASE, multiplied in per period while it is in ALARM
+    'flow_increase_dwell_minutes',  # FLOW_INCREASE_DWELL_SECONDS, before an increase after a decrease
+    'flow_backlog_step',    # circuit breaker FLOW_RATE_BACKLOG_STEP, added per period instead while there is a backlog
+    'flow_health_recover'   # FLOW_HEALTH_RECOVER, health score at which an increase skips the dwell
+])
+
+DEFAULT_POLICY = Policy(
+    period_minutes=5,
+    high_threshold=50,
+    high_periods=2,
+    low_threshold=10,
+    low_periods=6,
+    resize_minutes=25,
+    resize_cooldown_minutes=30,
+    resize_dwell_minutes=60,
+    noop_minutes=5,
+    error_threshold=100,
+    error_periods=1,
+    saturation_threshold=90,
+    flow_floor=FLOW_RATE_FLOOR,
+    flow_ceiling=FLOW_RATE_CEILING,
+    flow_step=FLOW_RATE_STEP,
+    flow_decrease=FLOW_RATE_DECREASE,
+    flow_increase_dwell_minutes=15,
+    flow_backlog_step=FLOW_RATE_BACKLOG_STEP,
+    flow_health_recover=FLOW_HEALTH_RECOVER
+)
+
+Series = namedtuple('Series', ['cpu', 'queue_depth', 'errors'])
+
+
+def vcpus(instance_class):
+    """
+    vCPUs of an r5-style instance class: large is 2, xlarge 4 and Nxlarge 4 * N.
+    """
+    match = re.fullmatch(r'db\.\w+\.(\d*)x?large', instance_class)
+    if match is None:
+        raise Exception(f"Unknown instance class {instance_class}")
+    if not instance_class.endswith('xlarge'):
+        return 2
+    return 4 * int(match.group(1) or 1)
+
+
+def to_periods(values, period_minutes, how='mean'):
+    """
+    Aggregate a 1-minute series into alarm periods by mean, sum or max.  Missing (NaN) minutes are skipped and a
+    period with no data at all comes out as 0.
+    """
+    values = np.asarray(values, dtype=float)
+    periods = -(-len(values) // period_minutes)
+    padded = np.full(periods * period_minutes, np.nan)
+    padded[:len(values)] = values
+    padded = padded.reshape(periods, period_minutes)
+    if how == 'max':
+        return np.nan_to_num(np.fmax.reduce(padded, axis=1))
+    sums = np.nansum(padded, axis=1)
+    if how == 'sum':
+        return sums
+    counts = np.count_nonzero(~np.isnan(padded), axis=1)
+    return sums / np.maximum(counts, 1)
+
+
+def alarm_states(breaching, periods):
+    """
+    ALARM when the last `periods` datapoints all breach, the way an N out of N CloudWatch alarm evaluates.
+    """
+    breaching = np.asarray(breaching, dtype=int)
+    running = np.concatenate(([0], np.cumsum(breaching)))
+    counts = running[periods:] - running[:-periods]
+    states = np.zeros(len(breaching), dtype=bool)
+    states[periods - 1:] = counts == periods
+    return states
+
+
+def transitions(states, initial=False):
+    """
+    Indexes where states goes from OK to ALARM (into_alarm) and from ALARM to OK (into_ok).
+    """
+    previous = np.concatenate(([initial], states[:-1]))
+    return np.flatnonzero(states & ~previous), np.flatnonzero(~states & previous)
+
+
+def simulate(series, ladder, initial_class, recorded_class, policy=DEFAULT_POLICY):
+    """
+    :param series: Series of equal length 1-minute numpy arrays
+    :param ladder: the capture size ladder, smallest first, e.g. db_resize_handler.CAPTURE_DB_SIZES['QA']
+    :param initial_class: the class the simulated database starts on
+    :param recorded_class: the class the CPU series was recorded on
+    :param policy: Policy
+    :return: dict report, see summarize()
+    """
+    pm = policy.period_minutes
+    minute_load = np.nan_to_num(np.asarray(series.cpu, dtype=float)) / 100 * vcpus(recorded_class)
+    load = to_periods(minute_load, pm)
+    period_count = len(load)
+
+    class_index = np.zeros(period_count, dtype=int)
+    trigger_off = np.zeros(period_count, dtype=bool)
+    resize_periods = -(-policy.resize_minutes // pm)
+    noop_periods = -(-policy.noop_minutes // pm)
+    resizes = {'grow': 0, 'shrink': 0, 'noop': 0, 'suppressed': 0}
+    last_start = None
+
+    current = ladder.index(initial_class)
+    segment_start = 0
+    search_from = 0
+    while segment_start < period_count:
+        cpu = np.minimum(load[segment_start:] / vcpus(ladder[current]) * 100, 100)
+        high, _ = transitions(alarm_states(cpu >= policy.high_threshold, policy.high_periods))
+        low, _ = transitions(alarm_states(cpu <= policy.low_threshold, policy.low_periods))
+        events = [(x + segment_start, +1) for x in high[high + segment_start >= search_from][:1]] + \
+                 [(x + segment_start, -1) for x in low[low + segment_start >= search_from][:1]]
+        if not events:
+            class_index[segment_start:] = current
+            break
+        at, step = min(events)
+        if last_start is not None:
+            wait = policy.resize_cooldown_minutes if step == last_start[1] else policy.resize_dwell_minutes
+            if (at - last_start[0]) * pm < wait:
+                # start_resize_machine turns it down and the alarm has to transition again.
+                resizes['suppressed'] += 1
+                search_from = at + 1
+                continue
+        last_start = (at, step)
+        target = ladder.index(_next_size(ladder, ladder[current], step))
+        if target == current:
+            # The state machine still runs and drains the trigger before finding nothing to do.
+            resizes['noop'] += 1
+            trigger_off[at + 1:at + 1 + noop_periods] = True
+            search_from = at + 1 + noop_periods
+            continue
+        resizes['grow' if step > 0 else 'shrink'] += 1
+        done = min(at + 1 + resize_periods, period_count)
+        class_index[segment_start:done] = current
+        trigger_off[at + 1:done] = True
+        current = target
+        segment_start = search_from = done
+
+    errors = to_periods(series.errors, pm, how='sum')
+    breaker = alarm_states(errors >= policy.error_threshold, policy.error_periods)
+    into_alarm, _ = transitions(breaker)
+    cpu = np.minimum(load / np.array([vcpus(x) for x in ladder], dtype=float)[class_index] * 100, 100)
+    flow = simulate_flow(breaker, errors, policy, to_periods(series.queue_depth, pm, how='max'), cpu)
+
+    return summarize(series, ladder, minute_load, class_index, trigger_off, flow, resizes, len(into_alarm), policy)
+
+
+def simulate_flow(breaker, errors, policy=DEFAULT_POLICY, queue_depth=None, cpu=None):
+    """
+    Tick the circuit breaker once per period, the way its schedule does: next_flow_rate while the error handler alarm
+    is in ALARM and next_backlog_flow_rate while it is OK, holding increases back for the dwell after a decrease
+    unless the health score has recovered.  At the floor in ALARM, or at the ceiling while the score is above 0, the
+    flow rate cannot move, so those stretches are filled in without ticking.
+
+    :param breaker: per-period error handler alarm states
+    :param errors: per-period error handler invocations
+    :param queue_depth: per-period largest trigger queue depth, or None for no backlog
+    :param cpu: per-period CPU percent on the simulated class, or None for an idle database
+    :return: per-period trigger reserved concurrency
+    """
+    period_count = len(breaker)
+    # health_score takes the largest pressure, so the score is the smaller of the scores of each signal alone.
+    # get_flow_signals reads the error handler invocations per minute, where errors are per period.
+    score = health_score({'errors': np.asarray(errors, dtype=float) / policy.period_minutes})
+    if cpu is not None:
+        score = np.minimum(score, health_score({'cpu': np.asarray(cpu, dtype=float)}))
+    score = np.broadcast_to(score, period_count)
+    queue_depth = np.zeros(period_count) if queue_depth is None else queue_depth
+    cuts = np.flatnonzero(breaker | (score <= 0))
+    into_ok = np.flatnonzero(~breaker)
+    dwell_periods = policy.flow_increase_dwell_minutes / policy.period_minutes
+    flow = np.empty(period_count, dtype=int)
+    flow_rate = policy.flow_ceiling
+    last_decrease = None
+    at = 0
+    while at < period_count:
+        if flow_rate == policy.flow_ceiling or (flow_rate == policy.flow_floor and breaker[at]):
+            ends = cuts if flow_rate == policy.flow_ceiling else into_ok
+            index = np.searchsorted(ends, at)
+            end = ends[index] if index < len(ends) else period_count
+            if end > at:
+                flow[at:end] = flow_rate
+                at = end
+                continue
+        if breaker[at]:
+            new_flow_rate = next_flow_rate(flow_rate, True, errors[at], policy.error_threshold, policy.flow_floor,
+                                           policy.flow_ceiling, policy.flow_step, policy.flow_decrease)
+        else:
+            new_flow_rate = next_backlog_flow_rate(flow_rate, queue_depth[at], score=score[at],
+                                                   floor=policy.flow_floor, ceiling=policy.flow_ceiling,
+                                                   step=policy.flow_step, backlog_step=policy.flow_backlog_step,
+                                                   decrease=policy.flow_decrease)
+        if new_flow_rate < flow_rate:
+            last_decrease = at
+            flow_rate = new_flow_rate
+        elif last_decrease is None or at - last_decrease >= dwell_periods or \
+                (not breaker[at] and score[at] >= policy.flow_health_recover):
+            flow_rate = new_flow_rate
+        flow[at] = flow_rate
+        at += 1
+    return flow
+
+
+def summarize(series, ladder, minute_load, class_index, trigger_off, flow, resizes, breaker_trips, policy):
+    """
+    :return: dict with instance hours per class, resize counts, trigger-off hours (resizes plus circuit breaker at
+        flow rate 0), saturated hours, circuit breaker trips and the peak queue depth seen while the trigger was off
+    """
+    pm = policy.period_minutes
+    minutes = len(minute_load)
+    per_minute_class = np.repeat(class_index, pm)[:minutes]
+    capacity = np.array([vcpus(x) for x in ladder], dtype=float)[per_minute_class]
+    saturated = minute_load / capacity * 100 >= policy.saturation_threshold
+    off = np.repeat(trigger_off | (flow == 0), pm)[:minutes]
+    hours_per_class = np.bincount(per_minute_class, minlength=len(ladder)) / 60
+    queue_depth = np.asarray(series.queue_depth, dtype=float)
+    return {
+        'instanceHours': {ladder[i]: round(float(x), 2) for i, x in enumerate(hours_per_class) if x},
+        'resizes': resizes,
+        'triggerOffHours': round(float(off.sum()) / 60, 2),
+        'saturatedHours': round(float(saturated.sum()) / 60, 2),
+        'circuitBreakerTrips': int(breaker_trips),
+        'peakQueueDepthWhileOff': float(queue_depth[off].max()) if off.any() else 0.0
+    }
@@ -0,0 +1,59 @@
+import argparse
+import csv
+import json
+import sys
+import time
+
+import numpy as np
+
+from simulator.replay import DEFAULT_POLICY, Policy, Series, simulate
+from src.db_resize_handler import CAPTURE_DB_SIZES
+
+"""
+Offline resize policy simulator.
+
+Reads 1-minute series exported from CloudWatch as a CSV with the columns timestamp, cpu, queue_depth and errors
+(capture writer CPUUtilization, trigger queue ApproximateNumberOfMessagesVisible and error handler Invocations) and
+prints what the policy would have done with them.  Every Policy field can be overridden on the command line.
+
+    python -m simulator.run metrics.csv --recorded-class db.r5.4xlarge
+    python -m simulator.run metrics.csv --recorded-class db.r5.4xlarge --high-threshold 60 --low-periods 12
+"""
+
+
+def read_series(path):
+    """
+    :return: Series of numpy arrays in timestamp order.  Empty cells become NaN.
+    """
+    with open(path, newline='') as f:
+        rows = sorted(csv.DictReader(f), key=lambda x: float(x['timestamp']))
+
+    def column(name):
+        return np.array([float(x[name]) if x.get(name) not in (None, '') else np.nan for x in rows])
+    return Series(cpu=column('cpu'), queue_depth=column('queue_depth'), errors=np.nan_to_num(column('errors')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline resize policy simulator')
+    parser.add_argument('metrics', help='CSV with timestamp, cpu, queue_depth and errors columns at 1-minute steps')
+    parser.add_argument('--stage', default='QA', choices=sorted(CAPTURE_DB_SIZES), help='which size ladder to use')
+    parser.add_argument('--recorded-class', required=True, help='instance class the cpu column was recorded on')
+    parser.add_argument('--initial-class', help='class to start the simulation on (default: --recorded-class)')
+    for field in Policy._fields:
+        default = getattr(DEFAULT_POLICY, field)
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    args = parser.parse_args(argv)
+
+    policy = Policy(**{x: getattr(args, x) for x in Policy._fields})
+    series = read_series(args.metrics)
+    start = time.perf_counter()
+    report = simulate(series, CAPTURE_DB_SIZES[args.stage], args.initial_class or args.recorded_class,
+                      args.recorded_class, policy)
+    report['simulatedDays'] = round(len(series.cpu) / 1440, 1)
+    report['runSeconds'] = round(time.perf_counter() - start, 2)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
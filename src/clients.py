@@ -0,0 +1,61 @@
+import os
+import threading
+
+import boto3
+
+"""
+Process-wide registry of boto3 clients.
+
+Building a boto3 client costs endpoint and credential resolution, so we build at most one client per
+(service, region) and keep it for the life of the Lambda container.  Tests can swap in stubs with set_client
+and should call clear_clients between cases so a stub never leaks into the next test.
+
+Handler modules that want a module-level client name use LazyClient, so importing a handler never builds a
+client it does not end up calling.
+"""
+
+DEFAULT_REGION = 'us-west-2'
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _get_region(region):
+    if region is None:
+        return os.getenv('AWS_DEPLOYMENT_REGION', DEFAULT_REGION)
+    return region
+
+
+def get_client(service_name, region=None):
+    key = (service_name, _get_region(region))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = boto3.client(service_name, key[1])
+                _clients[key] = client
+    return client
+
+
+def set_client(service_name, client, region=None):
+    with _lock:
+        _clients[(service_name, _get_region(region))] = client
+
+
+def clear_clients():
+    with _lock:
+        _clients.clear()
+
+
+class LazyClient:
+    """
+    Stand-in for a module-level boto3 client that defers to the registry on first attribute access.
+    """
+
+    def __init__(self, service_name, region=None):
+        self.service_name = service_name
+        self.region = region
+
+    def __getattr__(self, name):
+        return getattr(get_client(self.service_name, self.region), name)
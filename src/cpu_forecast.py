@@ -0,0 +1,111 @@
+import numpy as np
+
+"""
+CPU forecasting for the capture database.
+
+The model is a seasonal-trend decomposition that only needs whole-array NumPy operations:
+
+    forecast(t) = level + slope * (t - t_last) + daily_profile[slot(t)]
+
+daily_profile is the mean CPU of each time-of-day slot minus the overall mean.  level is an exponentially weighted
+moving average of the deseasonalized series and slope is a least squares fit over its most recent points.  The
+functions take plain timestamp/value sequences so they can be run on metric series recorded from CloudWatch.
+"""
+
+SEASON_SECONDS = 86400
+DEFAULT_PERIOD_SECONDS = 300
+DEFAULT_ALPHA = 0.3
+DEFAULT_TREND_POINTS = 12
+# Below this many points there is not enough history to say anything, so decide() holds.
+MIN_POINTS = 12
+# Each rung of the size ladder has half the vCPUs of the one above it, so the same load shows roughly twice the CPU
+# after a shrink.
+SHRINK_HEADROOM = 2.0
+
+
+def seasonal_profile(timestamps, values, period=DEFAULT_PERIOD_SECONDS, season_seconds=SEASON_SECONDS):
+    """
+    Mean offset from the overall mean for every time-of-day slot.  Slots with no data, and the whole profile when
+    the history is shorter than one season, are zero.
+
+    :param timestamps: epoch seconds, numpy array
+    :param values: CPU percent, numpy array the same length as timestamps
+    :param period: slot width in seconds
+    :param season_seconds: season length in seconds
+    :return: numpy array of season_seconds // period offsets
+    """
+    slot_count = season_seconds // period
+    if len(timestamps) == 0 or timestamps[-1] - timestamps[0] < season_seconds:
+        return np.zeros(slot_count)
+    slots = _slots(timestamps, period, season_seconds)
+    sums = np.bincount(slots, weights=values, minlength=slot_count)
+    counts = np.bincount(slots, minlength=slot_count)
+    profile = np.zeros(slot_count)
+    np.divide(sums, counts, out=profile, where=counts > 0)
+    profile[counts > 0] -= values.mean()
+    return profile
+
+
+def ewma(values, alpha=DEFAULT_ALPHA):
+    """
+    The last value of the exponentially weighted moving average of values, computed as one weighted mean.
+    """
+    weights = (1 - alpha) ** np.arange(len(values))[::-1]
+    return float(np.dot(weights, values) / weights.sum())
+
+
+def forecast_cpu(timestamps, values, horizon, period=DEFAULT_PERIOD_SECONDS, alpha=DEFAULT_ALPHA,
+                 trend_points=DEFAULT_TREND_POINTS, season_seconds=SEASON_SECONDS):
+    """
+    :param timestamps: epoch seconds of the history, in any order
+    :param values: CPU percent for each timestamp
+    :param horizon: epoch seconds to forecast
+    :param period: the metric period in seconds
+    :param alpha: EWMA smoothing factor for the level
+    :param trend_points: how many of the most recent points the slope is fitted to
+    :param season_seconds: season length in seconds
+    :return: numpy array of forecast CPU percent for each horizon timestamp, clipped to 0-100
+    """
+    timestamps = np.asarray(timestamps, dtype=float)
+    values = np.asarray(values, dtype=float)
+    order = np.argsort(timestamps)
+    timestamps, values = timestamps[order], values[order]
+    horizon = np.asarray(horizon, dtype=float)
+
+    profile = seasonal_profile(timestamps, values, period, season_seconds)
+    deseasonalized = values - profile[_slots(timestamps, period, season_seconds)]
+    level = ewma(deseasonalized, alpha)
+    recent = slice(-trend_points, None)
+    slope = 0.0
+    if len(timestamps[recent]) >= 2:
+        slope = np.polyfit(timestamps[recent] - timestamps[-1], deseasonalized[recent], 1)[0]
+    forecast = level + slope * (horizon - timestamps[-1]) + profile[_slots(horizon, period, season_seconds)]
+    return np.clip(forecast, 0, 100)
+
+
+def decide(timestamps, values, now, lead_time, grow_threshold, shrink_threshold, period=DEFAULT_PERIOD_SECONDS):
+    """
+    Whether to resize the capture database ahead of the load.
+
+    Grow when the forecast reaches grow_threshold within lead_time, which is how long a resize takes to land.  Shrink
+    when recent CPU is at or below shrink_threshold, unless the forecast peak within lead_time would reach
+    grow_threshold on an instance one rung smaller.
+
+    :return: dict with 'action' ('grow', 'shrink' or None), 'current' and 'predictedPeak' in percent
+    """
+    if len(values) < MIN_POINTS:
+        return {'action': None, 'current': None, 'predictedPeak': None}
+    horizon = now + np.arange(period, lead_time + period, period)
+    peak = float(forecast_cpu(timestamps, values, horizon, period).max())
+    order = np.argsort(np.asarray(timestamps, dtype=float))
+    current = float(np.asarray(values, dtype=float)[order][-3:].mean())
+    action = None
+    if current >= grow_threshold or peak >= grow_threshold:
+        action = 'grow'
+    elif current <= shrink_threshold and peak * SHRINK_HEADROOM < grow_threshold:
+        action = 'shrink'
+    return {'action': action, 'current': round(current, 1), 'predictedPeak': round(peak, 1)}
+
+
+def _slots(timestamps, period, season_seconds):
+    return ((timestamps % season_seconds) // period).astype(int)
@@ -2,7 +2,9 @@ import datetime
 import json
 import os
 
-import boto3
+from psycopg2 import sql
+
+from src.clients import LazyClient
 from src.rds import RDS
 from src.utils import enable_lambda_trigger, disable_lambda_trigger, \
     DEFAULT_DB_INSTANCE_CLASS, CAPTURE_INSTANCE_TAGS, OBSERVATION_INSTANCE_TAGS,  \
@@ -47,6 +49,39 @@ DEFAULT_DB_INSTANCE_IDENTIFIER = get_capture_db_instance_identifier(STAGE)
 ENGINE = 'aurora-postgresql'
 CAPTURE_DB_SECRET_KEY = get_capture_db_secret_key(STAGE)
 OBSERVATION_REAL = f"WQP-EXTERNAL-{STAGE}"
+# How long the password handlers wait in the invocation for a freshly restored database to accept connections, before
+# leaving it to the state machine's next retry.  CONNECT_RETRY_MARGIN_SECONDS of the Lambda timeout is kept for the
+# work after connecting.
+CONNECT_RETRY_SECONDS = int(os.getenv('CONNECT_RETRY_SECONDS', 60))
+CONNECT_RETRY_MARGIN_SECONDS = 15
+
+# Whether observations db provisioning also builds the index handler.run_etl_query's probe uses.
+ETL_PROBE_INDEX = os.getenv('ETL_PROBE_INDEX', 'true')
+ETL_PROBE_INDEX_NAME = 'batch_job_execution_in_progress_idx'
+# A partial index holding only the job executions still in progress, so it stays tiny however long the job history
+# gets.  Its where clause has to match the probe's for the planner to use it.
+ETL_PROBE_INDEX_SQL = "create index concurrently if not exists {} on {}.batch_job_execution (last_updated) " \
+                      "where status not in ('COMPLETED', 'FAILED')"
+# The schema of batch_job_execution and whether the probe index on it is valid, null if there is no index yet.
+BATCH_JOB_EXECUTION_SCHEMA_SQL = "select t.schemaname, i.indisvalid from pg_tables t " \
+                                 "join pg_namespace n on n.nspname = t.schemaname " \
+                                 "left join pg_class c on c.relnamespace = n.oid and c.relname = %s " \
+                                 "left join pg_index i on i.indexrelid = c.oid " \
+                                 "where t.tablename = 'batch_job_execution'"
+DROP_ETL_PROBE_INDEX_SQL = "drop index concurrently if exists {}.{}"
+
+# Database role and the secret key that holds its password.
+CAPTURE_ROLE_PASSWORDS = [
+    ('capture_owner', 'SCHEMA_OWNER_PASSWORD')
+]
+OBSERVATION_ROLE_PASSWORDS = [
+    ('wqp_core', 'DB_OWNER_PASSWORD'),
+    ('wqp_user', 'WQP_READ_ONLY_PASSWORD'),
+    ('ars_owner', 'ARS_SCHEMA_OWNER_PASSWORD'),
+    ('nwis_ws_star_owner', 'NWIS_SCHEMA_OWNER_PASSWORD'),
+    ('epa_owner', 'EPA_SCHEMA_OWNER_PASSWORD'),
+    ('wdfn_user', 'WDFN_DB_READ_ONLY_PASSWORD')
+]
 
 log_level = os.getenv('LOG_LEVEL', logging.ERROR)
 logger = logging.getLogger(__name__)
@@ -54,10 +89,9 @@ logger.setLevel(log_level)
 
 STAGE = os.getenv('STAGE', 'TEST')
 
-cloudwatch_client = boto3.client('cloudwatch', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
-secrets_client = boto3.client('secretsmanager', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
-rds_client = boto3.client('rds', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
-sqs_client = boto3.client('sqs', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
+secrets_client = LazyClient('secretsmanager')
+rds_client = LazyClient('rds')
+sqs_client = LazyClient('sqs')
 
 
 def _get_date_string(my_datetime):
@@ -92,7 +126,6 @@ def modify_postgres_password(event, context):
     secret_string = json.loads(original['SecretString'])
     postgres_password = secret_string['POSTGRES_PASSWORD']
 
-    response = rds_client.describe_db_clusters()
     rds_client.modify_db_cluster(
         DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER,
         ApplyImmediately=True,
@@ -102,16 +135,20 @@ def modify_postgres_password(event, context):
 
 def delete_capture_db(event, context):
     _validate()
-    try:
-        rds_client.delete_db_instance(
-            DBInstanceIdentifier=DEFAULT_DB_INSTANCE_IDENTIFIER,
-            SkipFinalSnapshot=True
-        )
-    except rds_client.exceptions.DBInstanceNotFoundFault:
-        """
-        We could be in a messed up state where the instance doesn't exist but the cluster does,
-        due to vagaries of how long AWS takes to set up a cluster, so proceed
-        """
+    # A failover mode resize leaves the writer under an alternate identifier, so delete whatever the cluster has.
+    response = rds_client.describe_db_clusters(DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER)
+    instance_ids = [x['DBInstanceIdentifier'] for x in response['DBClusters'][0].get('DBClusterMembers', [])]
+    for instance_id in instance_ids or [DEFAULT_DB_INSTANCE_IDENTIFIER]:
+        try:
+            rds_client.delete_db_instance(
+                DBInstanceIdentifier=instance_id,
+                SkipFinalSnapshot=True
+            )
+        except rds_client.exceptions.DBInstanceNotFoundFault:
+            """
+            We could be in a messed up state where the instance doesn't exist but the cluster does,
+            due to vagaries of how long AWS takes to set up a cluster, so proceed
+            """
 
     rds_client.delete_db_cluster(
         DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER,
@@ -194,10 +231,9 @@ def modify_schema_owner_password(event, context):
     db_host = secret_string['DATABASE_ADDRESS']
     db_name = secret_string['DATABASE_NAME']
     postgres_password = secret_string['POSTGRES_PASSWORD']
-    schema_owner_password = secret_string['SCHEMA_OWNER_PASSWORD']
-    rds = RDS(db_host, 'postgres', db_name, postgres_password)
-    sql = "alter user capture_owner with password %s"
-    rds.alter_permissions(sql, (schema_owner_password,))
+    with RDS(db_host, 'postgres', db_name, postgres_password,
+             connect_retry_seconds=_connect_retry_seconds(context)) as rds:
+        _change_passwords(rds, CAPTURE_ROLE_PASSWORDS, secret_string)
 
     queue_info = sqs_client.get_queue_url(QueueName=CAPTURE_TRIGGER_QUEUE)
     sqs_client.purge_queue(QueueUrl=queue_info['QueueUrl'])
@@ -207,6 +243,30 @@ def modify_schema_owner_password(event, context):
     enable_lambda_trigger(TRIGGER[os.environ['STAGE']])
 
 
+def _change_passwords(rds, role_passwords, secret_string):
+    """
+    Set each role's password from the secret, all in one batch.
+    :param role_passwords: list of (role, secret key) tuples
+    """
+    statements = [(f"alter user {role} with password %s", (secret_string[key],)) for role, key in role_passwords]
+    errors = rds.execute_batch(statements)
+    failed = [f"{role}: {error}" for (role, key), error in zip(role_passwords, errors) if error is not None]
+    changed = [role for (role, key), error in zip(role_passwords, errors) if error is None]
+    logger.info(f"changed passwords for {changed}")
+    if failed:
+        raise Exception(f"could not change passwords for {failed}")
+
+
+def _connect_retry_seconds(context):
+    """
+    :return: CONNECT_RETRY_SECONDS, or less if the invocation does not have that long left
+    """
+    if not hasattr(context, 'get_remaining_time_in_millis'):
+        return CONNECT_RETRY_SECONDS
+    remaining = context.get_remaining_time_in_millis() / 1000 - CONNECT_RETRY_MARGIN_SECONDS
+    return max(min(CONNECT_RETRY_SECONDS, remaining), 0)
+
+
 def get_snapshot_identifier():
     # In the dev account we don't have a list of automatic backups
     # See README
@@ -280,36 +340,46 @@ def modify_observation_passwords(event, context):
     db_host = secret_string['DATABASE_ADDRESS']
     db_name = secret_string['DATABASE_NAME']
     postgres_password = secret_string['POSTGRES_PASSWORD']
-    rds = RDS(db_host, 'postgres', db_name, postgres_password)
-    pwd = secret_string['DB_OWNER_PASSWORD']
-    sql = "alter user wqp_core with password %s"
-    rds.alter_permissions(sql, (pwd,))
-    logger.info("changed wqp_core password")
-
-    pwd = secret_string['WQP_READ_ONLY_PASSWORD']
-    sql = "alter user wqp_user with password %s"
-    rds.alter_permissions(sql, (pwd,))
-    logger.info("changed wqp_user password")
-
-    pwd = secret_string['ARS_SCHEMA_OWNER_PASSWORD']
-    sql = "alter user ars_owner with password %s"
-    rds.alter_permissions(sql, (pwd,))
-    logger.info("changed ars_owner password")
-
-    pwd = secret_string['NWIS_SCHEMA_OWNER_PASSWORD']
-    sql = "alter user nwis_ws_star_owner with password %s"
-    rds.alter_permissions(sql, (pwd,))
-    logger.info("changed nwis_ws_star_owner password")
-
-    pwd = secret_string['EPA_SCHEMA_OWNER_PASSWORD']
-    sql = "alter user epa_owner with password %s"
-    rds.alter_permissions(sql, (pwd,))
-    logger.info("changed epa_owner password")
-
-    pwd = secret_string['WDFN_DB_READ_ONLY_PASSWORD']
-    sql = "alter user wdfn_user with password %s"
-    rds.alter_permissions(sql, (pwd,))
-    logger.info("changed wdfn_user password")
+    with RDS(db_host, 'postgres', db_name, postgres_password,
+             connect_retry_seconds=_connect_retry_seconds(context)) as rds:
+        _change_passwords(rds, OBSERVATION_ROLE_PASSWORDS, secret_string)
+    return True
+
+
+def create_etl_probe_index(event, context):
+    """
+    Optional last step of observations db provisioning: index batch_job_execution for the ETL in progress probe.
+    Building it concurrently does not block the ETL jobs, and it is a no-op once the index exists.
+    :return: True if the index is there, False if turned off or there is no batch_job_execution table yet
+    :raises psycopg2.Error: if the index could not be built
+    """
+    _validate()
+    if ETL_PROBE_INDEX.lower() != 'true':
+        logger.info("ETL_PROBE_INDEX is off, not creating the ETL probe index")
+        return False
+    original = secrets_client.get_secret_value(
+        SecretId=OBSERVATION_REAL,
+    )
+    secret_string = json.loads(original['SecretString'])
+    db_host = secret_string['DATABASE_ADDRESS']
+    db_name = secret_string['DATABASE_NAME']
+    postgres_password = secret_string['POSTGRES_PASSWORD']
+    with RDS(db_host, 'postgres', db_name, postgres_password,
+             connect_retry_seconds=_connect_retry_seconds(context)) as rds:
+        result = rds.execute(BATCH_JOB_EXECUTION_SCHEMA_SQL, (ETL_PROBE_INDEX_NAME,))
+        if result is None:
+            logger.info("No batch_job_execution table, not creating the ETL probe index")
+            return False
+        schema, valid = result
+        # A concurrent build that failed leaves an invalid index behind, which "if not exists" would then keep.
+        if valid is False:
+            logger.info(f"dropping invalid {ETL_PROBE_INDEX_NAME} left by a failed build")
+            rds.execute(sql.SQL(DROP_ETL_PROBE_INDEX_SQL).format(sql.Identifier(schema),
+                                                                 sql.Identifier(ETL_PROBE_INDEX_NAME)))
+        # create index concurrently cannot run inside a transaction, so it goes on its own, and raises if the build
+        # fails instead of being logged and reported as done.
+        rds.execute(sql.SQL(ETL_PROBE_INDEX_SQL).format(sql.Identifier(ETL_PROBE_INDEX_NAME), sql.Identifier(schema)))
+        logger.info(f"created {ETL_PROBE_INDEX_NAME} on {schema}.batch_job_execution")
     return True
 
 
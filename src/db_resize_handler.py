@@ -1,11 +1,14 @@
 import datetime
 import json
 import os
+import time
 
-import boto3
-from src.utils import enable_lambda_trigger, disable_lambda_trigger, DEFAULT_DB_INSTANCE_CLASS, CAPTURE_INSTANCE_TAGS, \
+from src.clients import get_client, LazyClient
+from src.utils import enable_lambda_trigger, disable_lambda_trigger, wait_for_lambda_trigger, drain_lambda_trigger, \
+    DEFAULT_DB_INSTANCE_CLASS, CAPTURE_INSTANCE_TAGS, \
     OBSERVATION_INSTANCE_TAGS, get_capture_db_cluster_identifier, get_capture_db_instance_identifier, \
-    get_capture_db_secret_key
+    get_capture_db_secret_key, warm_up_lambda_trigger
+from src.state import record_action, forget_action, handle_once, RESIZE_STATE
 import logging
 
 TRIGGER = {
@@ -15,19 +18,50 @@ TRIGGER = {
 }
 
 STAGE = os.getenv('STAGE', 'TEST')
+CAPTURE_TRIGGER_QUEUE = f"aqts-capture-trigger-queue-{STAGE}"
 
 DEFAULT_DB_CLUSTER_IDENTIFIER = get_capture_db_cluster_identifier(STAGE)
 DEFAULT_DB_INSTANCE_IDENTIFIER = get_capture_db_instance_identifier(STAGE)
 ENGINE = 'aurora-postgresql'
 CAPTURE_DB_SECRET_KEY = get_capture_db_secret_key(STAGE)
 
-SMALL_DB_SIZE = 'db.r5.xlarge'
-BIG_DB_SIZE = DEFAULT_DB_INSTANCE_CLASS
-BIG_OB_DB_SIZE = 'db.r5.2xlarge'
-SMALL_OB_DB_SIZE = 'db.r5.xlarge'
+# Ordered size ladders, smallest first.  grow_db and shrink_db move one rung per resize.
+CAPTURE_DB_SIZES = {
+    "DEV": ['db.r5.xlarge', 'db.r5.2xlarge', DEFAULT_DB_INSTANCE_CLASS],
+    "TEST": ['db.r5.xlarge', 'db.r5.2xlarge', DEFAULT_DB_INSTANCE_CLASS],
+    "QA": ['db.r5.xlarge', 'db.r5.2xlarge', DEFAULT_DB_INSTANCE_CLASS],
+    "PROD-EXTERNAL": ['db.r5.xlarge', 'db.r5.2xlarge', DEFAULT_DB_INSTANCE_CLASS, 'db.r5.8xlarge']
+}
+# The observations db never goes below db.r5.xlarge, the smallest class it has been sized for.
+OBSERVATIONS_DB_SIZES = {
+    "DEV": ['db.r5.xlarge', 'db.r5.2xlarge', 'db.r5.4xlarge'],
+    "TEST": ['db.r5.xlarge', 'db.r5.2xlarge', 'db.r5.4xlarge'],
+    "QA": ['db.r5.xlarge', 'db.r5.2xlarge', 'db.r5.4xlarge']
+}
 
-cloudwatch_client = boto3.client('cloudwatch', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
-rds_client = boto3.client('rds', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
+SMALL_DB_SIZE = CAPTURE_DB_SIZES[STAGE][0]
+BIG_DB_SIZE = CAPTURE_DB_SIZES[STAGE][-1]
+SMALL_OB_DB_SIZE = OBSERVATIONS_DB_SIZES.get(STAGE, OBSERVATIONS_DB_SIZES['TEST'])[0]
+BIG_OB_DB_SIZE = OBSERVATIONS_DB_SIZES.get(STAGE, OBSERVATIONS_DB_SIZES['TEST'])[-1]
+
+# The resize machines call check_resize every RESIZE_POLL_SECONDS and give up waiting after RESIZE_MAX_CHECKS, which
+# is about as long as the old fixed wait plus the enable_trigger retries.  Keep these in step with serverless.yml.
+RESIZE_POLL_SECONDS = 30
+RESIZE_MAX_CHECKS = 60
+# A resize waits this long after one in the same direction, and RESIZE_DWELL_SECONDS after one in the other, so a
+# borderline CPU alarm cannot start back-to-back or see-saw resizes.
+RESIZE_COOLDOWN_SECONDS = int(os.getenv('RESIZE_COOLDOWN_SECONDS', 1800))
+RESIZE_DWELL_SECONDS = int(os.getenv('RESIZE_DWELL_SECONDS', 3600))
+
+# 'modify' changes the class of the writer in place, which reboots it, so the trigger is drained first.  'failover'
+# adds an instance of the new class to the cluster, fails over to it and deletes the old writer, so the trigger is
+# only paused for the failover itself.  The two instance identifiers alternate between resizes.
+RESIZE_MODE_MODIFY = 'modify'
+RESIZE_MODE_FAILOVER = 'failover'
+RESIZE_STANDBY_SUFFIX = '-alt'
+
+cloudwatch_client = LazyClient('cloudwatch')
+rds_client = LazyClient('rds')
 
 log_level = os.getenv('LOG_LEVEL', logging.ERROR)
 logger = logging.getLogger(__name__)
@@ -39,68 +73,183 @@ DB resize functions
 
 
 def disable_trigger(event, context):
+    """
+    Disable the trigger and wait until the event source mappings report Disabled, so the resize machine
+    knows how long the trigger actually took to stop.
+    """
+    disabled_at = time.time()
     disable_lambda_trigger(TRIGGER[STAGE])
+    settle_seconds = wait_for_lambda_trigger(TRIGGER[STAGE], False)
+    return {'triggerSettleSeconds': settle_seconds, 'triggerDisabledAt': disabled_at}
+
+
+def drain_trigger(event, context):
+    """
+    Disable the trigger and return as soon as the capture work already in flight has finished, so the resize can
+    start without rebooting the instance underneath running capture lambdas.
+    """
+    disabled_at = time.time()
+    drained, drain_seconds = drain_lambda_trigger(TRIGGER[STAGE], CAPTURE_TRIGGER_QUEUE)
+    return {'drained': drained, 'drainSeconds': drain_seconds, 'triggerDisabledAt': disabled_at}
+
+
+def check_resize(event, context):
+    """
+    One readiness poll for the resize state machines.  The machine loops on this until 'ready' is true or
+    'checks' reaches RESIZE_MAX_CHECKS, then moves on to enable_trigger.
+    """
+    resize = event.get('resize', {})
+    target_class = resize['targetClass']
+    instance_id = resize.get('instance', DEFAULT_DB_INSTANCE_IDENTIFIER)
+    checks = resize.get('checks', 0) + 1
+    ready = _is_resize_complete(instance_id, DEFAULT_DB_CLUSTER_IDENTIFIER, target_class)
+    if not ready and checks >= RESIZE_MAX_CHECKS:
+        logger.warning(f"{instance_id} is not {target_class} after {checks} checks, moving on")
+    return dict(resize, checks=checks, ready=ready)
+
+
+def failover_db(event, context):
+    """
+    Promote the instance added by a 'failover' mode resize to writer.
+    """
+    new_instance_id = event['resize']['instance']
+    response = rds_client.failover_db_cluster(
+        DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER,
+        TargetDBInstanceIdentifier=new_instance_id
+    )
+    logger.info(f"Failing over to {new_instance_id}, please stand by. {response}")
+
+
+def check_failover(event, context):
+    """
+    One poll of the failover started by failover_db, looped on by the state machine the same way as check_resize.
+    """
+    failover = event.get('failover', {})
+    checks = failover.get('checks', 0) + 1
+    response = rds_client.describe_db_clusters(DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER)
+    cluster = response['DBClusters'][0]
+    ready = cluster['Status'] == 'available' and _find_writer(cluster) == event['resize']['instance']
+    return {'checks': checks, 'ready': ready}
+
+
+def delete_old_instance(event, context):
+    """
+    Remove the writer that a 'failover' mode resize replaced.  Refuses to delete the instance if it is somehow
+    still the writer.
+    """
+    old_instance_id = event['resize']['oldInstance']
+    response = rds_client.describe_db_clusters(DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER)
+    if _find_writer(response['DBClusters'][0]) == old_instance_id:
+        raise Exception(f"{old_instance_id} is still the writer, not deleting it")
+    try:
+        rds_client.delete_db_instance(DBInstanceIdentifier=old_instance_id)
+    except rds_client.exceptions.DBInstanceNotFoundFault:
+        logger.info(f"{old_instance_id} is already gone")
 
 
 def enable_trigger(event, context):
     if _is_cluster_available(DEFAULT_DB_CLUSTER_IDENTIFIER):
+        warm_up_lambda_trigger(TRIGGER[STAGE], DEFAULT_DB_CLUSTER_IDENTIFIER)
         enable_lambda_trigger(TRIGGER[STAGE])
+        disabled_at = event.get('drain', {}).get('triggerDisabledAt')
+        if disabled_at is not None:
+            trigger_off_seconds = round(time.time() - disabled_at, 1)
+            logger.info(f"Trigger was off for {trigger_off_seconds} seconds")
+            return {'triggerOffSeconds': trigger_off_seconds}
 
 
 def shrink_db(event, context):
     logger.info(event)
-    response = rds_client.describe_db_instances(DBInstanceIdentifier=DEFAULT_DB_INSTANCE_IDENTIFIER)
-    db_instance_class = str(response['DBInstances'][0]['DBInstanceClass'])
-    if db_instance_class == SMALL_DB_SIZE:
+    cluster = rds_client.describe_db_clusters(DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER)['DBClusters'][0]
+    instance_id = _find_writer(cluster)
+    response = rds_client.describe_db_instances(DBInstanceIdentifier=instance_id)
+    db_instance_class = _effective_instance_class(response['DBInstances'][0])
+    target_class = _next_size(CAPTURE_DB_SIZES[STAGE], db_instance_class, -1)
+    if db_instance_class == target_class:
         logger.info(f"Cannot shrink the db because it already shrank")
-    elif not _is_cluster_available(DEFAULT_DB_CLUSTER_IDENTIFIER):
+        return {'targetClass': target_class, 'instance': instance_id}
+    elif cluster['Status'] != 'available':
         raise Exception("Cluster is not available")
-    else:
-        response = rds_client.modify_db_instance(
-            DBInstanceIdentifier=DEFAULT_DB_INSTANCE_IDENTIFIER,
-            DBInstanceClass=SMALL_DB_SIZE,
-            ApplyImmediately=True
-        )
-        logger.info(f"Shrinking DB, please stand by. {response}")
+    return _start_resize(instance_id, target_class, event.get('mode', RESIZE_MODE_MODIFY))
 
 
 def grow_db(event, context):
     logger.info(event)
-    response = rds_client.describe_db_instances(DBInstanceIdentifier=DEFAULT_DB_INSTANCE_IDENTIFIER)
-    db_instance_class = str(response['DBInstances'][0]['DBInstanceClass'])
-    if db_instance_class == BIG_DB_SIZE:
+    cluster = rds_client.describe_db_clusters(DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER)['DBClusters'][0]
+    instance_id = _find_writer(cluster)
+    response = rds_client.describe_db_instances(DBInstanceIdentifier=instance_id)
+    db_instance_class = _effective_instance_class(response['DBInstances'][0])
+    target_class = _next_size(CAPTURE_DB_SIZES[STAGE], db_instance_class, 1)
+    if db_instance_class == target_class:
         logger.info("DB is already grown")
-    elif not _is_cluster_available(DEFAULT_DB_CLUSTER_IDENTIFIER):
+        return {'targetClass': target_class, 'instance': instance_id}
+    elif cluster['Status'] != 'available':
         raise Exception("Cluster is not available")
-    else:
-        response = rds_client.modify_db_instance(
-            DBInstanceIdentifier=DEFAULT_DB_INSTANCE_IDENTIFIER,
-            DBInstanceClass=BIG_DB_SIZE,
-            ApplyImmediately=True
-        )
-        logger.info(f"Growing the DB, please stand by. {response}")
+    return _start_resize(instance_id, target_class, event.get('mode', RESIZE_MODE_MODIFY))
 
 
+@handle_once
 def execute_shrink_machine(event, context):
-    arn = os.environ['SHRINK_STATE_MACHINE_ARN']
-    payload = {}
     alarm_state = event["detail"]["state"]["value"]
     if alarm_state == "ALARM":
-        _execute_state_machine(arn, json.dumps(payload))
-        return True
+        return start_resize_machine('shrink')
     return False
 
 
+@handle_once
 def execute_grow_machine(event, context):
-    arn = os.environ['GROW_STATE_MACHINE_ARN']
-    payload = {}
     alarm_state = event["detail"]["state"]["value"]
     if alarm_state == "ALARM":
-        _execute_state_machine(arn, json.dumps(payload))
-        return True
+        return start_resize_machine('grow')
     return False
 
 
+def start_resize_machine(action):
+    """
+    Start the grow or shrink state machine so that only the latest intent is ever in flight:
+    - a running execution in the same direction already covers it, so nothing is started;
+    - a resize waits RESIZE_COOLDOWN_SECONDS after one in the same direction, and RESIZE_DWELL_SECONDS after one in
+      the other direction that has finished;
+    - a running execution in the other direction is stopped, without waiting out the dwell.  The new one works from
+      whatever it left behind, see _effective_instance_class and _start_resize, and resumes the trigger if it was
+      stopped with the trigger paused.
+    :param action: 'grow' or 'shrink'
+    :return: True if the state machine was started
+    """
+    arns = {'grow': os.environ['GROW_STATE_MACHINE_ARN'], 'shrink': os.environ['SHRINK_STATE_MACHINE_ARN']}
+    opposite = 'shrink' if action == 'grow' else 'grow'
+    if _get_running_executions(arns[action]):
+        logger.info(f"A {action} execution is already running, not starting another")
+        return False
+    # Preempting a running execution is the latest intent winning, so the dwell that holds back a flapping alarm
+    # does not apply to it; the cooldown in the same direction still does.
+    preempted = _get_running_executions(arns[opposite])
+    dwell = 0 if preempted else RESIZE_DWELL_SECONDS
+    now = time.time()
+    if not record_action(RESIZE_STATE, action, RESIZE_COOLDOWN_SECONDS, dwell, now):
+        logger.info(f"Not starting the {action} state machine")
+        return False
+    try:
+        payload = {'mode': os.getenv('RESIZE_MODE', RESIZE_MODE_MODIFY)}
+        for execution_arn in preempted:
+            logger.info(f"Stopping {opposite} execution {execution_arn} in favour of {action}")
+            get_client('stepfunctions').stop_execution(executionArn=execution_arn, error='Preempted',
+                                                       cause=f"Superseded by a {action} request")
+        if preempted:
+            payload['preempted'] = preempted
+        _execute_state_machine(arns[action], json.dumps(payload))
+    except Exception:
+        # Otherwise the retry would be held back by the cooldown of a resize that never started.
+        forget_action(RESIZE_STATE, action, now, RESIZE_COOLDOWN_SECONDS, RESIZE_DWELL_SECONDS)
+        raise
+    return True
+
+
+def _get_running_executions(state_machine_arn):
+    response = get_client('stepfunctions').list_executions(stateMachineArn=state_machine_arn, statusFilter='RUNNING')
+    return [x['executionArn'] for x in response['executions']]
+
+
 def _get_cpu_utilization(db_instance_identifier, period_in_seconds, total_time):
     response = cloudwatch_client.get_metric_data(
         MetricDataQueries=[
@@ -127,6 +276,22 @@ def _get_cpu_utilization(db_instance_identifier, period_in_seconds, total_time):
     return response
 
 
+def _next_size(sizes, current_class, step):
+    """
+    The rung next to current_class on a size ladder.
+
+    :param sizes: the ladder, smallest first
+    :param current_class: the instance class now
+    :param step: 1 to grow, -1 to shrink
+    :return: the class to resize to, which is current_class when it is already at that end of the ladder.  A class
+        that is not on the ladder (changed by hand, say) goes straight to the end it is moving towards.
+    """
+    if current_class not in sizes:
+        return sizes[-1] if step > 0 else sizes[0]
+    index = min(max(sizes.index(current_class) + step, 0), len(sizes) - 1)
+    return sizes[index]
+
+
 def _validate():
     """
     If we are limiting resize functionality to specific tiers for any reason do it here.
@@ -135,17 +300,95 @@ def _validate():
 
 
 def _is_cluster_available(cluster_id):
-    response = rds_client.describe_db_clusters()
-    all_dbs = response['DBClusters']
-    available_clusters = [x['DBClusterIdentifier'] for x in all_dbs if x['Status'] == 'available']
-    if cluster_id in available_clusters:
+    response = rds_client.describe_db_clusters(DBClusterIdentifier=cluster_id)
+    if response['DBClusters'][0]['Status'] == 'available':
         return True
     else:
-        raise Exception(f"DB {DEFAULT_DB_CLUSTER_IDENTIFIER} is not ready yet")
+        raise Exception(f"DB {cluster_id} is not ready yet")
+
+
+def _find_writer(cluster):
+    """
+    The writer's identifier changes after every 'failover' mode resize, so look it up from the cluster members.
+    """
+    for member in cluster.get('DBClusterMembers', []):
+        if member['IsClusterWriter']:
+            return member['DBInstanceIdentifier']
+    return DEFAULT_DB_INSTANCE_IDENTIFIER
+
+
+def _get_standby_identifier(writer_id):
+    if writer_id == DEFAULT_DB_INSTANCE_IDENTIFIER:
+        return f"{DEFAULT_DB_INSTANCE_IDENTIFIER}{RESIZE_STANDBY_SUFFIX}"
+    return DEFAULT_DB_INSTANCE_IDENTIFIER
+
+
+def _start_resize(instance_id, target_class, mode):
+    """
+    :param instance_id: the current writer
+    :param target_class: the instance class to end up with
+    :param mode: RESIZE_MODE_MODIFY or RESIZE_MODE_FAILOVER
+    :return: the resize state the rest of the state machine works from
+    """
+    if mode == RESIZE_MODE_FAILOVER:
+        new_instance_id = _get_standby_identifier(instance_id)
+        try:
+            response = rds_client.create_db_instance(
+                DBInstanceIdentifier=new_instance_id,
+                DBInstanceClass=target_class,
+                DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER,
+                Engine=ENGINE,
+                PromotionTier=0,
+                Tags=CAPTURE_INSTANCE_TAGS
+            )
+            logger.info(f"Adding {new_instance_id} as {target_class}, please stand by. {response}")
+        except rds_client.exceptions.DBInstanceAlreadyExistsFault:
+            # Left behind by a resize that was stopped part way, so reuse it.  This fails and is retried while it is
+            # still being created.
+            response = rds_client.modify_db_instance(
+                DBInstanceIdentifier=new_instance_id,
+                DBInstanceClass=target_class,
+                ApplyImmediately=True
+            )
+            logger.info(f"Reusing {new_instance_id} as {target_class}, please stand by. {response}")
+        return {'targetClass': target_class, 'instance': new_instance_id, 'oldInstance': instance_id}
+    response = rds_client.modify_db_instance(
+        DBInstanceIdentifier=instance_id,
+        DBInstanceClass=target_class,
+        ApplyImmediately=True
+    )
+    logger.info(f"Resizing {instance_id} to {target_class}, please stand by. {response}")
+    return {'targetClass': target_class, 'instance': instance_id}
+
+
+def _effective_instance_class(instance):
+    """
+    The class an instance is on its way to.  A resize that was stopped part way can leave a class change pending,
+    and the next resize has to step from there rather than from the class the instance still reports.
+    """
+    return str(instance.get('PendingModifiedValues', {}).get('DBInstanceClass', instance['DBInstanceClass']))
+
+
+def _is_resize_complete(instance_id, cluster_id, target_class):
+    """
+    The cluster status stays 'available' while one of its instances is being modified, so look at the instance too.
+
+    :param instance_id: the instance being resized
+    :param cluster_id: the cluster it belongs to
+    :param target_class: the instance class the resize asked for
+    :return: True once the instance runs as target_class with nothing pending and the cluster is available
+    """
+    instance = rds_client.describe_db_instances(DBInstanceIdentifier=instance_id)['DBInstances'][0]
+    if instance['DBInstanceStatus'] != 'available' or instance['DBInstanceClass'] != target_class:
+        return False
+    if 'DBInstanceClass' in instance.get('PendingModifiedValues', {}):
+        return False
+    cluster = rds_client.describe_db_clusters(DBClusterIdentifier=cluster_id)['DBClusters'][0]
+    return cluster['Status'] == 'available'
 
 
 def _execute_state_machine(state_machine_arn, invocation_payload, region='us-west-2'):
-    sf = boto3.client('stepfunctions', region_name=region)
+    sf = get_client('stepfunctions', region)
     resp = sf.start_execution(
         stateMachineArn=state_machine_arn,
         input=invocation_payload
@@ -153,6 +396,7 @@ def _execute_state_machine(state_machine_arn, invocation_payload, region='us-wes
     return resp
 
 
+@handle_once
 def shrink_observations_db(event, context):
     _validate_observations_resize()
     alarm_state = event["detail"]["state"]["value"]
@@ -161,18 +405,20 @@ def shrink_observations_db(event, context):
         ob_id = f"observations-{STAGE.lower()}"
         response = rds_client.describe_db_instances(DBInstanceIdentifier=ob_id)
         db_instance_class = str(response['DBInstances'][0]['DBInstanceClass'])
-        if db_instance_class == SMALL_OB_DB_SIZE:
+        target_class = _next_size(OBSERVATIONS_DB_SIZES[STAGE], db_instance_class, -1)
+        if db_instance_class == target_class:
             logger.info(f"Cannot shrink the observations db because it already shrank")
         else:
             logger.info("Disabling the trigger!")
             response = rds_client.modify_db_instance(
                 DBInstanceIdentifier=ob_id,
-                DBInstanceClass=SMALL_OB_DB_SIZE,
+                DBInstanceClass=target_class,
                 ApplyImmediately=True
             )
             logger.info(f"Shrinking observations DB, please stand by. {response}")
 
 
+@handle_once
 def grow_observations_db(event, context):
     _validate_observations_resize()
     alarm_state = event["detail"]["state"]["value"]
@@ -181,13 +427,14 @@ def grow_observations_db(event, context):
         ob_id = f"observations-{STAGE.lower()}"
         response = rds_client.describe_db_instances(DBInstanceIdentifier=ob_id)
         db_instance_class = str(response['DBInstances'][0]['DBInstanceClass'])
-        if db_instance_class == BIG_OB_DB_SIZE:
+        target_class = _next_size(OBSERVATIONS_DB_SIZES[STAGE], db_instance_class, 1)
+        if db_instance_class == target_class:
             logger.info(f"Cannot grow the observations db because it already shrank")
         else:
             logger.info("Disabling the trigger!")
             response = rds_client.modify_db_instance(
                 DBInstanceIdentifier=ob_id,
-                DBInstanceClass=BIG_OB_DB_SIZE,
+                DBInstanceClass=target_class,
                 ApplyImmediately=True
             )
             logger.info(f"Growing observations DB, please stand by. {response}")
@@ -0,0 +1,89 @@
+import os
+import time
+
+from src.cpu_forecast import decide
+from src.db_resize_handler import CAPTURE_DB_SIZES, DEFAULT_DB_CLUSTER_IDENTIFIER, STAGE, rds_client, \
+    start_resize_machine, _find_writer, _get_cpu_utilization, _next_size
+import logging
+
+"""
+Scheduled, forecast driven resize of the capture database.  Kept out of db_resize_handler so that the resize
+lambdas do not pay for importing NumPy on a cold start.
+"""
+
+FORECAST_PERIOD_SECONDS = 300
+FORECAST_HISTORY_SECONDS = 7 * 86400
+# How far ahead a grow has to be started: the drain, the modification and the trigger coming back.
+FORECAST_LEAD_TIME_SECONDS = 1800
+# In the message of RDS-EVENT-0014, which RDS logs when it has applied a change of instance class.
+CLASS_CHANGE_MESSAGE = 'DB instance class'
+
+log_level = os.getenv('LOG_LEVEL', logging.ERROR)
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+
+def forecast_resize(event, context):
+    """
+    Forecast the capture writer's CPU and start the grow or shrink state machine ahead of the load.  Does nothing
+    when the database is already at that end of its size ladder.
+    """
+    cluster = rds_client.describe_db_clusters(DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER)['DBClusters'][0]
+    if cluster['Status'] != 'available':
+        return {'action': None, 'reason': f"cluster is {cluster['Status']}"}
+    instance_id = _find_writer(cluster)
+    instance = rds_client.describe_db_instances(DBInstanceIdentifier=instance_id)['DBInstances'][0]
+    db_instance_class = instance['DBInstanceClass']
+    timestamps, values = _get_cpu_history(instance_id, _get_last_class_change(instance))
+    decision = decide(
+        timestamps, values, time.time(),
+        lead_time=int(os.getenv('FORECAST_LEAD_TIME_SECONDS', FORECAST_LEAD_TIME_SECONDS)),
+        grow_threshold=float(os.getenv('GROW_THRESHOLD', 50)),
+        shrink_threshold=float(os.getenv('SHRINK_THRESHOLD', 10)),
+        period=FORECAST_PERIOD_SECONDS
+    )
+    logger.info(f"CPU forecast for {instance_id}: {decision}")
+    if decision['action'] is None:
+        return decision
+
+    step = 1 if decision['action'] == 'grow' else -1
+    if _next_size(CAPTURE_DB_SIZES[STAGE], db_instance_class, step) == db_instance_class:
+        return dict(decision, action=None, reason=f"{db_instance_class} is the end of the ladder")
+
+    if not start_resize_machine(decision['action']):
+        return dict(decision, action=None, reason='too soon after the last resize')
+    return decision
+
+
+def _get_last_class_change(instance):
+    """
+    When the writer last changed instance class: when it was created, which is how a 'failover' mode resize changes
+    it, or the latest change of class applied to it in place, for a 'modify' mode resize.
+    :return: epoch seconds
+    """
+    changed = instance['InstanceCreateTime'].timestamp()
+    response = rds_client.describe_events(
+        SourceIdentifier=instance['DBInstanceIdentifier'],
+        SourceType='db-instance',
+        EventCategories=['configuration change'],
+        Duration=FORECAST_HISTORY_SECONDS // 60
+    )
+    for event in response['Events']:
+        if CLASS_CHANGE_MESSAGE in event['Message']:
+            changed = max(changed, event['Date'].timestamp())
+    return changed
+
+
+def _get_cpu_history(instance_id, since):
+    """
+    CPU percent is only comparable between datapoints recorded on the same instance class, so the history starts at
+    the last class change.  Until there is a day of it the forecast has no daily profile, see seasonal_profile.
+    :param since: epoch seconds of the writer's last class change
+    :return: (epoch seconds, CPU percent) lists for the last FORECAST_HISTORY_SECONDS, or since the writer's last
+        class change if that is more recent
+    """
+    history_seconds = int(min(FORECAST_HISTORY_SECONDS, max(time.time() - since, FORECAST_PERIOD_SECONDS)))
+    response = _get_cpu_utilization(instance_id, FORECAST_PERIOD_SECONDS, history_seconds)
+    result = response['MetricDataResults'][0]
+    timestamps = [x.timestamp() for x in result['Timestamps']]
+    return timestamps, result['Values']
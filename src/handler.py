@@ -1,15 +1,20 @@
 import datetime
 import json
+import math
 import os
+import time
 
 import boto3
 
-from src.db_resize_handler import disable_trigger, enable_trigger
-from src.rds import RDS
-from src.utils import enable_lambda_trigger, describe_db_clusters, start_db_cluster, disable_lambda_trigger, \
+from src.clients import get_client, LazyClient
+from src.rds import RDS, QueryTimeoutError
+from src.state import get_state, put_state, clear_state, suppression_reason, append_action, handle_once, \
+    FLOW_RATE_STATE
+from src.utils import enable_lambda_trigger, get_db_cluster_status, start_db_cluster, disable_lambda_trigger, \
     stop_db_cluster, \
     purge_queue, stop_observations_db_instance, DEFAULT_DB_INSTANCE_CLASS, get_capture_db_secret_key, \
-    get_capture_db_cluster_identifier, get_capture_db_instance_identifier
+    get_capture_db_cluster_identifier, get_capture_db_instance_identifier, get_flow_signals, warm_up_lambda_trigger, \
+    get_writer_instance_class, max_trigger_concurrency, MAX_CONNECTIONS
 import logging
 
 STAGES = ['DEV', 'TEST', 'QA', 'PROD-EXTERNAL']
@@ -45,6 +50,43 @@ TRIGGER = {
 STAGE = os.getenv('STAGE', 'TEST')
 CAPTURE_TRIGGER_QUEUE = f"aqts-capture-trigger-queue-{STAGE}"
 ERROR_QUEUE = f"aqts-capture-error-queue-{STAGE}"
+ERROR_HANDLER_ALARM = f"aqts-capture-error-handler-{STAGE}-invocation-alarm"
+ERROR_HANDLER_FUNCTION = os.getenv('ERROR_HANDLER_FUNCTION', f"aqts-capture-error-handler-{STAGE}-aqtsErrorHandler")
+
+# The circuit breaker is an additive-increase/multiplicative-decrease controller on the trigger's reserved
+# concurrency: on every tick it adds FLOW_RATE_STEP while the error handler alarm is OK, and multiplies by
+# FLOW_RATE_DECREASE (or by threshold / error rate, whichever cuts deeper) while it is in ALARM.
+FLOW_RATE_FLOOR = int(os.getenv('FLOW_RATE_FLOOR', 0))
+FLOW_RATE_CEILING = int(os.getenv('FLOW_RATE_CEILING', 10))
+FLOW_RATE_STEP = int(os.getenv('FLOW_RATE_STEP', 2))
+FLOW_RATE_DECREASE = float(os.getenv('FLOW_RATE_DECREASE', 0.5))
+# While the alarm is OK the step also depends on the trigger queue backlog and the capture writer's CPU: above
+# FLOW_CPU_SATURATED the flow rate is cut as if in ALARM, above FLOW_CPU_BUSY it is held, and below that a backlog
+# (FLOW_BACKLOG_MESSAGES visible, or the oldest message FLOW_BACKLOG_AGE_SECONDS old) raises it by
+# FLOW_RATE_BACKLOG_STEP instead of FLOW_RATE_STEP.
+FLOW_CPU_SATURATED = float(os.getenv('FLOW_CPU_SATURATED', 85))
+FLOW_CPU_BUSY = float(os.getenv('FLOW_CPU_BUSY', 65))
+FLOW_BACKLOG_MESSAGES = int(os.getenv('FLOW_BACKLOG_MESSAGES', 500))
+FLOW_BACKLOG_AGE_SECONDS = int(os.getenv('FLOW_BACKLOG_AGE_SECONDS', 900))
+FLOW_RATE_BACKLOG_STEP = int(os.getenv('FLOW_RATE_BACKLOG_STEP', 5))
+# The health score folds the writer's CPU together with the other signals the alarm only sees late: error handler
+# invocations, trigger throttles and dead letter queue growth per minute, and the writer's connections as a share of
+# its max_connections.  Each is scaled so that 1 is as much as we can take (FLOW_CPU_SATURATED for CPU), and the
+# score is 1 minus the worst of them.  At or below 0 the flow rate is cut, below FLOW_HEALTH_HOLD it is held, and at
+# or above FLOW_HEALTH_RECOVER an increase does not wait out the dwell after a cut.
+HEALTH_ERROR_INVOCATIONS = float(os.getenv('HEALTH_ERROR_INVOCATIONS', 100))
+HEALTH_THROTTLES = float(os.getenv('HEALTH_THROTTLES', 100))
+HEALTH_DEAD_LETTERS = float(os.getenv('HEALTH_DEAD_LETTERS', 100))
+HEALTH_CONNECTION_SHARE = float(os.getenv('HEALTH_CONNECTION_SHARE', 0.9))
+FLOW_HEALTH_HOLD = float(os.getenv('FLOW_HEALTH_HOLD', 1 - FLOW_CPU_BUSY / FLOW_CPU_SATURATED))
+FLOW_HEALTH_RECOVER = float(os.getenv('FLOW_HEALTH_RECOVER', 0.75))
+# Against a flapping alarm: a flow rate change waits FLOW_COOLDOWN_SECONDS after a change in the same direction, and
+# an increase waits FLOW_INCREASE_DWELL_SECONDS after a decrease.  A decrease never waits on an increase.
+FLOW_COOLDOWN_SECONDS = int(os.getenv('FLOW_COOLDOWN_SECONDS', 240))
+FLOW_INCREASE_DWELL_SECONDS = int(os.getenv('FLOW_INCREASE_DWELL_SECONDS', 900))
+# How long the circuit breaker trusts its cached flow rate before reading the trigger's concurrency again.  The
+# record also holds the change history, so it lives at least as long as the dwell.
+FLOW_RATE_STATE_TTL_SECONDS = max(int(os.getenv('FLOW_RATE_STATE_TTL_SECONDS', 900)), FLOW_INCREASE_DWELL_SECONDS)
 
 DEFAULT_DB_CLUSTER_IDENTIFIER = get_capture_db_cluster_identifier(STAGE)
 DEFAULT_DB_INSTANCE_IDENTIFIER = get_capture_db_instance_identifier(STAGE)
@@ -57,10 +99,8 @@ logger.setLevel(log_level)
 
 STAGE = os.getenv('STAGE', 'TEST')
 
-cloudwatch_client = boto3.client('cloudwatch', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
-secrets_client = boto3.client('secretsmanager', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
-rds_client = boto3.client('rds', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
-sqs_client = boto3.client('sqs', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
+secrets_client = LazyClient('secretsmanager')
+rds_client = LazyClient('rds')
 
 
 def _get_etl_start():
@@ -75,9 +115,13 @@ def _get_etl_start():
     return my_etl_start
 
 
-etl_start = _get_etl_start()
+# The ETL probe gives up after this long, and the observations db is left running.
+ETL_QUERY_TIMEOUT_SECONDS = int(os.getenv('ETL_QUERY_TIMEOUT_SECONDS', 30))
+# Only whether one job execution is in progress matters, so the probe stops at the first one instead of counting them.
+# Its where clause matches the partial index db_create_handler.create_etl_probe_index builds.
 OBSERVATIONS_ETL_IN_PROGRESS_SQL = \
-    "select count(1) from batch_job_execution where status not in ('COMPLETED', 'FAILED') and last_updated > %s"
+    "select exists (select 1 from batch_job_execution " \
+    "where status not in ('COMPLETED', 'FAILED') and last_updated > %s)"
 
 """
 DB stop and start functions
@@ -112,7 +156,7 @@ def stop_observations_db(event, context):
     stage = os.getenv('STAGE')
     if stage not in STAGES:
         raise Exception(f"stage not recognized {os.getenv('STAGE')}")
-    should_stop = run_etl_query()
+    should_stop = run_etl_query(context=context)
     if not should_stop:
         return {
             'statusCode': 200,
@@ -136,54 +180,169 @@ def start_observations_db(event, context):
     }
 
 
+@handle_once
 def circuit_breaker(event, context):
     """
-    Right now we are only listening for the error handler alarm, because it
-    is the last alarm to get triggered when we are going into a death spiral.
+    Steer the capture trigger's reserved concurrency by the error handler alarm, which is the last alarm to get
+    triggered when we are going into a death spiral, and while it is OK by the flow signals as well.
+
+    Invoked with the alarm's state change event, and on a schedule (any event without an alarm state) so the flow
+    rate keeps moving while the alarm stays in one state.  While the alarm is OK the trigger queue backlog and a
+    health score decide how fast it moves, see health_score and next_backlog_flow_rate, and it never goes above what
+    the writer's max_connections can take.  The score can cut the flow rate before the alarm fires, and a healthy
+    score lets it climb back without waiting out the dwell after a cut.
     :param event:
     :param context:
     :return:
     """
     logger.info(event)
-    alarm_state = event["detail"]["state"]["value"]
     stage = os.getenv('STAGE')
     if stage not in STAGES:
         raise Exception(f"stage not recognized {os.getenv('STAGE')}")
-    if alarm_state == "ALARM":
+    state = event.get('detail', {}).get('state')
+    if state is None:
+        alarms = get_client('cloudwatch').describe_alarms(AlarmNames=[ERROR_HANDLER_ALARM])['MetricAlarms']
+        if not alarms:
+            logger.warning(f"{ERROR_HANDLER_ALARM} not found, no change made.")
+            return
+        state = {'value': alarms[0]['StateValue'], 'reasonData': alarms[0].get('StateReasonData')}
+    in_alarm = state['value'] == "ALARM"
+    if in_alarm:
         logger.info(f"ALARM!")
-        flow_rate = get_flow_rate()
-        if flow_rate == 10:
-            logger.info(f"Adjusting flow rate to 5")
-            adjust_flow_rate(5)
-        elif flow_rate == 5:
-            logger.info(f"Adjusting flow rate to 0")
-            adjust_flow_rate(0)
-        elif flow_rate == 0:
-            logger.info(f"The flow rate is already at 0 so no change made.")
-        else:
-            raise Exception(f"Invalid flow rate {flow_rate}")
     else:
         """
         Ramp up the reserved concurrency on aqts-capture-trigger to increase the data flow rate.
         """
         logger.info(f"The error handler notifications have calmed down.  Let's try to ramp things up.")
-        flow_rate = get_flow_rate()
-        if flow_rate == 0:
-            logger.info(f"Adjusting flow rate up to 5.")
-            adjust_flow_rate(5)
-        elif flow_rate == 5:
-            logger.info(f"Adjusting flow rate up to 10.")
-            adjust_flow_rate(10)
-        elif flow_rate == 10:
-            logger.info(f"We already at maximum flow rate, so no change made.")
-        else:
-            raise Exception(f"Invalid flow rate {flow_rate}")
+    cached, version = get_state(FLOW_RATE_STATE)
+    flow_rate = cached['flowRate'] if cached is not None else get_flow_rate()
+    score = None
+    if in_alarm:
+        error_rate, threshold = _parse_alarm_reason_data(state.get('reasonData'))
+        new_flow_rate = next_flow_rate(flow_rate, in_alarm, error_rate, threshold)
+    else:
+        signals = get_flow_signals(CAPTURE_TRIGGER_QUEUE, DEFAULT_DB_CLUSTER_IDENTIFIER, TRIGGER[STAGE][0],
+                                   ERROR_HANDLER_FUNCTION, ERROR_QUEUE)
+        instance_class = get_writer_instance_class(DEFAULT_DB_CLUSTER_IDENTIFIER)
+        score = health_score(signals, MAX_CONNECTIONS.get(instance_class))
+        logger.info(f"Flow signals {signals}, health score {score:.2f}")
+        new_flow_rate = next_backlog_flow_rate(flow_rate, signals.get('messages'), signals.get('oldestAgeSeconds'),
+                                               score=score)
+        cap = max_trigger_concurrency(instance_class)
+        if cap is not None and new_flow_rate > cap:
+            logger.info(f"Capping flow rate {new_flow_rate} at {cap} to fit the writer's max_connections")
+            new_flow_rate = max(cap, FLOW_RATE_FLOOR)
+    history = (cached or {}).get('history', [])
+    if new_flow_rate == flow_rate:
+        logger.info(f"The flow rate is already at {flow_rate} so no change made.")
+        if cached is None:
+            put_state(FLOW_RATE_STATE, {'flowRate': flow_rate, 'history': history}, version,
+                      FLOW_RATE_STATE_TTL_SECONDS)
+        return
+    now = time.time()
+    action = 'decrease' if flow_rate is None or new_flow_rate < flow_rate else 'increase'
+    dwell = FLOW_INCREASE_DWELL_SECONDS if action == 'increase' else 0
+    if score is not None and score >= FLOW_HEALTH_RECOVER:
+        dwell = 0
+    reason = suppression_reason(history, action, FLOW_COOLDOWN_SECONDS, dwell, now)
+    if reason is not None:
+        logger.info(f"Suppressing flow rate {action} from {flow_rate} to {new_flow_rate}: {reason}")
+        return
+    # Claim the change before making it, so of two breakers racing from the same version only one adjusts.
+    value = {'flowRate': new_flow_rate, 'history': append_action(history, action, now)}
+    if not put_state(FLOW_RATE_STATE, value, version, FLOW_RATE_STATE_TTL_SECONDS):
+        logger.info(f"Another circuit breaker invocation changed the flow rate first so no change made.")
+        return
+    logger.info(f"Adjusting flow rate from {flow_rate} to {new_flow_rate}")
+    try:
+        adjust_flow_rate(new_flow_rate)
+    except Exception:
+        clear_state(FLOW_RATE_STATE)
+        raise
+
+
+def next_flow_rate(flow_rate, in_alarm, error_rate=None, threshold=None, floor=FLOW_RATE_FLOOR,
+                   ceiling=FLOW_RATE_CEILING, step=FLOW_RATE_STEP, decrease=FLOW_RATE_DECREASE):
+    """
+    One AIMD step of the circuit breaker.  Also used by the resize policy simulator.
+
+    :param flow_rate: the trigger's reserved concurrency now.  Anything outside floor..ceiling, including None for
+        no reserved concurrency, is treated as the nearest bound.
+    :param in_alarm: True if the error handler alarm is in ALARM
+    :param error_rate: the error handler's most recent datapoint, if known
+    :param threshold: the alarm threshold, if known
+    :return: the reserved concurrency to set
+    """
+    flow_rate = ceiling if flow_rate is None else min(max(int(flow_rate), floor), ceiling)
+    if not in_alarm:
+        return min(flow_rate + step, ceiling)
+    factor = decrease
+    if error_rate and threshold:
+        factor = min(factor, threshold / error_rate)
+    return max(min(math.floor(flow_rate * factor), flow_rate - 1), floor)
+
+
+def health_score(signals, max_connections=None):
+    """
+    How much headroom the capture pipeline has, from get_flow_signals.  A missing signal counts as no pressure.
+
+    :param signals: dict with any of cpu, connections, errors, throttles and deadLetters
+    :param max_connections: the writer's max_connections, if known; connections are ignored without it
+    :return: 1 minus the largest signal as a share of its limit, so 1 is idle and 0 or less is saturated
+    """
+    limits = {
+        'cpu': FLOW_CPU_SATURATED,
+        'connections': max_connections * HEALTH_CONNECTION_SHARE if max_connections else None,
+        'errors': HEALTH_ERROR_INVOCATIONS,
+        'throttles': HEALTH_THROTTLES,
+        'deadLetters': HEALTH_DEAD_LETTERS
+    }
+    pressures = [signals[name] / limit for name, limit in limits.items()
+                 if limit and signals.get(name) is not None]
+    return 1 - max(pressures, default=0)
+
+
+def next_backlog_flow_rate(flow_rate, messages=None, oldest_age_seconds=None, score=None, signals=None,
+                           floor=FLOW_RATE_FLOOR, ceiling=FLOW_RATE_CEILING, step=FLOW_RATE_STEP,
+                           backlog_step=FLOW_RATE_BACKLOG_STEP, decrease=FLOW_RATE_DECREASE):
+    """
+    The circuit breaker's step while the error handler alarm is OK: clear a backlog as fast as the capture pipeline
+    can take it.  A missing signal counts as no backlog.  Also used by the resize policy simulator.
+
+    :param flow_rate: the trigger's reserved concurrency now
+    :param messages: visible messages on the trigger queue
+    :param oldest_age_seconds: age of the oldest message on the trigger queue
+    :param score: the health score, or None to work it out from signals
+    :param signals: dict for health_score, used when score is None; None counts as no pressure
+    :param backlog_step: the step while there is a backlog, instead of step
+    :return: the reserved concurrency to set
+    """
+    if score is None:
+        score = health_score(signals or {})
+    if score <= 0:
+        return next_flow_rate(flow_rate, True, floor=floor, ceiling=ceiling, decrease=decrease)
+    if score <= FLOW_HEALTH_HOLD:
+        return next_flow_rate(flow_rate, False, floor=floor, ceiling=ceiling, step=0)
+    backlog = (messages or 0) >= FLOW_BACKLOG_MESSAGES or (oldest_age_seconds or 0) >= FLOW_BACKLOG_AGE_SECONDS
+    return next_flow_rate(flow_rate, False, floor=floor, ceiling=ceiling, step=backlog_step if backlog else step)
+
+
+def _parse_alarm_reason_data(reason_data):
+    """
+    :param reason_data: the JSON reasonData of a CloudWatch alarm state
+    :return: (largest recent datapoint, threshold), or (None, None) when they are not there
+    """
+    try:
+        reason = json.loads(reason_data)
+        return max(reason['recentDatapoints']), reason['threshold']
+    except (TypeError, ValueError, KeyError):
+        return None, None
 
 
 def adjust_flow_rate(new_flow_rate):
-    if new_flow_rate is None or new_flow_rate < 0 or new_flow_rate > 10:
-        raise Exception(f"flow rate must be between 0 and 10")
-    client = boto3.client('lambda', os.getenv('AWS_DEPLOYMENT_REGION'))
+    if new_flow_rate is None or new_flow_rate < FLOW_RATE_FLOOR or new_flow_rate > FLOW_RATE_CEILING:
+        raise Exception(f"flow rate must be between {FLOW_RATE_FLOOR} and {FLOW_RATE_CEILING}")
+    client = get_client('lambda')
     response = client.put_function_concurrency(
         FunctionName=TRIGGER[STAGE][0],
         ReservedConcurrentExecutions=new_flow_rate
@@ -191,15 +350,15 @@ def adjust_flow_rate(new_flow_rate):
 
 
 def get_flow_rate():
-    client = boto3.client('lambda', os.getenv('AWS_DEPLOYMENT_REGION'))
+    client = get_client('lambda')
     response = client.get_function_concurrency(
         FunctionName=TRIGGER[STAGE][0]
     )
-    flow_rate = response['ReservedConcurrentExecutions']
+    flow_rate = response.get('ReservedConcurrentExecutions')
     return flow_rate
 
 
-def run_etl_query(rds=None):
+def run_etl_query(rds=None, context=None):
     """
     If we look in the batch_job_executions table and something is in a state other than COMPLETED or FAILED,
     assume an ETL is in progress and don't shut the db down.
@@ -207,18 +366,28 @@ def run_etl_query(rds=None):
     Also, if someone aborts an ETL job in Jenkins, we can get in a messed up state where a job execution has
     STARTED but never fails or completes, so check the start time and if it's more than 4 days ignore those and
     shut the db down anyway.
+
+    The connection is kept for the next invocation in a warm container.  The query is cancelled after
+    ETL_QUERY_TIMEOUT_SECONDS, or before the invocation runs out of time, and then the db is treated as busy.
     """
     if rds is None:
-        rds = RDS(os.getenv('DB_HOST'), os.getenv('DB_USER'), os.getenv('DB_NAME'), os.getenv('DB_PASSWORD'))
-    result = rds.execute_sql(OBSERVATIONS_ETL_IN_PROGRESS_SQL, (etl_start,))
-    if result[0] > 0:
-        logger.debug(f"Cannot shutdown down observations db because {result[0]} processes are running")
+        rds = RDS(os.getenv('DB_HOST'), os.getenv('DB_USER'), os.getenv('DB_NAME'), os.getenv('DB_PASSWORD'),
+                  reuse=True)
+    # Worked out on every call, since a warm container can outlive the day it was started on.
+    etl_start = _get_etl_start()
+    try:
+        result = rds.execute_sql(OBSERVATIONS_ETL_IN_PROGRESS_SQL, (etl_start,),
+                                 timeout_seconds=ETL_QUERY_TIMEOUT_SECONDS, context=context)
+    except QueryTimeoutError as e:
+        logger.warning(f"Cannot tell whether an ETL is running, so not shutting down the observations db: {e}")
         return False
-    elif result[0] == 0:
-        logger.debug("Shutting down observations db because no processes are running")
-        return True
-    else:
+    if result is None:
         raise Exception(f"something wrong with db result {result}")
+    if result[0]:
+        logger.debug(f"Cannot shutdown down observations db because an ETL updated since {etl_start} is running")
+        return False
+    logger.debug("Shutting down observations db because no processes are running")
+    return True
 
 
 def _start_db(db, triggers, queue_name):
@@ -227,38 +396,31 @@ def _start_db(db, triggers, queue_name):
     development is further along, we'd like to see these tiers coping with a more production-like backlog.
     """
     # purge_queue(queue_name)
-    cluster_identifiers = describe_db_clusters("start")
     started = False
-    for cluster_identifier in cluster_identifiers:
-        if cluster_identifier == db:
-            start_db_cluster(db)
-            started = True
-            enable_lambda_trigger(triggers)
+    if get_db_cluster_status(db) not in (None, 'available'):
+        start_db_cluster(db)
+        started = True
+        warm_up_lambda_trigger(triggers, db)
+        enable_lambda_trigger(triggers)
     return started
 
 
 def _stop_db(db, triggers):
-    cluster_identifiers = describe_db_clusters("stop")
     stopped = False
     disable_lambda_trigger(triggers)
-    for cluster_identifier in cluster_identifiers:
-        if cluster_identifier == db:
-            stop_db_cluster(db)
-            stopped = True
+    if get_db_cluster_status(db) == 'available':
+        stop_db_cluster(db)
+        stopped = True
     return stopped
 
 
 def troubleshoot(event, context):
     if event['action'].lower() == 'start_capture_db':
-        cluster_identifiers = describe_db_clusters("start")
-        for cluster_identifier in cluster_identifiers:
-            if cluster_identifier == DB[STAGE]:
-                start_db_cluster(DB[STAGE])
+        if get_db_cluster_status(DB[STAGE]) not in (None, 'available'):
+            start_db_cluster(DB[STAGE])
     elif event['action'].lower() == 'stop_capture_db':
-        cluster_identifiers = describe_db_clusters("stop")
-        for cluster_identifier in cluster_identifiers:
-            if cluster_identifier == DB[STAGE]:
-                stop_db_cluster(DB[STAGE])
+        if get_db_cluster_status(DB[STAGE]) == 'available':
+            stop_db_cluster(DB[STAGE])
     elif event['action'].lower() == 'make_kms_key':
         _make_kms_key(event)
     elif event['action'].lower() == 'change_secret_kms_key':
@@ -267,10 +429,11 @@ def troubleshoot(event, context):
         _change_kms_key_policy(event)
     elif event['action'].lower() == 'change_flow_rate':
         adjust_flow_rate(event['flow_rate'])
+        clear_state(FLOW_RATE_STATE)
     # TODO remove
     elif event['action'].lower() == 'delete_stack':
         stack = event['stack']
-        client = boto3.client('cloudformation', "us-west-2")
+        client = get_client('cloudformation', 'us-west-2')
         response = client.delete_stack(
             StackName=stack,
         )
@@ -283,12 +446,12 @@ def troubleshoot(event, context):
     elif event['action'].lower() == 'delete_fargate_security_group':
         # When you need to delete a security group, modify the code
         # here and specify the group id.  Don't check into master
-        client = boto3.client('ec2', os.getenv('AWS_DEPLOYMENT_REGION'))
+        client = get_client('ec2')
         client.delete_security_group(GroupId='sg-xxxxxxxxxxxxxxxxx')
     elif event['action'].lower() == 'delete_access_point':
         # When you need to delete an efs access point, modify the code
         # here and specify the access point id.  Don't check into master
-        client = boto3.client('efs', os.getenv('AWS_DEPLOYMENT_REGION'))
+        client = get_client('efs')
         client.delete_access_point(AccessPointId='fsap-xxxxxxxxxxxxxxxxx')
     elif event['action'].lower() == 'copy_dev_snapshot':
         shared_arn = event['shared_arn']
@@ -398,7 +561,7 @@ def _change_kms_key_policy(event):
     }
     policy = json.dumps(policy)
 
-    client = boto3.client('kms', os.getenv('AWS_DEPLOYMENT_REGION'))
+    client = get_client('kms')
     response = client.put_key_policy(
         KeyId=key_id,
         PolicyName='default',
@@ -417,7 +580,7 @@ def _change_secret_kms_key(event):
 
 
 def _make_efs_access_point(event):
-    client = boto3.client('efs', os.getenv('AWS_DEPLOYMENT_REGION'))
+    client = get_client('efs')
     file_system_id = event['file_system_id']
     response = client.create_access_point(
         ClientToken='iow-geoserver-test',
@@ -451,7 +614,7 @@ def _make_efs_access_point(event):
 
 
 def _make_fargate_security_group(event):
-    client = boto3.client('ec2', os.getenv('AWS_DEPLOYMENT_REGION'))
+    client = get_client('ec2')
     description = event['description']
     group_name = event['group_name']
     vpc_id = event['vpc_id']
@@ -482,7 +645,7 @@ def _make_fargate_security_group(event):
 def _make_kms_key(event):
     key_project = event['key_project'].upper()
     key_stage = event['key_stage'].upper()
-    client = boto3.client('kms', os.getenv('AWS_DEPLOYMENT_REGION'))
+    client = get_client('kms')
     try:
         response = client.create_key(
             Description=f'IOW {key_project} {key_stage} key',
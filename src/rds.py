@@ -1,5 +1,10 @@
+import random
+import threading
+import time
+
 from psycopg2 import connect
-from psycopg2 import OperationalError, DataError, IntegrityError
+from psycopg2 import OperationalError, DataError, IntegrityError, InterfaceError, DatabaseError
+from psycopg2.extensions import QueryCanceledError
 
 # allows for logging information
 import logging
@@ -7,29 +12,182 @@ import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+"""
+Connections opened with reuse=True are kept here, keyed by their connection parameters, so a warm Lambda container
+skips the connect (and its TLS handshake and authentication) on the next invocation.  A cached connection is checked
+with a SELECT 1 before it is handed out, since the database may have been stopped, failed over or resized since.
+"""
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+# Opt-in connect retries, for a database that was just restored or started: each attempt gets a short connect
+# timeout, and attempts are spaced by exponential backoff with full jitter until the caller's budget runs out.
+CONNECT_RETRY_ATTEMPT_TIMEOUT_SECONDS = 5
+CONNECT_RETRY_INITIAL_DELAY_SECONDS = 1
+CONNECT_RETRY_MAX_DELAY_SECONDS = 8
+# OperationalError messages from libpq that mean the database is not up yet, rather than that we cannot log in.
+TRANSIENT_CONNECT_ERRORS = (
+    'could not translate host name',
+    'connection refused',
+    'the database system is starting up',
+    'the database system is shutting down',
+    'timeout expired',
+    'no route to host',
+    'server closed the connection unexpectedly'
+)
+
+# TCP keepalives, so a connection to a database that went away (stopped, failed over, or a dropped NAT mapping) is
+# noticed in about a minute instead of hanging until the Lambda times out.
+KEEPALIVES_IDLE_SECONDS = 30
+KEEPALIVES_INTERVAL_SECONDS = 10
+KEEPALIVES_COUNT = 3
+# Given a Lambda context, a query's statement_timeout is the invocation's remaining time less this margin, so there
+# is time left to report the timeout.  The query is also cancelled from the client CANCEL_GRACE_SECONDS after that,
+# in case the server has not stopped it.
+REMAINING_TIME_MARGIN_SECONDS = 5
+CANCEL_GRACE_SECONDS = 1
+
+
+class QueryTimeoutError(Exception):
+    """
+    A query ran past its statement timeout or the invocation's remaining time, and was cancelled.
+    """
+    pass
+
+
+def is_transient_connect_error(error):
+    """
+    :return: True if error from connect is worth retrying
+    """
+    message = str(error).lower()
+    return any(x in message for x in TRANSIENT_CONNECT_ERRORS)
+
+
+def _connection_key(connection_parameters):
+    return tuple(sorted(connection_parameters.items()))
+
+
+def _is_alive(conn):
+    """
+    :return: True if conn is open and the server still answers on it
+    """
+    if conn.closed:
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute('select 1')
+        cursor.fetchone()
+        cursor.close()
+        return True
+    except (OperationalError, InterfaceError) as e:
+        logger.info(f'Cached connection is dead, reconnecting: {repr(e)}')
+        return False
+
+
+def clear_connections():
+    """
+    Close and forget every cached connection.
+    """
+    with _connections_lock:
+        for conn in _connections.values():
+            try:
+                conn.close()
+            except (OperationalError, InterfaceError):
+                pass
+        _connections.clear()
+
 
 class RDS:
 
-    def __init__(self, db_host, db_user, db_name, db_password, connect_timeout=65):
+    def __init__(self, db_host, db_user, db_name, db_password, connect_timeout=65, reuse=False,
+                 connect_retry_seconds=None, statement_timeout_ms=None):
+        """
+        :param reuse: take a live connection with the same parameters from the cache instead of opening one, and
+            leave this one in the cache for the next caller.  disconnect() still closes it.
+        :param connect_retry_seconds: if given, keep retrying a connect that fails with a transient error for up to
+            this long, with CONNECT_RETRY_ATTEMPT_TIMEOUT_SECONDS per attempt instead of connect_timeout
+        :param statement_timeout_ms: if given, the server cancels any statement on this connection that runs longer
+        """
+        if connect_retry_seconds is not None:
+            connect_timeout = min(connect_timeout, CONNECT_RETRY_ATTEMPT_TIMEOUT_SECONDS)
         self.connection_parameters = {
             'host': db_host,
             'database': db_name,
             'user': db_user,
             'password': db_password,
-            'connect_timeout': connect_timeout
+            'connect_timeout': connect_timeout,
             # keyword argument from https://www.postgresql.org/docs/current/libpq-connect.html#LIBPQ-PARAMKEYWORDS
+            'keepalives': 1,
+            'keepalives_idle': KEEPALIVES_IDLE_SECONDS,
+            'keepalives_interval': KEEPALIVES_INTERVAL_SECONDS,
+            'keepalives_count': KEEPALIVES_COUNT
         }
-        logger.info("created RDS instance %s" % self.connection_parameters)
-        self.conn, self.cursor = self._connect()
+        if statement_timeout_ms is not None:
+            self.connection_parameters['options'] = f"-c statement_timeout={int(statement_timeout_ms)}"
+        self.statement_timeout_ms = statement_timeout_ms
+        self.reuse = reuse
+        self.connect_retry_seconds = connect_retry_seconds
+        logger.info("created RDS instance %s" % {**self.connection_parameters, 'password': '********'})
+        self.conn, self.cursor = self._get_connection() if reuse else self._connect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.reuse:
+            self.disconnect()
+        return False
+
+    def _get_connection(self):
+        key = _connection_key(self.connection_parameters)
+        with _connections_lock:
+            conn = _connections.pop(key, None)
+        if conn is not None and _is_alive(conn):
+            logger.debug('Reusing cached database connection')
+            cursor = conn.cursor()
+        else:
+            if conn is not None:
+                conn.close()
+            conn, cursor = self._connect()
+        with _connections_lock:
+            _connections[key] = conn
+        return conn, cursor
 
     def _connect(self):
-        conn = connect(**self.connection_parameters)  # should raise a OperationalError if it can't get a connection
+        conn = self._connect_with_retry()
         # Interestingly, autocommit seemed necessary for create table too.
         conn.autocommit = True
         cursor = conn.cursor()
         return conn, cursor
 
+    def _connect_with_retry(self):
+        if self.connect_retry_seconds is None:
+            return connect(**self.connection_parameters)  # should raise a OperationalError if it can't get a connection
+        deadline = time.monotonic() + self.connect_retry_seconds
+        delay = CONNECT_RETRY_INITIAL_DELAY_SECONDS
+        attempt = 1
+        while True:
+            try:
+                return connect(**self.connection_parameters)
+            except OperationalError as e:
+                if not is_transient_connect_error(e):
+                    raise
+                sleep = random.uniform(0, delay)
+                if time.monotonic() + sleep + self.connection_parameters['connect_timeout'] > deadline:
+                    logger.info(f'Giving up connecting after {attempt} attempts: {repr(e)}')
+                    raise
+                logger.info(f'Connect attempt {attempt} failed, retrying in {sleep:.1f} seconds: {repr(e)}')
+                time.sleep(sleep)
+                delay = min(delay * 2, CONNECT_RETRY_MAX_DELAY_SECONDS)
+                attempt += 1
+
     def disconnect(self):
+        if self.reuse:
+            with _connections_lock:
+                key = _connection_key(self.connection_parameters)
+                if _connections.get(key) is self.conn:
+                    del _connections[key]
         try:
             self.conn.close()
             logger.debug(f'Disconnected from database: {self.conn}.')
@@ -39,13 +197,64 @@ class RDS:
             logger.debug(f'Error closing connection objection: {repr(e)}', exc_info=True)
             raise RuntimeError
 
-    def execute_sql(self, sql, params=()):
+    def execute_sql(self, sql, params=(), timeout_seconds=None, context=None):
+        """
+        :param timeout_seconds: statement timeout for this query, instead of the connection's
+        :param context: the Lambda context; the query is cancelled before the invocation runs out of time
+        :return: the first row, or None if the query failed
+        :raises QueryTimeoutError: if the query was cancelled for running too long
+        """
+        timeout_ms = self._statement_timeout_ms(timeout_seconds, context)
+        # The timeout is set in the same round trip as the query, and set every time because a cached connection
+        # keeps whatever the last caller set.  With no timeout of our own it goes back to the one configured for the
+        # server, role or connection, rather than 0, which would turn that off.
+        if timeout_ms:
+            set_timeout = self.cursor.mogrify('set statement_timeout = %s; ', (timeout_ms,))
+        else:
+            set_timeout = b'set statement_timeout to default; '
+        query = set_timeout + self.cursor.mogrify(sql, params)
+        timer = None
+        if timeout_ms:
+            timer = threading.Timer(timeout_ms / 1000 + CANCEL_GRACE_SECONDS, self.conn.cancel)
+            timer.daemon = True
+            timer.start()
         try:
-            self.cursor.execute(sql, params)
+            self.cursor.execute(query)
             return self.cursor.fetchone()
+        except QueryCanceledError as e:
+            raise QueryTimeoutError(f"Query cancelled after {timeout_ms} ms: {str(e).strip()}") from e
         except (OperationalError, DataError, IntegrityError) as e:
             logger.debug(f'Error during SQL execution: {repr(e)}', exc_info=True)
             self.conn.rollback()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def _statement_timeout_ms(self, timeout_seconds, context):
+        """
+        :return: the tightest of the call's timeout, the invocation's remaining time and the connection's timeout, in
+            milliseconds, or 0 for none
+        """
+        limits = [timeout_seconds * 1000 if timeout_seconds is not None else None, self.statement_timeout_ms]
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            limits.append(context.get_remaining_time_in_millis() - REMAINING_TIME_MARGIN_SECONDS * 1000)
+        limits = [x for x in limits if x is not None]
+        if not limits:
+            return 0
+        # statement_timeout = 0 would turn the timeout off, so an exhausted budget still gets a millisecond.
+        return max(int(min(limits)), 1)
+
+    def execute(self, sql, params=()):
+        """
+        Run one statement on its own and let any error raise, for callers that have to tell a failure from no rows,
+        and for statements like create index concurrently that cannot share a query with execute_sql's timeout.
+        :return: the first row, or None if there is none or the statement returns no rows
+        :raises psycopg2.Error: if the statement fails
+        """
+        self.cursor.execute(sql, params)
+        if self.cursor.description is None:
+            return None
+        return self.cursor.fetchone()
 
     def alter_permissions(self, sql, params=()):
         try:
@@ -53,3 +262,32 @@ class RDS:
         except (OperationalError, DataError, IntegrityError) as e:
             logger.debug(f'Error during SQL execution: {repr(e)}', exc_info=True)
             self.conn.rollback()
+
+    def execute_batch(self, statements):
+        """
+        Run statements in one transaction.  They go to the server as a single multi-statement query, one round trip,
+        which PostgreSQL runs as one transaction.  If that fails, they are run again one at a time, each under a
+        savepoint in one transaction, to find out which failed; the rest are committed.
+        :param statements: list of (sql, params) tuples
+        :return: list with None for each statement that succeeded and the error message for each that failed
+        """
+        if not statements:
+            return []
+        queries = [self.cursor.mogrify(sql, params) for sql, params in statements]
+        try:
+            self.cursor.execute(b'; '.join(queries))
+            return [None] * len(queries)
+        except DatabaseError as e:
+            logger.debug(f'Error during batch execution, retrying one statement at a time: {repr(e)}', exc_info=True)
+            self.conn.rollback()
+        errors = []
+        self.cursor.execute('begin')
+        for query in queries:
+            try:
+                self.cursor.execute(b'savepoint batch; ' + query + b'; release savepoint batch')
+                errors.append(None)
+            except DatabaseError as e:
+                self.cursor.execute('rollback to savepoint batch')
+                errors.append(str(e).strip())
+        self.cursor.execute('commit')
+        return errors
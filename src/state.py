@@ -0,0 +1,232 @@
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+from src.clients import get_client
+
+"""
+Small persisted state records for the ecosystem switch, one DynamoDB item per key.
+
+Each record carries a version number.  put_state only writes if the version has not moved since the caller read it,
+so two invocations racing on the same record cannot both act on it: the loser gets False and should back off.
+Records expire after a TTL, so a value that something else changed behind our back is only trusted for so long.
+DynamoDB's own TTL deletion is lazy, which is why get_state also checks expiresAt itself.
+
+Records can also carry a short action history, which is what holds back flapping: an action is suppressed within
+its cooldown of the same action, and within its dwell time of a different one.
+
+handle_once makes an event handler idempotent.  EventBridge delivers at least once, so each alarm transition is
+claimed with a conditional write before it is acted on, and remembered in memory so a warm container does not have to
+ask again.
+"""
+
+STAGE = os.getenv('STAGE', 'TEST')
+STATE_TABLE = os.getenv('STATE_TABLE', f"aqts-capture-ecosystem-switch-{STAGE}-state")
+
+# The capture trigger's reserved concurrency as the circuit breaker last set it, and its recent changes.
+FLOW_RATE_STATE = 'flow-rate'
+# Recent capture resize state machine executions.
+RESIZE_STATE = 'resize'
+# Actions kept per history, newest last.
+ACTION_HISTORY_LENGTH = 10
+# How long a handled event is remembered.  EventBridge gives up retrying a delivery after 24 hours.
+EVENT_TTL_SECONDS = int(os.getenv('EVENT_TTL_SECONDS', 86400))
+# Most events remembered in memory per container.
+EVENT_CACHE_SIZE = 256
+
+_handled_events = {}
+_handled_events_lock = threading.Lock()
+
+log_level = os.getenv('LOG_LEVEL', logging.ERROR)
+logger = logging.getLogger(__name__)
+logger.setLevel(log_level)
+
+
+def get_state(key):
+    """
+    :return: (value, version).  value is None and version 0 for a record that does not exist; an expired record
+        keeps its version so the next put_state still has to match it.
+    """
+    response = get_client('dynamodb').get_item(TableName=STATE_TABLE, Key={'pk': {'S': key}}, ConsistentRead=True)
+    item = response.get('Item')
+    if item is None:
+        return None, 0
+    version = int(item['version']['N'])
+    if int(item['expiresAt']['N']) <= time.time():
+        return None, version
+    return json.loads(item['value']['S']), version
+
+
+def put_state(key, value, version, ttl_seconds):
+    """
+    Write value if the record is still at version.
+    :param version: the version get_state returned
+    :return: True if written, False if another writer got there first
+    """
+    dynamodb = get_client('dynamodb')
+    condition = 'attribute_not_exists(pk)' if version == 0 else 'version = :version'
+    kwargs = {} if version == 0 else {'ExpressionAttributeValues': {':version': {'N': str(version)}}}
+    try:
+        dynamodb.put_item(
+            TableName=STATE_TABLE,
+            Item={
+                'pk': {'S': key},
+                'version': {'N': str(version + 1)},
+                'value': {'S': json.dumps(value)},
+                'expiresAt': {'N': str(int(time.time() + ttl_seconds))}
+            },
+            ConditionExpression=condition,
+            **kwargs
+        )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        logger.info(f"State {key} moved past version {version}, not written")
+        return False
+    return True
+
+
+def clear_state(key):
+    """
+    Forget a record, for when whatever it caches has been changed some other way.
+    """
+    get_client('dynamodb').delete_item(TableName=STATE_TABLE, Key={'pk': {'S': key}})
+
+
+def suppression_reason(history, action, cooldown_seconds, dwell_seconds, now):
+    """
+    :param history: list of {'action', 'at'} dicts, newest last
+    :param cooldown_seconds: how long after the same action this one is held back
+    :param dwell_seconds: how long after a different action this one is held back
+    :return: why action should not happen now, or None if it may
+    """
+    if not history:
+        return None
+    last = history[-1]
+    elapsed = now - last['at']
+    wait = cooldown_seconds if last['action'] == action else dwell_seconds
+    if elapsed < wait:
+        return f"last action was {last['action']} {elapsed:.0f} seconds ago, {action} waits {wait} seconds"
+    return None
+
+
+def append_action(history, action, now):
+    """
+    :return: a copy of history with action added and only the newest ACTION_HISTORY_LENGTH kept
+    """
+    return (list(history or []) + [{'action': action, 'at': now}])[-ACTION_HISTORY_LENGTH:]
+
+
+def record_action(key, action, cooldown_seconds, dwell_seconds, now=None):
+    """
+    Record action in the history under key, unless it is suppressed or a concurrent invocation records one first.
+    :param now: when the action happens, to hand to forget_action if it then fails
+    :return: True if the caller should go ahead with action
+    """
+    now = time.time() if now is None else now
+    value, version = get_state(key)
+    history = (value or {}).get('history', [])
+    reason = suppression_reason(history, action, cooldown_seconds, dwell_seconds, now)
+    if reason is not None:
+        logger.info(f"Suppressing {action} for {key}: {reason}")
+        return False
+    return put_state(key, {'history': append_action(history, action, now)}, version,
+                     max(cooldown_seconds, dwell_seconds, 1))
+
+
+def forget_action(key, action, now, cooldown_seconds, dwell_seconds):
+    """
+    Take back an action record_action recorded at now, because it did not happen after all, so a retry is not held
+    back by its own failed attempt.  Left alone if anything has been recorded since.
+    :return: True if it was taken back
+    """
+    value, version = get_state(key)
+    history = (value or {}).get('history', [])
+    if not history or history[-1] != {'action': action, 'at': now}:
+        return False
+    return put_state(key, {'history': history[:-1]}, version, max(cooldown_seconds, dwell_seconds, 1))
+
+
+def get_event_key(event):
+    """
+    What identifies an event across deliveries: the alarm and the time of its state change for a CloudWatch alarm
+    event, otherwise the EventBridge event id.
+    :return: the key, or None for an event with neither (a manual invocation), which is always handled
+    """
+    detail = event.get('detail') or {}
+    timestamp = (detail.get('state') or {}).get('timestamp')
+    if detail.get('alarmName') and timestamp:
+        return f"event#{detail['alarmName']}#{timestamp}"
+    if event.get('id'):
+        return f"event#{event['id']}"
+    return None
+
+
+def _remember_event(key, now):
+    with _handled_events_lock:
+        for expired in [x for x, expires_at in _handled_events.items() if expires_at <= now]:
+            del _handled_events[expired]
+        while len(_handled_events) >= EVENT_CACHE_SIZE:
+            del _handled_events[next(iter(_handled_events))]
+        _handled_events[key] = now + EVENT_TTL_SECONDS
+
+
+def _forget_event(key):
+    with _handled_events_lock:
+        _handled_events.pop(key, None)
+
+
+def clear_handled_events():
+    """
+    Forget the events this container has handled, as a cold start would.
+    """
+    with _handled_events_lock:
+        _handled_events.clear()
+
+
+def claim_event(event):
+    """
+    :return: True if the caller is the first to handle event and should go ahead
+    """
+    key = get_event_key(event)
+    if key is None:
+        return True
+    now = time.time()
+    if _handled_events.get(key, 0) > now:
+        logger.info(f"Already handled {key} in this container")
+        return False
+    if not put_state(key, {'handledAt': now}, 0, EVENT_TTL_SECONDS):
+        logger.info(f"Already handled {key}")
+        _remember_event(key, now)
+        return False
+    _remember_event(key, now)
+    return True
+
+
+def release_event(event):
+    """
+    Undo claim_event, so a retried delivery of an event whose handling failed is handled again.
+    """
+    key = get_event_key(event)
+    if key is not None:
+        _forget_event(key)
+        clear_state(key)
+
+
+def handle_once(handler):
+    """
+    Decorator for Lambda handlers that act on EventBridge events: a redelivered event returns None without calling
+    the handler, and an event whose handler raised can be delivered again.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if not claim_event(event):
+            return None
+        try:
+            return handler(event, context)
+        except Exception:
+            release_event(event)
+            raise
+    return wrapper
+
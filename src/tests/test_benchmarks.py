@@ -0,0 +1,27 @@
+import os
+import re
+from unittest import TestCase
+
+from benchmarks.run import run_scenario, load_budgets, check_budget
+from benchmarks.scenarios import build_scenarios
+from src.clients import clear_clients
+
+SERVERLESS_YML = os.path.join(os.path.dirname(__file__), '..', '..', 'serverless.yml')
+
+
+class TestBenchmarks(TestCase):
+
+    def setUp(self):
+        clear_clients()
+
+    def test_every_lambda_has_a_scenario(self):
+        with open(SERVERLESS_YML) as f:
+            handlers = set(re.findall(r'handler: (src\.\S+)', f.read()))
+        covered = {x.handler for x in build_scenarios()}
+        self.assertEqual(handlers - covered, set())
+
+    def test_call_budgets(self):
+        budgets = load_budgets()
+        for scenario in build_scenarios():
+            wall_ms, calls = run_scenario(scenario, 0)
+            self.assertEqual(check_budget(scenario.name, len(calls), wall_ms, budgets, False), [], calls)
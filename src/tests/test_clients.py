@@ -0,0 +1,69 @@
+from unittest import TestCase, mock
+
+from src.clients import get_client, set_client, clear_clients, LazyClient
+
+
+class TestClients(TestCase):
+
+    def setUp(self):
+        clear_clients()
+
+    def tearDown(self):
+        clear_clients()
+
+    @mock.patch.dict('src.clients.os.environ', {'AWS_DEPLOYMENT_REGION': 'us-south-10'})
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_get_client_is_cached(self, mock_boto):
+        first = get_client('rds')
+        second = get_client('rds')
+        assert first is second
+        mock_boto.assert_called_once_with('rds', 'us-south-10')
+
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_get_client_per_service_and_region(self, mock_boto):
+        mock_boto.side_effect = lambda service, region: mock.Mock()
+        rds_west = get_client('rds', 'us-west-2')
+        rds_east = get_client('rds', 'us-east-1')
+        sqs_west = get_client('sqs', 'us-west-2')
+        assert rds_west is not rds_east
+        assert rds_west is not sqs_west
+        self.assertEqual(mock_boto.call_count, 3)
+
+    @mock.patch.dict('src.clients.os.environ', {}, clear=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_get_client_default_region(self, mock_boto):
+        get_client('lambda')
+        mock_boto.assert_called_once_with('lambda', 'us-west-2')
+
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_set_client(self, mock_boto):
+        stub = mock.Mock()
+        set_client('sqs', stub, 'us-west-2')
+        assert get_client('sqs', 'us-west-2') is stub
+        mock_boto.assert_not_called()
+
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_clear_clients(self, mock_boto):
+        get_client('sqs', 'us-west-2')
+        clear_clients()
+        get_client('sqs', 'us-west-2')
+        self.assertEqual(mock_boto.call_count, 2)
+
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_lazy_client_defers_construction(self, mock_boto):
+        stub = mock.Mock()
+        mock_boto.return_value = stub
+        lazy = LazyClient('rds', 'us-west-2')
+        mock_boto.assert_not_called()
+        lazy.describe_db_clusters(DBClusterIdentifier='foo')
+        mock_boto.assert_called_once_with('rds', 'us-west-2')
+        stub.describe_db_clusters.assert_called_once_with(DBClusterIdentifier='foo')
+
+    @mock.patch.dict('src.clients.os.environ', {'STAGE': 'TEST'})
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_handler_import_builds_no_clients(self, mock_boto):
+        import importlib
+        from src import handler, db_resize_handler, db_create_handler
+        for module in (db_resize_handler, db_create_handler, handler):
+            importlib.reload(module)
+        mock_boto.assert_not_called()
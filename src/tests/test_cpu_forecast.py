@@ -0,0 +1,83 @@
+from unittest import TestCase
+
+import numpy as np
+
+from src import cpu_forecast
+
+PERIOD = 300
+DAY = 86400
+# Midnight UTC, so slot numbers are easy to read.
+START = 1600041600
+
+
+def daily_series(days, base=20.0, peak=70.0, peak_start_hour=14, peak_hours=3):
+    """
+    A recorded-looking CPU series: flat at base with a daily plateau at peak.
+    """
+    timestamps = START + np.arange(days * DAY // PERIOD) * PERIOD
+    hours = (timestamps % DAY) / 3600
+    values = np.where((hours >= peak_start_hour) & (hours < peak_start_hour + peak_hours), peak, base)
+    return timestamps, values
+
+
+class TestCpuForecast(TestCase):
+
+    def test_seasonal_profile_short_history(self):
+        timestamps, values = daily_series(1)
+        profile = cpu_forecast.seasonal_profile(timestamps[:100], values[:100], PERIOD)
+        assert profile.shape == (DAY // PERIOD,)
+        assert not profile.any()
+
+    def test_seasonal_profile(self):
+        timestamps, values = daily_series(3)
+        profile = cpu_forecast.seasonal_profile(timestamps, values, PERIOD)
+        peak_slot = 14 * 3600 // PERIOD
+        assert profile[peak_slot] > 40
+        assert profile[0] < 0
+
+    def test_ewma_weights_recent_values(self):
+        assert cpu_forecast.ewma(np.array([0.0] * 20 + [100.0]), 0.5) > 49
+        self.assertAlmostEqual(cpu_forecast.ewma(np.array([10.0] * 5), 0.3), 10.0)
+
+    def test_forecast_follows_trend(self):
+        timestamps = START + np.arange(24) * PERIOD
+        values = np.linspace(10, 56, 24)
+        forecast = cpu_forecast.forecast_cpu(timestamps, values, [timestamps[-1] + 3 * PERIOD], PERIOD)
+        assert forecast[0] > 56
+
+    def test_forecast_predicts_daily_peak(self):
+        timestamps, values = daily_series(7)
+        # Noon on the eighth day, two hours before the peak
+        now = START + 7 * DAY + 12 * 3600
+        history = timestamps < now
+        horizon = [START + 7 * DAY + 15 * 3600]
+        forecast = cpu_forecast.forecast_cpu(timestamps[history], values[history], horizon, PERIOD)
+        assert 60 < forecast[0] <= 100
+
+    def test_decide_not_enough_data(self):
+        result = cpu_forecast.decide([START], [99.0], START, 1800, 50, 10, PERIOD)
+        assert result == {'action': None, 'current': None, 'predictedPeak': None}
+
+    def test_decide_grows_before_the_peak(self):
+        timestamps, values = daily_series(7)
+        now = START + 7 * DAY + 13 * 3600 + 40 * 60
+        history = timestamps < now
+        result = cpu_forecast.decide(timestamps[history], values[history], now, 1800, 50, 10, PERIOD)
+        assert result['action'] == 'grow'
+        assert result['current'] == 20.0
+
+    def test_decide_refuses_to_shrink_before_the_peak(self):
+        timestamps, values = daily_series(7, base=8.0, peak=60.0)
+        now = START + 7 * DAY + 13 * 3600 + 40 * 60
+        history = timestamps < now
+        result = cpu_forecast.decide(timestamps[history], values[history], now, 1800, 50, 10, PERIOD)
+        assert result['action'] == 'grow'
+        result = cpu_forecast.decide(timestamps[history], values[history], now, 1800, 80, 10, PERIOD)
+        assert result['action'] is None
+
+    def test_decide_shrinks_when_quiet(self):
+        timestamps, values = daily_series(7, base=5.0, peak=60.0)
+        now = START + 7 * DAY + 2 * 3600
+        history = timestamps < now
+        result = cpu_forecast.decide(timestamps[history], values[history], now, 1800, 50, 10, PERIOD)
+        assert result['action'] == 'shrink'
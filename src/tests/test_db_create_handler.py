@@ -3,6 +3,8 @@ import os
 import datetime
 from unittest import TestCase, mock
 
+from psycopg2 import OperationalError, sql
+
 from src import db_create_handler
 from src.db_create_handler import _get_observation_snapshot_identifier, _get_date_string
 from src.db_resize_handler import BIG_DB_SIZE
@@ -60,6 +62,18 @@ class TestDbCreateHandler(TestCase):
             DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER,
             SkipFinalSnapshot=True)
 
+    @mock.patch('src.db_create_handler.disable_lambda_trigger', autospec=True)
+    @mock.patch('src.db_create_handler.rds_client')
+    def test_delete_capture_db_after_failover_resize(self, mock_rds, mock_triggers):
+        os.environ['STAGE'] = 'QA'
+        os.environ['CAN_DELETE_DB'] = 'true'
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{'DBClusterMembers': [
+            {'DBInstanceIdentifier': f"{DEFAULT_DB_INSTANCE_IDENTIFIER}-alt", 'IsClusterWriter': True}]}]}
+        db_create_handler.delete_capture_db({}, {})
+        mock_rds.delete_db_instance.assert_called_once_with(
+            DBInstanceIdentifier=f"{DEFAULT_DB_INSTANCE_IDENTIFIER}-alt",
+            SkipFinalSnapshot=True)
+
     @mock.patch('src.db_create_handler.disable_lambda_trigger', autospec=True)
     @mock.patch('src.db_create_handler.rds_client')
     def test_delete_capture_db_invalid_tier(self, mock_rds, mock_triggers):
@@ -221,6 +235,76 @@ class TestDbCreateHandler(TestCase):
         mock_secrets_client.get_secret_value.return_value = mock_secret_payload
         db_create_handler.modify_schema_owner_password({}, {})
         self.assertEqual(mock_sqs_client.purge_queue.call_count, 2)
+        mock_db.assert_called_once_with('address', 'postgres', 'name', 'Password123',
+                                        connect_retry_seconds=db_create_handler.CONNECT_RETRY_SECONDS)
+
+    @mock.patch('src.db_create_handler.RDS', autospec=True)
+    @mock.patch('src.db_create_handler.secrets_client')
+    def test_create_etl_probe_index(self, mock_secrets_client, mock_db):
+        os.environ['STAGE'] = 'TEST'
+        os.environ['CAN_DELETE_DB'] = 'true'
+        mock_secrets_client.get_secret_value.return_value = {'SecretString': json.dumps(
+            {'DATABASE_ADDRESS': 'blah', 'DATABASE_NAME': 'blah', 'POSTGRES_PASSWORD': 'blah'})}
+        rds = mock_db.return_value.__enter__.return_value
+        rds.execute.side_effect = [('wqp', None), None]
+        assert db_create_handler.create_etl_probe_index({}, {}) is True
+        lookup, create = rds.execute.call_args_list
+        assert lookup == mock.call(db_create_handler.BATCH_JOB_EXECUTION_SCHEMA_SQL,
+                                   ('batch_job_execution_in_progress_idx',))
+        statement = create[0][0]
+        assert [x.string for x in statement.seq if isinstance(x, sql.Identifier)] == [
+            'batch_job_execution_in_progress_idx', 'wqp']
+        rds.execute_sql.assert_not_called()
+        rds.alter_permissions.assert_not_called()
+
+        # An invalid index left by a failed build is dropped before building it again
+        rds.execute.reset_mock()
+        rds.execute.side_effect = [('wqp', False), None, None]
+        assert db_create_handler.create_etl_probe_index({}, {}) is True
+        drop, create = [x[0][0] for x in rds.execute.call_args_list[1:]]
+        assert str(drop.seq[0]).startswith("SQL('drop index concurrently")
+        assert [x.string for x in drop.seq if isinstance(x, sql.Identifier)] == [
+            'wqp', 'batch_job_execution_in_progress_idx']
+        assert str(create.seq[0]).startswith("SQL('create index concurrently")
+
+        # A valid index is left alone
+        rds.execute.reset_mock()
+        rds.execute.side_effect = [('wqp', True), None]
+        assert db_create_handler.create_etl_probe_index({}, {}) is True
+        assert rds.execute.call_count == 2
+
+        # A failed build raises
+        rds.execute.side_effect = [('wqp', None), OperationalError('canceling statement due to lock timeout')]
+        with self.assertRaises(OperationalError):
+            db_create_handler.create_etl_probe_index({}, {})
+
+        # So does a failed lookup, instead of passing for a missing table
+        rds.execute.side_effect = [OperationalError('server closed the connection unexpectedly')]
+        with self.assertRaises(OperationalError):
+            db_create_handler.create_etl_probe_index({}, {})
+
+        # Nothing to index yet
+        rds.execute.reset_mock()
+        rds.execute.side_effect = [None]
+        assert db_create_handler.create_etl_probe_index({}, {}) is False
+        assert rds.execute.call_count == 1
+
+    @mock.patch('src.db_create_handler.ETL_PROBE_INDEX', 'false')
+    @mock.patch('src.db_create_handler.RDS', autospec=True)
+    def test_create_etl_probe_index_off(self, mock_db):
+        os.environ['CAN_DELETE_DB'] = 'true'
+        assert db_create_handler.create_etl_probe_index({}, {}) is False
+        mock_db.assert_not_called()
+
+    def test_connect_retry_seconds(self):
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 89000
+        assert db_create_handler._connect_retry_seconds(context) == db_create_handler.CONNECT_RETRY_SECONDS
+        context.get_remaining_time_in_millis.return_value = 30000
+        assert db_create_handler._connect_retry_seconds(context) == 15
+        context.get_remaining_time_in_millis.return_value = 5000
+        assert db_create_handler._connect_retry_seconds(context) == 0
+        assert db_create_handler._connect_retry_seconds({}) == db_create_handler.CONNECT_RETRY_SECONDS
 
     @mock.patch('src.db_create_handler.enable_lambda_trigger', autospec=True)
     @mock.patch('src.db_create_handler.RDS', autospec=True)
@@ -427,8 +511,20 @@ class TestDbCreateHandler(TestCase):
             "SecretString": my_secret_string
         }
         mock_secrets_client.get_secret_value.return_value = mock_secret_payload
+        rds = mock_db.return_value.__enter__.return_value
+        rds.execute_batch.return_value = [None] * 6
         result = db_create_handler.modify_observation_passwords({}, {})
         assert result is True
+        statements = rds.execute_batch.call_args[0][0]
+        assert [x[0] for x in statements] == [f"alter user {role} with password %s" for role, key in
+                                              db_create_handler.OBSERVATION_ROLE_PASSWORDS]
+        assert statements[0][1] == ('Password123',)
+
+        # A failed rotation is an error, so the state machine retries it
+        rds.execute_batch.return_value = [None, 'role "wqp_user" does not exist', None, None, None, None]
+        with self.assertRaises(Exception) as context:
+            db_create_handler.modify_observation_passwords({}, {})
+        assert 'wqp_user' in str(context.exception)
 
     @mock.patch('src.db_create_handler.RDS', autospec=True)
     @mock.patch('src.db_create_handler.secrets_client')
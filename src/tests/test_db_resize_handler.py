@@ -1,7 +1,10 @@
+import json
 import os
 from unittest import TestCase, mock
 
-from src import db_resize_handler
+from benchmarks.fake_aws import FakeAwsBackend
+from src.clients import clear_clients, set_client
+from src import db_resize_handler, state
 from src.db_resize_handler import SMALL_DB_SIZE, BIG_DB_SIZE, DEFAULT_DB_CLUSTER_IDENTIFIER, BIG_OB_DB_SIZE, \
     SMALL_OB_DB_SIZE
 from src.handler import DEFAULT_DB_INSTANCE_IDENTIFIER
@@ -11,16 +14,82 @@ from src.utils import OBSERVATION_INSTANCE_TAGS, CAPTURE_INSTANCE_TAGS
 class TestDbResizeHandler(TestCase):
 
     def setUp(self):
-        pass
+        clear_clients()
 
+    def tearDown(self):
+        clear_clients()
+
+    @mock.patch('src.db_resize_handler.time.time')
+    @mock.patch('src.db_resize_handler.wait_for_lambda_trigger')
     @mock.patch('src.db_resize_handler.disable_lambda_trigger')
-    def test_disable_trigger(self, mock_trigger):
-        db_resize_handler.disable_trigger({}, {})
+    def test_disable_trigger(self, mock_trigger, mock_wait, mock_time):
+        mock_wait.return_value = 4.5
+        mock_time.return_value = 1000.0
+        result = db_resize_handler.disable_trigger({}, {})
         mock_trigger.assert_called_once()
+        mock_wait.assert_called_once_with(db_resize_handler.TRIGGER[db_resize_handler.STAGE], False)
+        assert result == {'triggerSettleSeconds': 4.5, 'triggerDisabledAt': 1000.0}
+
+    @mock.patch('src.db_resize_handler.time.time')
+    @mock.patch('src.db_resize_handler.drain_lambda_trigger')
+    def test_drain_trigger(self, mock_drain, mock_time):
+        mock_drain.return_value = (True, 12.5)
+        mock_time.return_value = 1000.0
+        result = db_resize_handler.drain_trigger({}, {})
+        mock_drain.assert_called_once_with(
+            db_resize_handler.TRIGGER[db_resize_handler.STAGE], db_resize_handler.CAPTURE_TRIGGER_QUEUE)
+        assert result == {'drained': True, 'drainSeconds': 12.5, 'triggerDisabledAt': 1000.0}
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_check_resize_pending(self, mock_rds):
+        mock_rds.describe_db_instances.return_value = {'DBInstances': [{
+            'DBInstanceClass': BIG_DB_SIZE,
+            'DBInstanceStatus': 'available',
+            'PendingModifiedValues': {'DBInstanceClass': SMALL_DB_SIZE}
+        }]}
+        result = db_resize_handler.check_resize({'resize': {'targetClass': SMALL_DB_SIZE}}, {})
+        assert result == {'targetClass': SMALL_DB_SIZE, 'checks': 1, 'ready': False}
+        mock_rds.describe_db_clusters.assert_not_called()
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_check_resize_ready(self, mock_rds):
+        mock_rds.describe_db_instances.return_value = {'DBInstances': [{
+            'DBInstanceClass': SMALL_DB_SIZE,
+            'DBInstanceStatus': 'available',
+            'PendingModifiedValues': {}
+        }]}
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{'Status': 'available'}]}
+        result = db_resize_handler.check_resize(
+            {'resize': {'targetClass': SMALL_DB_SIZE, 'checks': 4, 'ready': False}}, {})
+        assert result == {'targetClass': SMALL_DB_SIZE, 'checks': 5, 'ready': True}
+        mock_rds.describe_db_clusters.assert_called_once_with(DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER)
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_check_resize_cluster_busy(self, mock_rds):
+        mock_rds.describe_db_instances.return_value = {'DBInstances': [{
+            'DBInstanceClass': SMALL_DB_SIZE,
+            'DBInstanceStatus': 'available',
+            'PendingModifiedValues': {}
+        }]}
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{'Status': 'modifying'}]}
+        result = db_resize_handler.check_resize({'resize': {'targetClass': SMALL_DB_SIZE}}, {})
+        assert result['ready'] is False
 
+    @mock.patch('src.db_resize_handler.time.time')
     @mock.patch('src.db_resize_handler.rds_client')
+    @mock.patch('src.db_resize_handler.warm_up_lambda_trigger', mock.Mock())
     @mock.patch('src.db_resize_handler.enable_lambda_trigger')
-    def test_enable_trigger(self, mock_trigger, mock_rds):
+    def test_enable_trigger_records_trigger_off_time(self, mock_trigger, mock_rds, mock_time):
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{'Status': 'available'}]}
+        mock_time.return_value = 1450.0
+        result = db_resize_handler.enable_trigger({'drain': {'triggerDisabledAt': 1000.0}}, {})
+        mock_trigger.assert_called_once()
+        assert result == {'triggerOffSeconds': 450.0}
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    @mock.patch('src.db_resize_handler.warm_up_lambda_trigger')
+    @mock.patch('src.db_resize_handler.enable_lambda_trigger')
+    def test_enable_trigger(self, mock_trigger, mock_warm_up, mock_rds):
         mock_rds.describe_db_clusters.return_value = {
             'DBClusters': [
                 {
@@ -31,11 +100,14 @@ class TestDbResizeHandler(TestCase):
         }
         mock_trigger.return_value = True
         db_resize_handler.enable_trigger({}, {})
+        mock_warm_up.assert_called_once_with(db_resize_handler.TRIGGER[db_resize_handler.STAGE],
+                                             DEFAULT_DB_CLUSTER_IDENTIFIER)
         mock_trigger.assert_called_once()
 
     @mock.patch('src.db_resize_handler.rds_client')
+    @mock.patch('src.db_resize_handler.warm_up_lambda_trigger')
     @mock.patch('src.db_resize_handler.enable_lambda_trigger')
-    def test_enable_trigger_not_ready(self, mock_trigger, mock_rds):
+    def test_enable_trigger_not_ready(self, mock_trigger, mock_warm_up, mock_rds):
         mock_rds.describe_db_clusters.return_value = {
             'DBClusters': [
                 {
@@ -47,6 +119,7 @@ class TestDbResizeHandler(TestCase):
         mock_trigger.return_value = False
         with self.assertRaises(Exception) as context:
             db_resize_handler.enable_trigger({}, {})
+        mock_warm_up.assert_not_called()
         mock_trigger.assert_not_called()
 
     @mock.patch('src.db_resize_handler._get_cpu_utilization')
@@ -64,11 +137,12 @@ class TestDbResizeHandler(TestCase):
             }]}
         mock_rds.describe_db_instances.return_value = {"DBInstances": [{"DBInstanceClass": BIG_DB_SIZE}]}
         mock_cpu_util.return_value = {'MetricDataResults': [{'Values': [0.0]}]}
-        db_resize_handler.shrink_db({}, {})
+        result = db_resize_handler.shrink_db({}, {})
         mock_rds.modify_db_instance.assert_called_once_with(
             DBInstanceIdentifier=DEFAULT_DB_INSTANCE_IDENTIFIER,
-            DBInstanceClass=SMALL_DB_SIZE,
+            DBInstanceClass='db.r5.2xlarge',
             ApplyImmediately=True)
+        assert result == {'targetClass': 'db.r5.2xlarge', 'instance': DEFAULT_DB_INSTANCE_IDENTIFIER}
 
     @mock.patch('src.db_resize_handler._get_cpu_utilization')
     @mock.patch('src.db_resize_handler.rds_client')
@@ -133,7 +207,7 @@ class TestDbResizeHandler(TestCase):
         db_resize_handler.grow_db({}, {})
         mock_rds.modify_db_instance.assert_called_once_with(
             DBInstanceIdentifier=DEFAULT_DB_INSTANCE_IDENTIFIER,
-            DBInstanceClass=BIG_DB_SIZE,
+            DBInstanceClass='db.r5.2xlarge',
             ApplyImmediately=True)
 
     @mock.patch('src.db_resize_handler._get_cpu_utilization')
@@ -172,6 +246,98 @@ class TestDbResizeHandler(TestCase):
             db_resize_handler.grow_db({}, {})
         mock_rds.modify_db_instance.assert_not_called()
 
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_shrink_db_failover_mode(self, mock_rds):
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{
+            'Status': 'available',
+            'DBClusterMembers': [{'DBInstanceIdentifier': DEFAULT_DB_INSTANCE_IDENTIFIER, 'IsClusterWriter': True}]
+        }]}
+        mock_rds.describe_db_instances.return_value = {"DBInstances": [{"DBInstanceClass": BIG_DB_SIZE}]}
+        result = db_resize_handler.shrink_db({'mode': 'failover'}, {})
+        mock_rds.modify_db_instance.assert_not_called()
+        mock_rds.create_db_instance.assert_called_once_with(
+            DBInstanceIdentifier=f"{DEFAULT_DB_INSTANCE_IDENTIFIER}-alt",
+            DBInstanceClass='db.r5.2xlarge',
+            DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER,
+            Engine='aurora-postgresql',
+            PromotionTier=0,
+            Tags=CAPTURE_INSTANCE_TAGS)
+        assert result == {'targetClass': 'db.r5.2xlarge', 'instance': f"{DEFAULT_DB_INSTANCE_IDENTIFIER}-alt",
+                          'oldInstance': DEFAULT_DB_INSTANCE_IDENTIFIER}
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_grow_db_failover_mode_alternates_back(self, mock_rds):
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{
+            'Status': 'available',
+            'DBClusterMembers': [
+                {'DBInstanceIdentifier': f"{DEFAULT_DB_INSTANCE_IDENTIFIER}-alt", 'IsClusterWriter': True}
+            ]
+        }]}
+        mock_rds.describe_db_instances.return_value = {"DBInstances": [{"DBInstanceClass": SMALL_DB_SIZE}]}
+        result = db_resize_handler.grow_db({'mode': 'failover'}, {})
+        mock_rds.describe_db_instances.assert_called_once_with(
+            DBInstanceIdentifier=f"{DEFAULT_DB_INSTANCE_IDENTIFIER}-alt")
+        assert result['instance'] == DEFAULT_DB_INSTANCE_IDENTIFIER
+        assert result['oldInstance'] == f"{DEFAULT_DB_INSTANCE_IDENTIFIER}-alt"
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_failover_db(self, mock_rds):
+        db_resize_handler.failover_db({'resize': {'instance': 'new'}}, {})
+        mock_rds.failover_db_cluster.assert_called_once_with(
+            DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER, TargetDBInstanceIdentifier='new')
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_check_failover(self, mock_rds):
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{
+            'Status': 'available',
+            'DBClusterMembers': [{'DBInstanceIdentifier': 'old', 'IsClusterWriter': True},
+                                 {'DBInstanceIdentifier': 'new', 'IsClusterWriter': False}]
+        }]}
+        event = {'resize': {'instance': 'new', 'oldInstance': 'old'}}
+        assert db_resize_handler.check_failover(event, {}) == {'checks': 1, 'ready': False}
+        mock_rds.describe_db_clusters.return_value['DBClusters'][0]['DBClusterMembers'] = [
+            {'DBInstanceIdentifier': 'old', 'IsClusterWriter': False},
+            {'DBInstanceIdentifier': 'new', 'IsClusterWriter': True}]
+        event['failover'] = {'checks': 1, 'ready': False}
+        assert db_resize_handler.check_failover(event, {}) == {'checks': 2, 'ready': True}
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_delete_old_instance(self, mock_rds):
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{
+            'DBClusterMembers': [{'DBInstanceIdentifier': 'new', 'IsClusterWriter': True}]
+        }]}
+        db_resize_handler.delete_old_instance({'resize': {'instance': 'new', 'oldInstance': 'old'}}, {})
+        mock_rds.delete_db_instance.assert_called_once_with(DBInstanceIdentifier='old')
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_delete_old_instance_still_writer(self, mock_rds):
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{
+            'DBClusterMembers': [{'DBInstanceIdentifier': 'old', 'IsClusterWriter': True}]
+        }]}
+        with self.assertRaises(Exception):
+            db_resize_handler.delete_old_instance({'resize': {'instance': 'new', 'oldInstance': 'old'}}, {})
+        mock_rds.delete_db_instance.assert_not_called()
+
+    def test_next_size(self):
+        sizes = ['db.r5.xlarge', 'db.r5.2xlarge', 'db.r5.4xlarge']
+        assert db_resize_handler._next_size(sizes, 'db.r5.xlarge', 1) == 'db.r5.2xlarge'
+        assert db_resize_handler._next_size(sizes, 'db.r5.2xlarge', -1) == 'db.r5.xlarge'
+        assert db_resize_handler._next_size(sizes, 'db.r5.4xlarge', 1) == 'db.r5.4xlarge'
+        assert db_resize_handler._next_size(sizes, 'db.r5.xlarge', -1) == 'db.r5.xlarge'
+        assert db_resize_handler._next_size(sizes, 'db.r5.12xlarge', -1) == 'db.r5.xlarge'
+        assert db_resize_handler._next_size(sizes, 'db.r5.large', 1) == 'db.r5.4xlarge'
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_grow_db_one_rung_at_a_time(self, mock_rds):
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{'Status': 'available'}]}
+        mock_rds.describe_db_instances.return_value = {"DBInstances": [{"DBInstanceClass": 'db.r5.2xlarge'}]}
+        result = db_resize_handler.grow_db({}, {})
+        mock_rds.modify_db_instance.assert_called_once_with(
+            DBInstanceIdentifier=DEFAULT_DB_INSTANCE_IDENTIFIER,
+            DBInstanceClass=BIG_DB_SIZE,
+            ApplyImmediately=True)
+        assert result['targetClass'] == BIG_DB_SIZE
+
     def test_validate_okay(self):
         os.environ['STAGE'] = 'QA'
         db_resize_handler._validate()
@@ -181,10 +347,12 @@ class TestDbResizeHandler(TestCase):
         with self.assertRaises(KeyError) as context:
             db_resize_handler.execute_grow_machine({}, {})
 
+    @mock.patch('src.db_resize_handler.record_action', mock.Mock(return_value=True))
     @mock.patch('src.db_resize_handler._get_cpu_utilization')
-    @mock.patch('src.db_resize_handler.boto3', autospec=True)
+    @mock.patch('src.clients.boto3', autospec=True)
     def test_execute_grow_machine_alarm_needs_to_grow(self, mock_boto3, mock_cpu_util):
         os.environ['GROW_STATE_MACHINE_ARN'] = 'arn'
+        os.environ['SHRINK_STATE_MACHINE_ARN'] = 'arn'
         os.environ['GROW_THRESHOLD'] = '75'
         os.environ['GROW_EVAL_TIME_IN_SECONDS'] = '300'
         mock_cpu_util.return_value = {'MetricDataResults': [{'Values': [80.0]}]}
@@ -198,7 +366,7 @@ class TestDbResizeHandler(TestCase):
         result = db_resize_handler.execute_grow_machine(alarm_event, {})
         assert result is True
 
-    @mock.patch('src.db_resize_handler.boto3', autospec=True)
+    @mock.patch('src.clients.boto3', autospec=True)
     def test_execute_grow_machine_not_alarm(self, mock_boto3):
         os.environ['GROW_STATE_MACHINE_ARN'] = 'arn'
         alarm_event = {
@@ -215,9 +383,11 @@ class TestDbResizeHandler(TestCase):
         with self.assertRaises(KeyError) as context:
             db_resize_handler.execute_shrink_machine({}, {})
 
+    @mock.patch('src.db_resize_handler.record_action', mock.Mock(return_value=True))
     @mock.patch('src.db_resize_handler._get_cpu_utilization')
-    @mock.patch('src.db_resize_handler.boto3', autospec=True)
+    @mock.patch('src.clients.boto3', autospec=True)
     def test_execute_shrink_machine_alarm_needs_to_shrink(self, mock_boto3, mock_cpu_util):
+        os.environ['GROW_STATE_MACHINE_ARN'] = 'arn'
         os.environ['SHRINK_STATE_MACHINE_ARN'] = 'arn'
         mock_cpu_util.return_value = {'MetricDataResults': [{'Values': [4.0]}]}
         alarm_event = {
@@ -230,7 +400,7 @@ class TestDbResizeHandler(TestCase):
         result = db_resize_handler.execute_shrink_machine(alarm_event, {})
         assert result is True
 
-    @mock.patch('src.db_resize_handler.boto3', autospec=True)
+    @mock.patch('src.clients.boto3', autospec=True)
     def test_execute_shrink_machine_not_alarm(self, mock_boto3):
         os.environ['SHRINK_STATE_MACHINE_ARN'] = 'arn'
         alarm_event = {
@@ -243,6 +413,118 @@ class TestDbResizeHandler(TestCase):
         result = db_resize_handler.execute_shrink_machine(alarm_event, {})
         assert result is False
 
+    @mock.patch('src.db_resize_handler._execute_state_machine')
+    @mock.patch('src.db_resize_handler._get_running_executions')
+    @mock.patch('src.db_resize_handler.record_action')
+    def test_start_resize_machine(self, mock_record, mock_running, mock_execute):
+        os.environ['GROW_STATE_MACHINE_ARN'] = 'grow_arn'
+        os.environ['SHRINK_STATE_MACHINE_ARN'] = 'shrink_arn'
+        mock_record.return_value = True
+        mock_running.return_value = []
+        assert db_resize_handler.start_resize_machine('shrink') is True
+        mock_record.assert_called_once_with('resize', 'shrink', db_resize_handler.RESIZE_COOLDOWN_SECONDS,
+                                            db_resize_handler.RESIZE_DWELL_SECONDS, mock.ANY)
+        mock_execute.assert_called_once_with('shrink_arn', json.dumps({'mode': 'modify'}))
+
+    @mock.patch('src.db_resize_handler._execute_state_machine')
+    @mock.patch('src.db_resize_handler._get_running_executions')
+    @mock.patch('src.db_resize_handler.record_action')
+    def test_start_resize_machine_suppressed(self, mock_record, mock_running, mock_execute):
+        os.environ['GROW_STATE_MACHINE_ARN'] = 'grow_arn'
+        os.environ['SHRINK_STATE_MACHINE_ARN'] = 'shrink_arn'
+        mock_record.return_value = False
+        mock_running.return_value = []
+        alarm_event = {"detail": {"state": {"value": "ALARM"}}}
+        assert db_resize_handler.execute_grow_machine(alarm_event, {}) is False
+        mock_execute.assert_not_called()
+
+    @mock.patch('src.db_resize_handler._execute_state_machine')
+    @mock.patch('src.db_resize_handler.record_action')
+    @mock.patch('src.db_resize_handler.get_client')
+    def test_start_resize_machine_already_running(self, mock_get_client, mock_record, mock_execute):
+        os.environ['GROW_STATE_MACHINE_ARN'] = 'grow_arn'
+        os.environ['SHRINK_STATE_MACHINE_ARN'] = 'shrink_arn'
+        sfn = mock_get_client.return_value
+        sfn.list_executions.return_value = {'executions': [{'executionArn': 'grow_arn:1'}]}
+        assert db_resize_handler.start_resize_machine('grow') is False
+        sfn.list_executions.assert_called_once_with(stateMachineArn='grow_arn', statusFilter='RUNNING')
+        mock_record.assert_not_called()
+        mock_execute.assert_not_called()
+
+    def use_fake_backend(self):
+        os.environ['GROW_STATE_MACHINE_ARN'] = 'grow_arn'
+        os.environ['SHRINK_STATE_MACHINE_ARN'] = 'shrink_arn'
+        backend = FakeAwsBackend()
+        for service_name in ('dynamodb', 'stepfunctions'):
+            set_client(service_name, backend.client(service_name))
+            set_client(service_name, backend.client(service_name), 'us-west-2')
+        return backend
+
+    @mock.patch('src.db_resize_handler.time.time')
+    def test_start_resize_machine_preempts(self, mock_time):
+        backend = self.use_fake_backend()
+        mock_time.return_value = 10000.0
+        assert db_resize_handler.start_resize_machine('shrink') is True
+        # Ten minutes into the shrink, well within the dwell, the grow alarm fires
+        mock_time.return_value = 10600.0
+        assert db_resize_handler.start_resize_machine('grow') is True
+        assert [(x['stateMachineArn'], x['status']) for x in backend.executions] == [
+            ('shrink_arn', 'ABORTED'), ('grow_arn', 'RUNNING')]
+        assert json.loads(backend.executions[1]['input']) == {'mode': 'modify',
+                                                              'preempted': ['shrink_arn:execution-0']}
+
+    @mock.patch('src.db_resize_handler.time.time')
+    def test_start_resize_machine_dwell_after_finished(self, mock_time):
+        backend = self.use_fake_backend()
+        mock_time.return_value = 10000.0
+        assert db_resize_handler.start_resize_machine('shrink') is True
+        backend.executions[0]['status'] = 'SUCCEEDED'
+        # A finished shrink still holds back a grow for the dwell, against a flapping alarm
+        mock_time.return_value = 10600.0
+        assert db_resize_handler.start_resize_machine('grow') is False
+        mock_time.return_value = 10000.0 + db_resize_handler.RESIZE_DWELL_SECONDS
+        assert db_resize_handler.start_resize_machine('grow') is True
+
+    @mock.patch('src.db_resize_handler._execute_state_machine')
+    @mock.patch('src.db_resize_handler._get_running_executions', mock.Mock(return_value=[]))
+    def test_start_resize_machine_failure_is_not_recorded(self, mock_execute):
+        os.environ['GROW_STATE_MACHINE_ARN'] = 'grow_arn'
+        os.environ['SHRINK_STATE_MACHINE_ARN'] = 'shrink_arn'
+        backend = FakeAwsBackend()
+        set_client('dynamodb', backend.client('dynamodb'))
+        mock_execute.side_effect = [Exception('ThrottlingException'), None]
+        with self.assertRaises(Exception):
+            db_resize_handler.start_resize_machine('grow')
+        # The retry is not held back by the cooldown of the grow that never started
+        assert db_resize_handler.start_resize_machine('grow') is True
+        assert mock_execute.call_count == 2
+        history = state.get_state(state.RESIZE_STATE)[0]['history']
+        assert [x['action'] for x in history] == ['grow']
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_grow_db_after_preempted_shrink(self, mock_rds):
+        # A stopped shrink left the writer on its way down to 2xlarge, so grow from there
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{'Status': 'available', 'DBClusterMembers': [
+            {'DBInstanceIdentifier': DEFAULT_DB_INSTANCE_IDENTIFIER, 'IsClusterWriter': True}]}]}
+        mock_rds.describe_db_instances.return_value = {'DBInstances': [{
+            'DBInstanceClass': BIG_DB_SIZE, 'PendingModifiedValues': {'DBInstanceClass': 'db.r5.2xlarge'}}]}
+        result = db_resize_handler.grow_db({}, {})
+        assert result == {'targetClass': BIG_DB_SIZE, 'instance': DEFAULT_DB_INSTANCE_IDENTIFIER}
+        mock_rds.modify_db_instance.assert_called_once_with(
+            DBInstanceIdentifier=DEFAULT_DB_INSTANCE_IDENTIFIER, DBInstanceClass=BIG_DB_SIZE, ApplyImmediately=True)
+
+    @mock.patch('src.db_resize_handler.rds_client')
+    def test_start_resize_failover_reuses_leftover_standby(self, mock_rds):
+        mock_rds.exceptions.DBInstanceAlreadyExistsFault = type('DBInstanceAlreadyExistsFault', (Exception,), {})
+        mock_rds.create_db_instance.side_effect = mock_rds.exceptions.DBInstanceAlreadyExistsFault()
+        result = db_resize_handler._start_resize(DEFAULT_DB_INSTANCE_IDENTIFIER, SMALL_DB_SIZE,
+                                                 db_resize_handler.RESIZE_MODE_FAILOVER)
+        standby = f"{DEFAULT_DB_INSTANCE_IDENTIFIER}{db_resize_handler.RESIZE_STANDBY_SUFFIX}"
+        assert result == {'targetClass': SMALL_DB_SIZE, 'instance': standby,
+                          'oldInstance': DEFAULT_DB_INSTANCE_IDENTIFIER}
+        mock_rds.modify_db_instance.assert_called_once_with(
+            DBInstanceIdentifier=standby, DBInstanceClass=SMALL_DB_SIZE, ApplyImmediately=True)
+
     @mock.patch('src.db_resize_handler.rds_client')
     def test_is_cluster_available_no(self, mock_rds):
         mock_rds.describe_db_clusters.return_value = {
@@ -268,6 +550,7 @@ class TestDbResizeHandler(TestCase):
         }
         result = db_resize_handler._is_cluster_available(DEFAULT_DB_CLUSTER_IDENTIFIER)
         assert result is True
+        mock_rds.describe_db_clusters.assert_called_once_with(DBClusterIdentifier=DEFAULT_DB_CLUSTER_IDENTIFIER)
 
     @mock.patch('src.db_resize_handler.rds_client')
     @mock.patch('src.db_resize_handler.disable_lambda_trigger')
@@ -283,10 +566,20 @@ class TestDbResizeHandler(TestCase):
         mock_utils.return_value = True
         mock_rds.describe_db_instances.return_value = {"DBInstances": [{"DBInstanceClass": BIG_OB_DB_SIZE}]}
         db_resize_handler.shrink_observations_db(alarm_event, {})
+        mock_rds.modify_db_instance.assert_called_once_with(
+            DBInstanceIdentifier='observations-test',
+            DBInstanceClass='db.r5.2xlarge',
+            ApplyImmediately=True)
+
+        # One more shrink reaches the floor
+        mock_rds.modify_db_instance.reset_mock()
+        mock_rds.describe_db_instances.return_value = {"DBInstances": [{"DBInstanceClass": 'db.r5.2xlarge'}]}
+        db_resize_handler.shrink_observations_db(alarm_event, {})
         mock_rds.modify_db_instance.assert_called_once_with(
             DBInstanceIdentifier='observations-test',
             DBInstanceClass=SMALL_OB_DB_SIZE,
             ApplyImmediately=True)
+        assert SMALL_OB_DB_SIZE == 'db.r5.xlarge'
 
     @mock.patch('src.db_resize_handler.rds_client')
     @mock.patch('src.db_resize_handler.disable_lambda_trigger')
@@ -336,7 +629,7 @@ class TestDbResizeHandler(TestCase):
         db_resize_handler.grow_observations_db(alarm_event, {})
         mock_rds.modify_db_instance.assert_called_once_with(
             DBInstanceIdentifier='observations-test',
-            DBInstanceClass=BIG_OB_DB_SIZE,
+            DBInstanceClass='db.r5.2xlarge',
             ApplyImmediately=True)
 
     @mock.patch('src.db_resize_handler.rds_client')
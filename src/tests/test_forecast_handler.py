@@ -0,0 +1,131 @@
+import datetime
+import os
+from unittest import TestCase, mock
+
+from src import forecast_handler
+from src.clients import clear_clients
+from src.db_resize_handler import BIG_DB_SIZE, SMALL_DB_SIZE
+
+
+class TestForecastHandler(TestCase):
+    cluster = {'DBClusters': [{
+        'Status': 'available',
+        'DBClusterMembers': [{'DBInstanceIdentifier': 'writer', 'IsClusterWriter': True}]
+    }]}
+    created = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def instances(self, instance_class):
+        return {'DBInstances': [{'DBInstanceIdentifier': 'writer', 'DBInstanceClass': instance_class,
+                                 'InstanceCreateTime': self.created}]}
+
+    def setUp(self):
+        clear_clients()
+        os.environ['GROW_STATE_MACHINE_ARN'] = 'grow_arn'
+        os.environ['SHRINK_STATE_MACHINE_ARN'] = 'shrink_arn'
+
+    @mock.patch('src.forecast_handler.start_resize_machine')
+    @mock.patch('src.forecast_handler.decide')
+    @mock.patch('src.forecast_handler._get_cpu_utilization')
+    @mock.patch('src.forecast_handler.rds_client')
+    def test_forecast_resize_grow(self, mock_rds, mock_cpu, mock_decide, mock_execute):
+        mock_rds.describe_db_clusters.return_value = self.cluster
+        mock_rds.describe_db_instances.return_value = self.instances(SMALL_DB_SIZE)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        mock_cpu.return_value = {'MetricDataResults': [{'Timestamps': [now], 'Values': [42.0]}]}
+        mock_decide.return_value = {'action': 'grow', 'current': 42.0, 'predictedPeak': 63.0}
+
+        result = forecast_handler.forecast_resize({}, {})
+
+        assert result == {'action': 'grow', 'current': 42.0, 'predictedPeak': 63.0}
+        mock_cpu.assert_called_once_with('writer', 300, 7 * 86400)
+        assert mock_decide.call_args[0][:2] == ([now.timestamp()], [42.0])
+        mock_execute.assert_called_once_with('grow')
+
+    @mock.patch('src.forecast_handler.start_resize_machine')
+    @mock.patch('src.forecast_handler.decide')
+    @mock.patch('src.forecast_handler._get_cpu_utilization')
+    @mock.patch('src.forecast_handler.rds_client')
+    def test_forecast_resize_already_biggest(self, mock_rds, mock_cpu, mock_decide, mock_execute):
+        mock_rds.describe_db_clusters.return_value = self.cluster
+        mock_rds.describe_db_instances.return_value = self.instances(BIG_DB_SIZE)
+        mock_cpu.return_value = {'MetricDataResults': [{'Timestamps': [], 'Values': []}]}
+        mock_decide.return_value = {'action': 'grow', 'current': 80.0, 'predictedPeak': 90.0}
+
+        result = forecast_handler.forecast_resize({}, {})
+
+        assert result['action'] is None
+        mock_execute.assert_not_called()
+
+    @mock.patch('src.forecast_handler.start_resize_machine')
+    @mock.patch('src.forecast_handler.decide')
+    @mock.patch('src.forecast_handler._get_cpu_utilization')
+    @mock.patch('src.forecast_handler.rds_client')
+    def test_forecast_resize_hold(self, mock_rds, mock_cpu, mock_decide, mock_execute):
+        mock_rds.describe_db_clusters.return_value = self.cluster
+        mock_rds.describe_db_instances.return_value = self.instances(SMALL_DB_SIZE)
+        mock_cpu.return_value = {'MetricDataResults': [{'Timestamps': [], 'Values': []}]}
+        mock_decide.return_value = {'action': None, 'current': 30.0, 'predictedPeak': 35.0}
+
+        forecast_handler.forecast_resize({}, {})
+
+        mock_execute.assert_not_called()
+
+    @mock.patch('src.forecast_handler.time.time')
+    @mock.patch('src.forecast_handler.start_resize_machine')
+    @mock.patch('src.forecast_handler.decide')
+    @mock.patch('src.forecast_handler._get_cpu_utilization')
+    @mock.patch('src.forecast_handler.rds_client')
+    def test_forecast_resize_history_since_class_change(self, mock_rds, mock_cpu, mock_decide, mock_execute,
+                                                        mock_time):
+        now = datetime.datetime(2021, 6, 1, 12, tzinfo=datetime.timezone.utc)
+        mock_time.return_value = now.timestamp()
+        mock_rds.describe_db_clusters.return_value = self.cluster
+        mock_rds.describe_db_instances.return_value = self.instances(SMALL_DB_SIZE)
+        mock_rds.describe_events.return_value = {'Events': [
+            {'Message': 'Finished applying modification to DB instance class',
+             'Date': now - datetime.timedelta(hours=2)},
+            {'Message': 'Updated to use DBParameterGroup default.aurora-postgresql11',
+             'Date': now - datetime.timedelta(hours=1)}
+        ]}
+        mock_cpu.return_value = {'MetricDataResults': [{'Timestamps': [], 'Values': []}]}
+        mock_decide.return_value = {'action': None, 'current': 30.0, 'predictedPeak': 35.0}
+
+        forecast_handler.forecast_resize({}, {})
+
+        # CPU percent from before the class change is against a different number of vCPUs
+        mock_cpu.assert_called_once_with('writer', 300, 7200)
+        assert mock_rds.describe_events.call_args[1]['SourceIdentifier'] == 'writer'
+
+        # A writer added by a 'failover' mode resize has no history from before it was created
+        mock_cpu.reset_mock()
+        mock_rds.describe_events.return_value = {'Events': []}
+        self.created = now - datetime.timedelta(hours=3)
+        mock_rds.describe_db_instances.return_value = self.instances(SMALL_DB_SIZE)
+        forecast_handler.forecast_resize({}, {})
+        mock_cpu.assert_called_once_with('writer', 300, 10800)
+
+    @mock.patch('src.forecast_handler.start_resize_machine')
+    @mock.patch('src.forecast_handler.decide')
+    @mock.patch('src.forecast_handler._get_cpu_utilization')
+    @mock.patch('src.forecast_handler.rds_client')
+    def test_forecast_resize_suppressed(self, mock_rds, mock_cpu, mock_decide, mock_execute):
+        mock_rds.describe_db_clusters.return_value = self.cluster
+        mock_rds.describe_db_instances.return_value = self.instances(BIG_DB_SIZE)
+        mock_cpu.return_value = {'MetricDataResults': [{'Timestamps': [], 'Values': []}]}
+        mock_decide.return_value = {'action': 'shrink', 'current': 3.0, 'predictedPeak': 5.0}
+        mock_execute.return_value = False
+
+        result = forecast_handler.forecast_resize({}, {})
+
+        assert result['action'] is None
+        mock_execute.assert_called_once_with('shrink')
+
+    @mock.patch('src.forecast_handler._get_cpu_utilization')
+    @mock.patch('src.forecast_handler.rds_client')
+    def test_forecast_resize_cluster_not_available(self, mock_rds, mock_cpu):
+        mock_rds.describe_db_clusters.return_value = {'DBClusters': [{'Status': 'stopped'}]}
+
+        result = forecast_handler.forecast_resize({}, {})
+
+        assert result['action'] is None
+        mock_cpu.assert_not_called()
@@ -2,8 +2,10 @@ import json
 import os
 from unittest import TestCase, mock
 
+from src.clients import clear_clients
 from src import handler
 from src.db_resize_handler import BIG_DB_SIZE
+from src.rds import QueryTimeoutError
 from src.handler import TRIGGER, STAGES, DB, run_etl_query, DEFAULT_DB_INSTANCE_IDENTIFIER, \
     DEFAULT_DB_CLUSTER_IDENTIFIER
 
@@ -38,17 +40,28 @@ class TestHandler(TestCase):
     }
 
     def setUp(self):
+        clear_clients()
         self.initial_execution_arn = 'arn:aws:states:us-south-10:98877654311:blah:a17h83j-p84321'
         self.state_machine_start_input = {
             'Record': {'eventVersion': '2.1', 'eventSource': 'aws:s3'}
         }
         self.initial_event = {'executionArn': self.initial_execution_arn, 'startInput': self.state_machine_start_input}
         self.context = {'element': 'lithium'}
+        state = mock.patch.multiple('src.handler', get_state=mock.DEFAULT, put_state=mock.DEFAULT,
+                                    clear_state=mock.DEFAULT)
+        self.mock_state = state.start()
+        self.addCleanup(state.stop)
+        self.mock_state['get_state'].return_value = (None, 0)
+        self.mock_state['put_state'].return_value = True
 
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
-    @mock.patch('src.utils.boto3', autospec=True)
+    @mock.patch('src.clients.boto3', autospec=True)
     def test_start_capture_db_nothing_to_start(self, mock_boto):
+        client = mock_boto.client.return_value
         for stage in STAGES:
+            client.describe_db_clusters.return_value = {
+                'DBClusters': [{'DBClusterIdentifier': DB[stage], 'Status': 'available'}]
+            }
             os.environ['STAGE'] = stage
             result = handler.start_capture_db(self.initial_event, self.context)
             assert result['statusCode'] == 200
@@ -60,7 +73,7 @@ class TestHandler(TestCase):
 
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
     @mock.patch('src.handler.disable_lambda_trigger', autospec=True)
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_stop_capture_db_nothing_to_stop(self, mock_boto, mock_disable_lambda_trigger):
         mock_disable_lambda_trigger.return_value = True
 
@@ -112,7 +125,7 @@ class TestHandler(TestCase):
     @mock.patch('src.handler.stop_observations_db_instance')
     @mock.patch('src.handler.disable_lambda_trigger', autospec=True)
     @mock.patch('src.handler.run_etl_query')
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_stop_observations_db_stop_quiet(self, mock_boto, mock_rds, mock_disable_lambda_trigger,
                                              mock_utils_stop_ob):
         mock_disable_lambda_trigger.return_value = True
@@ -130,12 +143,66 @@ class TestHandler(TestCase):
         with self.assertRaises(Exception) as context:
             handler.stop_observations_db(self.initial_event, self.context)
 
+    def test_next_flow_rate(self):
+        assert handler.next_flow_rate(10, True) == 5
+        assert handler.next_flow_rate(5, True) == 2
+        assert handler.next_flow_rate(1, True) == 0
+        assert handler.next_flow_rate(0, True) == 0
+        assert handler.next_flow_rate(0, False) == 2
+        assert handler.next_flow_rate(9, False) == 10
+        assert handler.next_flow_rate(10, False) == 10
+
+    def test_next_flow_rate_tolerates_any_value(self):
+        assert handler.next_flow_rate(7, True) == 3
+        assert handler.next_flow_rate(7, False) == 9
+        assert handler.next_flow_rate(9000, False) == 10
+        assert handler.next_flow_rate(-3, True) == 0
+        assert handler.next_flow_rate(None, True) == 5
+
+    def test_next_flow_rate_scales_decrease_with_error_rate(self):
+        assert handler.next_flow_rate(10, True, error_rate=400, threshold=100) == 2
+        assert handler.next_flow_rate(10, True, error_rate=120, threshold=100) == 5
+        assert handler.next_flow_rate(8, True, floor=2, ceiling=20, decrease=0.5) == 4
+        assert handler.next_flow_rate(3, True, floor=2, ceiling=20, decrease=0.5) == 2
+        assert handler.next_flow_rate(19, False, floor=2, ceiling=20, step=3) == 20
+
+    def test_next_backlog_flow_rate(self):
+        assert handler.next_backlog_flow_rate(4) == 6
+        assert handler.next_backlog_flow_rate(4, messages=10, oldest_age_seconds=30, signals={'cpu': 20.0}) == 6
+        assert handler.next_backlog_flow_rate(4, messages=5000, signals={'cpu': 20.0}) == 9
+        assert handler.next_backlog_flow_rate(4, oldest_age_seconds=3600) == 9
+        assert handler.next_backlog_flow_rate(8, messages=5000, signals={'cpu': 20.0}) == 10
+        assert handler.next_backlog_flow_rate(4, messages=5000, signals={'cpu': 70.0}) == 4
+        assert handler.next_backlog_flow_rate(4, messages=5000, signals={'cpu': 95.0}) == 2
+        assert handler.next_backlog_flow_rate(1, signals={'cpu': 95.0}) == 0
+        dead_letters = {'deadLetters': handler.HEALTH_DEAD_LETTERS}
+        assert handler.next_backlog_flow_rate(4, messages=5000, signals=dead_letters) == 2
+        # A misspelt signal is an error rather than no backlog
+        with self.assertRaises(TypeError):
+            handler.next_backlog_flow_rate(4, oldestAgeSeconds=3600)
+        assert handler.next_backlog_flow_rate(4, score=0.1) == 4
+
+    def test_health_score(self):
+        assert handler.health_score({}) == 1
+        assert handler.health_score({'cpu': None, 'errors': None}) == 1
+        assert handler.health_score({'cpu': handler.FLOW_CPU_SATURATED / 2, 'errors': 0.0}) == 0.5
+        assert handler.health_score({'cpu': 10.0, 'throttles': handler.HEALTH_THROTTLES * 1.5}) == -0.5
+        # Connections only count when max_connections is known
+        assert handler.health_score({'connections': 2000.0}) == 1
+        assert handler.health_score({'connections': 1494.0}, 1660) == 0
+
+    def test_parse_alarm_reason_data(self):
+        reason = json.dumps({'recentDatapoints': [40.0, 250.0], 'threshold': 100.0})
+        assert handler._parse_alarm_reason_data(reason) == (250.0, 100.0)
+        assert handler._parse_alarm_reason_data(None) == (None, None)
+        assert handler._parse_alarm_reason_data('{}') == (None, None)
+        assert handler._parse_alarm_reason_data('not json') == (None, None)
+
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
-    @mock.patch('src.handler.describe_db_clusters')
     @mock.patch('src.handler.get_flow_rate')
     @mock.patch('src.handler.adjust_flow_rate')
     def test_circuit_breaker_ramp_10_to_5(
-            self, mock_adjust, mock_get_flow, mock_describe_db_clusters):
+            self, mock_adjust, mock_get_flow):
 
         # Test where we ramp down from 10
         mock_get_flow.return_value = 10
@@ -147,17 +214,15 @@ class TestHandler(TestCase):
             }
         }
         os.environ['STAGE'] = 'TEST'
-        mock_describe_db_clusters.return_value = DB['TEST']
         handler.circuit_breaker(my_alarm, self.context)
         mock_get_flow.assert_called_once()
         mock_adjust.assert_called_once_with(5)
 
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
-    @mock.patch('src.handler.describe_db_clusters')
     @mock.patch('src.handler.get_flow_rate')
     @mock.patch('src.handler.adjust_flow_rate')
-    def test_circuit_breaker_ramp_5_to_0(
-            self, mock_adjust, mock_get_flow, mock_describe_db_clusters):
+    def test_circuit_breaker_ramp_5_to_2(
+            self, mock_adjust, mock_get_flow):
 
         # Test where we ramp down from 5
         mock_get_flow.return_value = 5
@@ -169,17 +234,15 @@ class TestHandler(TestCase):
             }
         }
         os.environ['STAGE'] = 'TEST'
-        mock_describe_db_clusters.return_value = DB['TEST']
         handler.circuit_breaker(my_alarm, self.context)
         mock_get_flow.assert_called_once()
-        mock_adjust.assert_called_once_with(0)
+        mock_adjust.assert_called_once_with(2)
 
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
-    @mock.patch('src.handler.describe_db_clusters')
     @mock.patch('src.handler.get_flow_rate')
     @mock.patch('src.handler.adjust_flow_rate')
     def test_circuit_breaker_ramp_0_to_0(
-            self, mock_adjust, mock_get_flow, mock_describe_db_clusters):
+            self, mock_adjust, mock_get_flow):
 
         # Test where we ramp down from 0
         mock_get_flow.return_value = 0
@@ -191,17 +254,17 @@ class TestHandler(TestCase):
             }
         }
         os.environ['STAGE'] = 'TEST'
-        mock_describe_db_clusters.return_value = DB['TEST']
         handler.circuit_breaker(my_alarm, self.context)
         mock_get_flow.assert_called_once()
         mock_adjust.assert_not_called()
 
+    @mock.patch('src.handler.get_writer_instance_class', mock.Mock(return_value=None))
+    @mock.patch('src.handler.get_flow_signals', mock.Mock(return_value={}))
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
-    @mock.patch('src.handler.describe_db_clusters')
     @mock.patch('src.handler.get_flow_rate')
     @mock.patch('src.handler.adjust_flow_rate')
-    def test_circuit_breaker_ramp_0_to_5(
-            self, mock_adjust, mock_get_flow, mock_describe_db_clusters):
+    def test_circuit_breaker_ramp_0_to_2(
+            self, mock_adjust, mock_get_flow):
 
         # Test where we ramp from zero
         mock_get_flow.return_value = 0
@@ -213,17 +276,17 @@ class TestHandler(TestCase):
             }
         }
         os.environ['STAGE'] = 'TEST'
-        mock_describe_db_clusters.return_value = DB['TEST']
         handler.circuit_breaker(my_alarm, self.context)
         mock_get_flow.assert_called_once()
-        mock_adjust.assert_called_once_with(5)
+        mock_adjust.assert_called_once_with(2)
 
+    @mock.patch('src.handler.get_writer_instance_class', mock.Mock(return_value=None))
+    @mock.patch('src.handler.get_flow_signals', mock.Mock(return_value={}))
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
-    @mock.patch('src.handler.describe_db_clusters')
     @mock.patch('src.handler.get_flow_rate')
     @mock.patch('src.handler.adjust_flow_rate')
-    def test_circuit_breaker_ramp_5_to_10(
-            self, mock_adjust, mock_get_flow, mock_describe_db_clusters):
+    def test_circuit_breaker_ramp_5_to_7(
+            self, mock_adjust, mock_get_flow):
 
         # Test where we ramp from zero
         mock_get_flow.return_value = 5
@@ -235,17 +298,17 @@ class TestHandler(TestCase):
             }
         }
         os.environ['STAGE'] = 'TEST'
-        mock_describe_db_clusters.return_value = DB['TEST']
         handler.circuit_breaker(my_alarm, self.context)
         mock_get_flow.assert_called_once()
-        mock_adjust.assert_called_once_with(10)
+        mock_adjust.assert_called_once_with(7)
 
+    @mock.patch('src.handler.get_writer_instance_class', mock.Mock(return_value=None))
+    @mock.patch('src.handler.get_flow_signals', mock.Mock(return_value={}))
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
-    @mock.patch('src.handler.describe_db_clusters')
     @mock.patch('src.handler.get_flow_rate')
     @mock.patch('src.handler.adjust_flow_rate')
     def test_circuit_breaker_ramp_10_to_10(
-            self, mock_adjust, mock_get_flow, mock_describe_db_clusters):
+            self, mock_adjust, mock_get_flow):
 
         # Test where we ramp from zero
         mock_get_flow.return_value = 10
@@ -257,17 +320,17 @@ class TestHandler(TestCase):
             }
         }
         os.environ['STAGE'] = 'TEST'
-        mock_describe_db_clusters.return_value = DB['TEST']
         handler.circuit_breaker(my_alarm, self.context)
         mock_get_flow.assert_called_once()
         mock_adjust.assert_not_called()
 
+    @mock.patch('src.handler.get_writer_instance_class', mock.Mock(return_value=None))
+    @mock.patch('src.handler.get_flow_signals', mock.Mock(return_value={}))
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
-    @mock.patch('src.handler.describe_db_clusters')
     @mock.patch('src.handler.get_flow_rate')
     @mock.patch('src.handler.adjust_flow_rate')
     def test_circuit_breaker_ramp_bogus_flow_rate(
-            self, mock_adjust, mock_get_flow, mock_describe_db_clusters):
+            self, mock_adjust, mock_get_flow):
         my_alarm = {
             "detail": {
                 "state": {
@@ -278,15 +341,223 @@ class TestHandler(TestCase):
 
         os.environ['STAGE'] = 'TEST'
         mock_get_flow.return_value = 9000
-        with self.assertRaises(Exception) as context:
-            handler.circuit_breaker(my_alarm, self.context)
+        handler.circuit_breaker(my_alarm, self.context)
+        mock_adjust.assert_called_once_with(10)
+
+    @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.get_flow_rate')
+    @mock.patch('src.handler.adjust_flow_rate')
+    def test_circuit_breaker_uses_error_rate(
+            self, mock_adjust, mock_get_flow):
+        my_alarm = {
+            "detail": {
+                "state": {
+                    "value": "ALARM",
+                    "reasonData": json.dumps({'recentDatapoints': [1000.0], 'threshold': 100.0})
+                }
+            }
+        }
+        os.environ['STAGE'] = 'TEST'
+        mock_get_flow.return_value = 10
+        handler.circuit_breaker(my_alarm, self.context)
+        mock_adjust.assert_called_once_with(1)
+
+    @mock.patch('src.handler.get_writer_instance_class', mock.Mock(return_value=None))
+    @mock.patch('src.handler.get_flow_signals', mock.Mock(return_value={}))
+    @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.get_client')
+    @mock.patch('src.handler.get_flow_rate')
+    @mock.patch('src.handler.adjust_flow_rate')
+    def test_circuit_breaker_scheduled_tick(
+            self, mock_adjust, mock_get_flow, mock_get_client):
+        os.environ['STAGE'] = 'TEST'
+        mock_get_flow.return_value = 4
+        mock_get_client.return_value.describe_alarms.return_value = {
+            'MetricAlarms': [{'StateValue': 'OK', 'StateReasonData': '{}'}]
+        }
+        handler.circuit_breaker({'source': 'aws.events', 'detail': {}}, self.context)
+        mock_get_client.return_value.describe_alarms.assert_called_once_with(
+            AlarmNames=[handler.ERROR_HANDLER_ALARM])
+        mock_adjust.assert_called_once_with(6)
+
+    @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.get_writer_instance_class', mock.Mock(return_value=None))
+    @mock.patch('src.handler.get_flow_signals')
+    @mock.patch('src.handler.get_flow_rate')
+    @mock.patch('src.handler.adjust_flow_rate')
+    def test_circuit_breaker_backlog(
+            self, mock_adjust, mock_get_flow, mock_signals):
+        my_alarm = {"detail": {"state": {"value": "OK"}}}
+        os.environ['STAGE'] = 'TEST'
+        mock_get_flow.return_value = 2
+        mock_signals.return_value = {'messages': 2000.0, 'oldestAgeSeconds': 1200.0, 'cpu': 30.0}
+        handler.circuit_breaker(my_alarm, self.context)
+        mock_signals.assert_called_once_with(handler.CAPTURE_TRIGGER_QUEUE, handler.DEFAULT_DB_CLUSTER_IDENTIFIER,
+                                             handler.TRIGGER['TEST'][0], handler.ERROR_HANDLER_FUNCTION,
+                                             handler.ERROR_QUEUE)
+        mock_adjust.assert_called_once_with(7)
+
+        mock_adjust.reset_mock()
+        mock_get_flow.return_value = 10
+        mock_signals.return_value = {'messages': 2000.0, 'oldestAgeSeconds': 1200.0, 'cpu': 92.0}
+        handler.circuit_breaker(my_alarm, self.context)
+        mock_adjust.assert_called_once_with(5)
+
+    @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.get_writer_instance_class')
+    @mock.patch('src.handler.get_flow_signals')
+    @mock.patch('src.handler.get_flow_rate')
+    @mock.patch('src.handler.adjust_flow_rate')
+    def test_circuit_breaker_connection_cap(
+            self, mock_adjust, mock_get_flow, mock_signals, mock_cap):
+        my_alarm = {"detail": {"state": {"value": "OK"}}}
+        os.environ['STAGE'] = 'TEST'
+        mock_signals.return_value = {'messages': 2000.0, 'oldestAgeSeconds': 1200.0, 'cpu': 30.0}
+        mock_cap.return_value = 'db.r5.large'
+        mock_get_flow.return_value = 2
+        handler.circuit_breaker(my_alarm, self.context)
+        mock_cap.assert_called_once_with(handler.DEFAULT_DB_CLUSTER_IDENTIFIER)
+        mock_adjust.assert_called_once_with(4)
+
+        # A shrink left the flow rate above what the smaller writer can take
+        mock_adjust.reset_mock()
+        mock_get_flow.return_value = 10
+        handler.circuit_breaker(my_alarm, self.context)
+        mock_adjust.assert_called_once_with(4)
+
+    @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.get_writer_instance_class')
+    @mock.patch('src.handler.get_flow_signals')
+    @mock.patch('src.handler.get_flow_rate')
+    @mock.patch('src.handler.adjust_flow_rate')
+    def test_circuit_breaker_alarm_ignores_backlog(
+            self, mock_adjust, mock_get_flow, mock_signals, mock_cap):
+        os.environ['STAGE'] = 'TEST'
+        mock_get_flow.return_value = 10
+        handler.circuit_breaker({"detail": {"state": {"value": "ALARM"}}}, self.context)
+        mock_signals.assert_not_called()
+        mock_cap.assert_not_called()
+        mock_adjust.assert_called_once_with(5)
+
+    @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.get_flow_rate')
+    @mock.patch('src.handler.adjust_flow_rate')
+    @mock.patch('src.handler.time.time', mock.Mock(return_value=5000.0))
+    def test_circuit_breaker_cached_flow_rate(
+            self, mock_adjust, mock_get_flow):
+        os.environ['STAGE'] = 'TEST'
+        self.mock_state['get_state'].return_value = ({'flowRate': 6}, 4)
+        handler.circuit_breaker({"detail": {"state": {"value": "ALARM"}}}, self.context)
+        mock_get_flow.assert_not_called()
+        self.mock_state['put_state'].assert_called_once_with(
+            'flow-rate', {'flowRate': 3, 'history': [{'action': 'decrease', 'at': 5000.0}]}, 4,
+            handler.FLOW_RATE_STATE_TTL_SECONDS)
+        mock_adjust.assert_called_once_with(3)
+
+    @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.get_flow_rate')
+    @mock.patch('src.handler.adjust_flow_rate')
+    def test_circuit_breaker_caches_unchanged_flow_rate(
+            self, mock_adjust, mock_get_flow):
+        os.environ['STAGE'] = 'TEST'
+        mock_get_flow.return_value = 0
+        self.mock_state['get_state'].return_value = (None, 2)
+        handler.circuit_breaker({"detail": {"state": {"value": "ALARM"}}}, self.context)
+        self.mock_state['put_state'].assert_called_once_with(
+            'flow-rate', {'flowRate': 0, 'history': []}, 2, handler.FLOW_RATE_STATE_TTL_SECONDS)
+        mock_adjust.assert_not_called()
+
+        # Nothing to write when the cached value is still good
+        self.mock_state['put_state'].reset_mock()
+        self.mock_state['get_state'].return_value = ({'flowRate': 0}, 3)
+        handler.circuit_breaker({"detail": {"state": {"value": "ALARM"}}}, self.context)
+        self.mock_state['put_state'].assert_not_called()
+
+    @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.time.time', mock.Mock(return_value=5000.0))
+    @mock.patch('src.handler.get_writer_instance_class', mock.Mock(return_value=None))
+    @mock.patch('src.handler.get_flow_signals')
+    @mock.patch('src.handler.get_flow_rate')
+    @mock.patch('src.handler.adjust_flow_rate')
+    def test_circuit_breaker_hysteresis(
+            self, mock_adjust, mock_get_flow, mock_signals):
+        os.environ['STAGE'] = 'TEST'
+        mock_signals.return_value = {'cpu': 50.0}
+        # Back up too soon after a cut
+        history = [{'action': 'decrease', 'at': 4500.0}]
+        self.mock_state['get_state'].return_value = ({'flowRate': 5, 'history': history}, 3)
+        handler.circuit_breaker({"detail": {"state": {"value": "OK"}}}, self.context)
+        self.mock_state['put_state'].assert_not_called()
+        mock_adjust.assert_not_called()
+
+        # A second cut straight after the first
+        history = [{'action': 'decrease', 'at': 4900.0}]
+        self.mock_state['get_state'].return_value = ({'flowRate': 5, 'history': history}, 3)
+        handler.circuit_breaker({"detail": {"state": {"value": "ALARM"}}}, self.context)
+        mock_adjust.assert_not_called()
+
+        # Cuts never wait on an increase
+        history = [{'action': 'increase', 'at': 4990.0}]
+        self.mock_state['get_state'].return_value = ({'flowRate': 5, 'history': history}, 3)
+        handler.circuit_breaker({"detail": {"state": {"value": "ALARM"}}}, self.context)
+        mock_adjust.assert_called_once_with(2)
+
+        # Once the dwell has passed
+        mock_adjust.reset_mock()
+        history = [{'action': 'decrease', 'at': 5000.0 - handler.FLOW_INCREASE_DWELL_SECONDS}]
+        self.mock_state['get_state'].return_value = ({'flowRate': 5, 'history': history}, 3)
+        handler.circuit_breaker({"detail": {"state": {"value": "OK"}}}, self.context)
+        mock_adjust.assert_called_once_with(7)
+
+        # A healthy score does not wait out the dwell
+        mock_adjust.reset_mock()
+        mock_signals.return_value = {'cpu': 10.0, 'errors': 2.0}
+        history = [{'action': 'decrease', 'at': 4500.0}]
+        self.mock_state['get_state'].return_value = ({'flowRate': 5, 'history': history}, 3)
+        handler.circuit_breaker({"detail": {"state": {"value": "OK"}}}, self.context)
+        mock_adjust.assert_called_once_with(7)
+
+    @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.get_writer_instance_class', mock.Mock(return_value=None))
+    @mock.patch('src.handler.get_flow_signals')
+    @mock.patch('src.handler.get_flow_rate')
+    @mock.patch('src.handler.adjust_flow_rate')
+    def test_circuit_breaker_health_score_cuts_before_alarm(
+            self, mock_adjust, mock_get_flow, mock_signals):
+        os.environ['STAGE'] = 'TEST'
+        mock_get_flow.return_value = 8
+        mock_signals.return_value = {'cpu': 40.0, 'throttles': 0.0, 'errors': handler.HEALTH_ERROR_INVOCATIONS * 2}
+        handler.circuit_breaker({"detail": {"state": {"value": "OK"}}}, self.context)
+        mock_adjust.assert_called_once_with(4)
+
+    @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.get_flow_rate')
+    @mock.patch('src.handler.adjust_flow_rate')
+    def test_circuit_breaker_loses_race(
+            self, mock_adjust, mock_get_flow):
+        os.environ['STAGE'] = 'TEST'
+        self.mock_state['get_state'].return_value = ({'flowRate': 10}, 7)
+        self.mock_state['put_state'].return_value = False
+        handler.circuit_breaker({"detail": {"state": {"value": "ALARM"}}}, self.context)
+        mock_adjust.assert_not_called()
+
+    @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.get_flow_rate')
+    @mock.patch('src.handler.adjust_flow_rate')
+    def test_circuit_breaker_adjust_fails(
+            self, mock_adjust, mock_get_flow):
+        os.environ['STAGE'] = 'TEST'
+        mock_get_flow.return_value = 10
+        mock_adjust.side_effect = Exception('throttled')
+        with self.assertRaises(Exception):
+            handler.circuit_breaker({"detail": {"state": {"value": "ALARM"}}}, self.context)
+        self.mock_state['clear_state'].assert_called_once_with('flow-rate')
 
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
-    @mock.patch('src.handler.describe_db_clusters')
     @mock.patch('src.handler.get_flow_rate')
     @mock.patch('src.handler.adjust_flow_rate')
     def test_circuit_breaker_bogus_stage(
-            self, mock_adjust, mock_get_flow, mock_describe_db_clusters):
+            self, mock_adjust, mock_get_flow):
 
         os.environ['STAGE'] = 'UNKNOWN'
         with self.assertRaises(Exception) as context:
@@ -294,7 +565,7 @@ class TestHandler(TestCase):
 
     @mock.patch('src.handler.disable_lambda_trigger', autospec=True)
     @mock.patch('src.handler.run_etl_query')
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_stop_observations_test_db_stop_quiet(self, mock_boto, mock_rds, mock_disable_lambda_trigger):
         mock_disable_lambda_trigger.return_value = True
         mock_client = mock.Mock()
@@ -306,9 +577,10 @@ class TestHandler(TestCase):
         assert result['message'] == 'Stopped the TEST observations db.'
 
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
+    @mock.patch('src.handler.warm_up_lambda_trigger', autospec=True)
     @mock.patch('src.handler.enable_lambda_trigger', autospec=True)
-    @mock.patch('src.utils.boto3.client', autospec=True)
-    def test_start_capture_db_something_to_start(self, mock_boto, mock_enable_lambda_trigger):
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_start_capture_db_something_to_start(self, mock_boto, mock_enable_lambda_trigger, mock_warm_up):
         mock_enable_lambda_trigger.return_value = True
         mock_client = mock.Mock()
         mock_boto.return_value = mock_client
@@ -324,6 +596,7 @@ class TestHandler(TestCase):
             result = handler.start_capture_db(self.initial_event, self.context)
             assert result['statusCode'] == 200
             assert result['message'] == f"Started the {stage} db: True"
+            mock_warm_up.assert_called_with(TRIGGER[stage], DB[stage])
 
         os.environ['STAGE'] = 'UNKNOWN'
         with self.assertRaises(Exception) as context:
@@ -332,22 +605,53 @@ class TestHandler(TestCase):
     @mock.patch('src.rds.RDS')
     def test_run_etl_query(self, mock_rds):
         """
-        So there are 4 ETLs running
+        There are ETLs running
         """
-        mock_rds.execute_sql.return_value = [4]
+        mock_rds.execute_sql.return_value = (True,)
         result = run_etl_query(mock_rds)
         assert result is False
 
         """
         No ETLs running so we can turn off the db
         """
-        mock_rds.execute_sql.return_value = [0]
+        mock_rds.execute_sql.return_value = (False,)
         result = run_etl_query(mock_rds)
         assert result is True
 
+        """
+        The query failed
+        """
+        mock_rds.execute_sql.return_value = None
+        with self.assertRaises(Exception):
+            run_etl_query(mock_rds)
+
+    @mock.patch('src.handler._get_etl_start')
+    @mock.patch('src.rds.RDS')
+    def test_run_etl_query_window_per_call(self, mock_rds, mock_etl_start):
+        """
+        A warm container does not keep the window from the day it started
+        """
+        mock_rds.execute_sql.return_value = (False,)
+        mock_etl_start.side_effect = ['2026-01-01', '2026-01-02']
+        run_etl_query(mock_rds)
+        run_etl_query(mock_rds)
+        assert [x[0][1] for x in mock_rds.execute_sql.call_args_list] == [('2026-01-01',), ('2026-01-02',)]
+
+    @mock.patch('src.handler._get_etl_start', mock.Mock(return_value='2026-01-01'))
+    @mock.patch('src.rds.RDS')
+    def test_run_etl_query_timeout(self, mock_rds):
+        """
+        A probe that cannot finish in time leaves the db running
+        """
+        mock_rds.execute_sql.side_effect = QueryTimeoutError('Query cancelled after 30000 ms')
+        assert run_etl_query(mock_rds, self.context) is False
+        mock_rds.execute_sql.assert_called_once_with(handler.OBSERVATIONS_ETL_IN_PROGRESS_SQL, ('2026-01-01',),
+                                                     timeout_seconds=handler.ETL_QUERY_TIMEOUT_SECONDS,
+                                                     context=self.context)
+
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
     @mock.patch('src.handler.disable_lambda_trigger', autospec=True)
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_stop_capture_db_something_to_stop(self, mock_boto, mock_disable_lambda_trigger):
         mock_disable_lambda_trigger.return_value = True
         mock_client = mock.Mock()
@@ -371,7 +675,7 @@ class TestHandler(TestCase):
         with self.assertRaises(Exception) as context:
             handler.stop_capture_db(self.initial_event, self.context)
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_troubleshoot_stop(self, mock_boto):
         mock_client = mock.Mock()
         my_mock_db_clusters = self.mock_db_clusters
@@ -384,10 +688,10 @@ class TestHandler(TestCase):
         mock_client.start_db_cluster.return_value = {DB[stage]}
         os.environ['STAGE'] = stage
         handler.troubleshoot({"action": "stop_capture_db"}, self.context)
-        mock_client.describe_db_clusters.assert_called_once()
+        mock_client.describe_db_clusters.assert_called_once_with(DBClusterIdentifier='nwcapture-test')
         mock_client.stop_db_cluster.assert_called_once_with(DBClusterIdentifier='nwcapture-test')
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_troubleshoot_start(self, mock_boto):
         mock_client = mock.Mock()
         my_mock_db_clusters = self.mock_db_clusters
@@ -400,7 +704,7 @@ class TestHandler(TestCase):
         mock_client.start_db_cluster.return_value = {DB[stage]}
         os.environ['STAGE'] = stage
         handler.troubleshoot({"action": "start_capture_db"}, self.context)
-        mock_client.describe_db_clusters.assert_called_once()
+        mock_client.describe_db_clusters.assert_called_once_with(DBClusterIdentifier='nwcapture-test')
         mock_client.start_db_cluster.assert_called_once_with(DBClusterIdentifier='nwcapture-test')
 
     @mock.patch('src.handler.rds_client')
@@ -410,7 +714,7 @@ class TestHandler(TestCase):
         with self.assertRaises(Exception) as context:
             handler.troubleshoot({"action": "unknown"}, self.context)
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_make_kms_key(self, mock_boto):
         mock_client = mock.Mock()
         mock_client.create_key.return_value = {
@@ -431,14 +735,14 @@ class TestHandler(TestCase):
             Tags=[{'TagKey': 'wma:organization', 'TagValue': 'IOW'}])
         mock_client.create_alias.assert_called_once_with(AliasName='alias/IOW-WQP-EXTERNAL-TEST', TargetKeyId='12345')
 
-    @mock.patch('src.handler.secrets_client', autospec=True)
+    @mock.patch('src.handler.secrets_client')
     def test_change_secret_kms_key(self, mock_boto):
         handler.troubleshoot(
             {"action": "change_secret_kms_key", "new_kms_key": "my_kms_key_id", "secret_id": "my_secret_id"},
             self.context)
         mock_boto.update_secret.assert_called_once_with(SecretId='my_secret_id', KmsKeyId='my_kms_key_id')
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_change_kms_key_policy(self, mock_boto):
         mock_client = mock.Mock()
         os.environ['ACCOUNT_ID'] = 'my_account_id'
@@ -457,7 +761,7 @@ class TestHandler(TestCase):
             Policy='{"Version": "2012-10-17", "Id": "key-consolepolicy-3", "Statement": [{"Sid": "Enable IAM User Permissions", "Effect": "Allow", "Principal": {"AWS": "arn:aws:iam::my_account_id:root"}, "Action": "kms:*", "Resource": "*"}, {"Sid": "Allow access for Key Administrators", "Effect": "Allow", "Principal": {"AWS": "arn:aws:iam::my_account_id:role/Ec2-Role"}, "Action": ["kms:Create*", "kms:Describe*", "kms:Enable*", "kms:List*", "kms:Put*", "kms:Update*", "kms:Revoke*", "kms:Disable*", "kms:Get*", "kms:Delete*", "kms:TagResource", "kms:UntagResource", "kms:ScheduleKeyDeletion", "kms:CancelKeyDeletion"], "Resource": "*"}, {"Sid": "Allow use of the key", "Effect": "Allow", "Principal": {"AWS": ["arn:aws:iam::my_account_id:role/adfs-developers", "arn:aws:iam::my_account_id:role/adfs-app-operations", "arn:aws:iam::my_account_id:role/Ec2-Role"]}, "Action": ["kms:Encrypt", "kms:Decrypt", "kms:ReEncrypt*", "kms:GenerateDataKey*", "kms:DescribeKey"], "Resource": "*"}, {"Sid": "Allow attachment of persistent resources", "Effect": "Allow", "Principal": {"AWS": "arn:aws:iam::my_account_id:role/Ec2-Role"}, "Action": ["kms:CreateGrant", "kms:ListGrants", "kms:RevokeGrant"], "Resource": "*", "Condition": {"Bool": {"kms:GrantIsForAWSResource": "true"}}}]}'
         )
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_create_efs_access_point(self, mock_boto):
         mock_client = mock.Mock()
         mock_client.create_access_point.return_value = \
@@ -478,7 +782,7 @@ class TestHandler(TestCase):
         )
 
     @mock.patch('src.handler.boto3.resource', autospec=True)
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_create_create_security_group(self, mock_boto, mock_resource):
         os.environ['AWS_DEPLOYMENT_REGION'] = 'us-west-2'
         mock_client = mock.Mock()
@@ -499,7 +803,7 @@ class TestHandler(TestCase):
             Description='test security group', GroupName='my group', VpcId='fsa12345'
         )
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_purge_queue(self, mock_boto):
         os.environ['AWS_DEPLOYMENT_REGION'] = 'us-west-2'
         mock_client = mock.MagicMock()
@@ -513,7 +817,7 @@ class TestHandler(TestCase):
 
         self.assertEqual(mock_client.purge_queue.call_count, 2)
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_adjust_flow_rate(self, mock_boto):
         os.environ['AWS_DEPLOYMENT_REGION'] = 'us-west-2'
         mock_client = mock.MagicMock()
@@ -523,7 +827,7 @@ class TestHandler(TestCase):
         mock_client.put_function_concurrency.assert_called_once_with(
             FunctionName='aqts-capture-trigger-TEST-aqtsCaptureTrigger', ReservedConcurrentExecutions=10)
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_get_flow_rate(self, mock_boto):
         os.environ['AWS_DEPLOYMENT_REGION'] = 'us-west-2'
         mock_client = mock.MagicMock()
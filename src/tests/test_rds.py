@@ -1,7 +1,10 @@
 import unittest
 from unittest import TestCase, mock
 
-from src.rds import RDS
+from psycopg2 import OperationalError, ProgrammingError
+from psycopg2.extensions import QueryCanceledError
+
+from src.rds import RDS, clear_connections, is_transient_connect_error, QueryTimeoutError
 
 
 class TestRDS(TestCase):
@@ -11,6 +14,10 @@ class TestRDS(TestCase):
         self.database = 'some-database'
         self.user = 'some-user'
         self.password = 'some-password'
+        clear_connections()
+
+    def tearDown(self):
+        clear_connections()
 
     @mock.patch('src.rds.connect')
     def test_db_connect(self, mock_connection):
@@ -21,7 +28,11 @@ class TestRDS(TestCase):
             database='some-database',
             user='some-user',
             password='some-password',
-            connect_timeout=65
+            connect_timeout=65,
+            keepalives=1,
+            keepalives_idle=30,
+            keepalives_interval=10,
+            keepalives_count=3
         )
 
     @mock.patch('src.rds.connect')
@@ -33,10 +44,195 @@ class TestRDS(TestCase):
             database='some-database',
             user='some-user',
             password='some-password',
-            connect_timeout=65
+            connect_timeout=65,
+            keepalives=1,
+            keepalives_idle=30,
+            keepalives_interval=10,
+            keepalives_count=3
         )
         rds.disconnect()
 
+    @mock.patch('src.rds.connect')
+    def test_context_manager_disconnects(self, mock_connection):
+        with RDS(self.host, self.user, self.database, self.password) as rds:
+            rds.execute_sql('select 1')
+        mock_connection.return_value.close.assert_called_once()
+
+    @mock.patch('src.rds.connect')
+    def test_reuse_cached_connection(self, mock_connection):
+        conn = mock_connection.return_value
+        conn.closed = 0
+        with RDS(self.host, self.user, self.database, self.password, reuse=True):
+            pass
+        rds = RDS(self.host, self.user, self.database, self.password, reuse=True)
+        mock_connection.assert_called_once()
+        assert rds.conn is conn
+        conn.close.assert_not_called()
+        # A different password is a different connection
+        RDS(self.host, self.user, self.database, 'new-password', reuse=True)
+        assert mock_connection.call_count == 2
+
+    @mock.patch('src.rds.connect')
+    def test_reuse_reconnects_dead_connection(self, mock_connection):
+        dead, fresh = mock.Mock(closed=0), mock.Mock(closed=0)
+        mock_connection.side_effect = [dead, fresh]
+        RDS(self.host, self.user, self.database, self.password, reuse=True)
+        dead.cursor.return_value.execute.side_effect = OperationalError('server closed the connection unexpectedly')
+        rds = RDS(self.host, self.user, self.database, self.password, reuse=True)
+        assert rds.conn is fresh
+        dead.close.assert_called_once()
+
+    @mock.patch('src.rds.connect')
+    def test_reuse_reconnects_closed_connection(self, mock_connection):
+        closed, fresh = mock.Mock(closed=1), mock.Mock(closed=0)
+        mock_connection.side_effect = [closed, fresh]
+        RDS(self.host, self.user, self.database, self.password, reuse=True)
+        rds = RDS(self.host, self.user, self.database, self.password, reuse=True)
+        assert rds.conn is fresh
+        closed.cursor.return_value.execute.assert_not_called()
+
+    @mock.patch('src.rds.connect')
+    def test_disconnect_forgets_cached_connection(self, mock_connection):
+        mock_connection.side_effect = [mock.Mock(closed=0), mock.Mock(closed=0)]
+        RDS(self.host, self.user, self.database, self.password, reuse=True).disconnect()
+        RDS(self.host, self.user, self.database, self.password, reuse=True)
+        assert mock_connection.call_count == 2
+
+    def test_is_transient_connect_error(self):
+        assert is_transient_connect_error(OperationalError(
+            'could not translate host name "some-host" to address: Name or service not known'))
+        assert is_transient_connect_error(OperationalError(
+            'could not connect to server: Connection refused\n\tIs the server running on host "some-host"'))
+        assert is_transient_connect_error(OperationalError('FATAL:  the database system is starting up'))
+        assert not is_transient_connect_error(OperationalError(
+            'FATAL:  password authentication failed for user "postgres"'))
+
+    @mock.patch('src.rds.time.sleep')
+    @mock.patch('src.rds.connect')
+    def test_connect_retry(self, mock_connection, mock_sleep):
+        conn = mock.Mock()
+        mock_connection.side_effect = [OperationalError('could not connect to server: Connection refused'),
+                                       OperationalError('FATAL:  the database system is starting up'), conn]
+        rds = RDS(self.host, self.user, self.database, self.password, connect_retry_seconds=60)
+        assert rds.conn is conn
+        assert mock_connection.call_count == 3
+        assert mock_connection.call_args[1]['connect_timeout'] == 5
+        assert mock_sleep.call_count == 2
+        assert mock_sleep.call_args_list[0][0][0] <= 1
+        assert mock_sleep.call_args_list[1][0][0] <= 2
+
+    @mock.patch('src.rds.time.sleep')
+    @mock.patch('src.rds.connect')
+    def test_connect_retry_not_transient(self, mock_connection, mock_sleep):
+        mock_connection.side_effect = OperationalError('FATAL:  password authentication failed for user "postgres"')
+        with self.assertRaises(OperationalError):
+            RDS(self.host, self.user, self.database, self.password, connect_retry_seconds=60)
+        mock_connection.assert_called_once()
+        mock_sleep.assert_not_called()
+
+    @mock.patch('src.rds.time.sleep')
+    @mock.patch('src.rds.connect')
+    def test_connect_retry_gives_up(self, mock_connection, mock_sleep):
+        mock_connection.side_effect = OperationalError('timeout expired')
+        with self.assertRaises(OperationalError):
+            RDS(self.host, self.user, self.database, self.password, connect_retry_seconds=3)
+        mock_connection.assert_called_once()
+
+    @mock.patch('src.rds.connect')
+    def test_connect_without_retry(self, mock_connection):
+        mock_connection.side_effect = OperationalError('could not connect to server: Connection refused')
+        with self.assertRaises(OperationalError):
+            RDS(self.host, self.user, self.database, self.password)
+        mock_connection.assert_called_once()
+
+    @mock.patch('src.rds.connect')
+    def test_execute(self, mock_connection):
+        cursor = mock_connection.return_value.cursor.return_value
+        cursor.fetchone.return_value = ('public',)
+        rds = RDS(self.host, self.user, self.database, self.password)
+        assert rds.execute('select schemaname from pg_tables where tablename = %s', ('t',)) == ('public',)
+        cursor.execute.assert_called_once_with('select schemaname from pg_tables where tablename = %s', ('t',))
+        # A statement that returns no rows
+        cursor.description = None
+        assert rds.execute('create index concurrently i on t (c)') is None
+        cursor.execute.side_effect = OperationalError('could not create unique index')
+        with self.assertRaises(OperationalError):
+            rds.execute('create index concurrently i on t (c)')
+
+    @mock.patch('src.rds.connect')
+    def test_execute_batch(self, mock_connection):
+        cursor = mock_connection.return_value.cursor.return_value
+        cursor.mogrify.side_effect = lambda sql, params: (sql % params).encode()
+        rds = RDS(self.host, self.user, self.database, self.password)
+        assert rds.execute_batch([('alter user a with password %s', ("'x'",)),
+                                  ('alter user b with password %s', ("'y'",))]) == [None, None]
+        cursor.execute.assert_called_once_with(b"alter user a with password 'x'; alter user b with password 'y'")
+        assert rds.execute_batch([]) == []
+
+    @mock.patch('src.rds.connect')
+    def test_execute_batch_reports_failures(self, mock_connection):
+        cursor = mock_connection.return_value.cursor.return_value
+        cursor.mogrify.side_effect = lambda sql, params: sql.encode()
+
+        def execute(sql, params=None):
+            if isinstance(sql, bytes) and b'alter user b' in sql:
+                raise ProgrammingError('role "b" does not exist')
+        cursor.execute.side_effect = execute
+        rds = RDS(self.host, self.user, self.database, self.password)
+        errors = rds.execute_batch([('alter user a', ()), ('alter user b', ()), ('alter user c', ())])
+        assert errors == [None, 'role "b" does not exist', None]
+        executed = [x[0][0] for x in cursor.execute.call_args_list]
+        assert executed[1] == 'begin'
+        assert executed[-1] == 'commit'
+        assert 'rollback to savepoint batch' in executed
+
+    @mock.patch('src.rds.connect')
+    def test_connection_statement_timeout(self, mock_connection):
+        rds = RDS(self.host, self.user, self.database, self.password, statement_timeout_ms=30000)
+        assert mock_connection.call_args[1]['options'] == '-c statement_timeout=30000'
+        assert rds._statement_timeout_ms(None, None) == 30000
+        assert rds._statement_timeout_ms(10, None) == 10000
+
+    @mock.patch('src.rds.connect')
+    def test_statement_timeout_from_context(self, mock_connection):
+        rds = RDS(self.host, self.user, self.database, self.password)
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 20000
+        assert rds._statement_timeout_ms(None, None) == 0
+        assert rds._statement_timeout_ms(None, context) == 15000
+        assert rds._statement_timeout_ms(10, context) == 10000
+        assert rds._statement_timeout_ms(None, {}) == 0
+        context.get_remaining_time_in_millis.return_value = 2000
+        assert rds._statement_timeout_ms(10, context) == 1
+
+    @mock.patch('src.rds.threading.Timer')
+    @mock.patch('src.rds.connect')
+    def test_execute_sql_sets_timeout(self, mock_connection, mock_timer):
+        cursor = mock_connection.return_value.cursor.return_value
+        cursor.mogrify.side_effect = lambda sql, params: (sql % params).encode()
+        cursor.fetchone.return_value = (0,)
+        rds = RDS(self.host, self.user, self.database, self.password)
+        assert rds.execute_sql('select %s', (1,), timeout_seconds=2) == (0,)
+        cursor.execute.assert_called_once_with(b'set statement_timeout = 2000; select 1')
+        mock_timer.assert_called_once_with(3, mock_connection.return_value.cancel)
+        mock_timer.return_value.cancel.assert_called_once()
+
+        # Without a timeout the configured one is put back, instead of turning it off with 0
+        cursor.execute.reset_mock()
+        mock_timer.reset_mock()
+        rds.execute_sql('select %s', (1,))
+        cursor.execute.assert_called_once_with(b'set statement_timeout to default; select 1')
+        mock_timer.assert_not_called()
+
+    @mock.patch('src.rds.connect')
+    def test_execute_sql_timeout(self, mock_connection):
+        cursor = mock_connection.return_value.cursor.return_value
+        cursor.mogrify.side_effect = lambda sql, params: (sql % params).encode()
+        cursor.execute.side_effect = QueryCanceledError('canceling statement due to statement timeout')
+        rds = RDS(self.host, self.user, self.database, self.password)
+        with self.assertRaises(QueryTimeoutError):
+            rds.execute_sql('select pg_sleep(10)', (), timeout_seconds=0.01)
+
 
 if __name__ == '__main__':
     unittest.main()
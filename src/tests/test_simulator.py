@@ -0,0 +1,129 @@
+import os
+import tempfile
+from unittest import TestCase, mock
+
+import numpy as np
+
+from simulator import replay, run
+
+LADDER = ['db.r5.xlarge', 'db.r5.2xlarge', 'db.r5.4xlarge']
+
+
+def flat(minutes, cpu, errors=0):
+    return replay.Series(cpu=np.full(minutes, float(cpu)), queue_depth=np.arange(minutes, dtype=float),
+                         errors=np.full(minutes, float(errors)))
+
+
+class TestReplay(TestCase):
+
+    def test_vcpus(self):
+        assert replay.vcpus('db.r5.large') == 2
+        assert replay.vcpus('db.r5.xlarge') == 4
+        assert replay.vcpus('db.r5.2xlarge') == 8
+        assert replay.vcpus('db.r5.12xlarge') == 48
+        with self.assertRaises(Exception):
+            replay.vcpus('db.serverless')
+
+    def test_to_periods(self):
+        values = [1, 2, 3, np.nan, np.nan, np.nan, 7]
+        np.testing.assert_array_equal(replay.to_periods(values, 3), [2, 0, 7])
+        np.testing.assert_array_equal(replay.to_periods(values, 3, how='sum'), [6, 0, 7])
+        np.testing.assert_array_equal(replay.to_periods(values, 3, how='max'), [3, 0, 7])
+
+    def test_alarm_states_and_transitions(self):
+        states = replay.alarm_states([1, 1, 0, 1, 1, 1, 0], 2)
+        np.testing.assert_array_equal(states, [False, True, False, False, True, True, False])
+        into_alarm, into_ok = replay.transitions(states)
+        np.testing.assert_array_equal(into_alarm, [1, 4])
+        np.testing.assert_array_equal(into_ok, [2, 6])
+
+    def test_quiet_database_steps_down_the_ladder(self):
+        report = replay.simulate(flat(24 * 60, 1), LADDER, 'db.r5.4xlarge', 'db.r5.4xlarge')
+        assert report['resizes'] == {'grow': 0, 'shrink': 2, 'noop': 1, 'suppressed': 0}
+        assert set(report['instanceHours']) == set(LADDER)
+        assert report['saturatedHours'] == 0
+        # Two resizes at 25 minutes and a no-op at the bottom of the ladder at 5 minutes
+        assert report['triggerOffHours'] == 0.92
+
+    def test_sustained_load_steps_up_and_stays(self):
+        report = replay.simulate(flat(12 * 60, 45), LADDER, 'db.r5.xlarge', 'db.r5.4xlarge')
+        assert report['resizes']['grow'] == 2
+        assert report['resizes']['shrink'] == 0
+        assert report['saturatedHours'] > 0
+        assert max(report['instanceHours'], key=report['instanceHours'].get) == 'db.r5.4xlarge'
+
+    def test_resize_dwell(self):
+        series = flat(6 * 60, 1)
+        series.cpu[:20] = 60
+        report = replay.simulate(series, LADDER, 'db.r5.xlarge', 'db.r5.xlarge')
+        # The low CPU alarm comes up less than an hour after the grow started
+        assert report['resizes'] == {'grow': 1, 'shrink': 0, 'noop': 0, 'suppressed': 1}
+        policy = replay.DEFAULT_POLICY._replace(resize_dwell_minutes=0)
+        report = replay.simulate(series, LADDER, 'db.r5.xlarge', 'db.r5.xlarge', policy)
+        assert report['resizes'] == {'grow': 1, 'shrink': 1, 'noop': 1, 'suppressed': 0}
+
+    def test_circuit_breaker(self):
+        series = flat(60, 30)
+        series.errors[10:25] = 500
+        report = replay.simulate(series, LADDER, 'db.r5.2xlarge', 'db.r5.2xlarge')
+        assert report['circuitBreakerTrips'] == 1
+        # 2500 errors a period against a threshold of 100 cuts straight to 0 for the three periods in ALARM
+        assert report['triggerOffHours'] == 0.25
+        series.errors[10:20] = 500
+        series.errors[20:25] = 0
+        series.errors[25:35] = 500
+        report = replay.simulate(series, LADDER, 'db.r5.2xlarge', 'db.r5.2xlarge')
+        # The alarm clears for one period in between, but the increase dwell keeps the trigger off through it
+        assert report['circuitBreakerTrips'] == 2
+        assert report['triggerOffHours'] == 0.42
+
+    def test_simulate_flow(self):
+        breaker = np.array([False, True, True, True, False, False, False, False, False])
+        errors = np.array([0, 150, 150, 150, 0, 0, 0, 0, 0])
+        # Busy enough that the health score does not let an increase skip the dwell
+        cpu = np.full(9, 30.0)
+        np.testing.assert_array_equal(replay.simulate_flow(breaker, errors, cpu=cpu), [10, 5, 2, 1, 1, 1, 3, 5, 7])
+        policy = replay.DEFAULT_POLICY._replace(flow_floor=1, flow_step=5)
+        np.testing.assert_array_equal(replay.simulate_flow(breaker, errors, policy, cpu=cpu),
+                                      [10, 5, 2, 1, 1, 1, 6, 10, 10])
+        policy = replay.DEFAULT_POLICY._replace(flow_increase_dwell_minutes=0)
+        np.testing.assert_array_equal(replay.simulate_flow(breaker, errors, policy, cpu=cpu),
+                                      [10, 5, 2, 1, 3, 5, 7, 9, 10])
+        # An idle database recovers without waiting out the dwell
+        np.testing.assert_array_equal(replay.simulate_flow(breaker, errors), [10, 5, 2, 1, 3, 5, 7, 9, 10])
+        # A backlog on the queue steps up faster
+        queue_depth = np.full(9, 1000.0)
+        np.testing.assert_array_equal(replay.simulate_flow(breaker, errors, queue_depth=queue_depth, cpu=cpu),
+                                      [10, 5, 2, 1, 1, 1, 6, 10, 10])
+
+    def test_simulate_flow_health_score(self):
+        breaker = np.zeros(6, dtype=bool)
+        errors = np.zeros(6)
+        # Saturated CPU cuts the flow rate before the error handler alarm fires, busy CPU holds it and it climbs again
+        # as soon as the CPU is back down
+        cpu = np.array([20, 90, 90, 70, 70, 20], dtype=float)
+        np.testing.assert_array_equal(replay.simulate_flow(breaker, errors, cpu=cpu), [10, 5, 2, 2, 2, 4])
+        # Error handler invocations below the alarm threshold still count against the score
+        errors = np.array([0, 600, 0, 0, 0, 0], dtype=float)
+        np.testing.assert_array_equal(replay.simulate_flow(breaker, errors), [10, 5, 7, 9, 10, 10])
+
+    def test_policy_is_respected(self):
+        policy = replay.DEFAULT_POLICY._replace(high_threshold=95)
+        report = replay.simulate(flat(12 * 60, 22.5), LADDER, 'db.r5.xlarge', 'db.r5.4xlarge', policy)
+        assert report['resizes']['grow'] == 0
+        report = replay.simulate(flat(12 * 60, 22.5), LADDER, 'db.r5.xlarge', 'db.r5.4xlarge')
+        assert report['resizes']['grow'] == 1
+
+
+class TestRun(TestCase):
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metrics.csv')
+            with open(path, 'w') as f:
+                f.write('timestamp,cpu,queue_depth,errors\n')
+                for minute in range(120):
+                    f.write(f"{minute * 60},{'' if minute == 3 else 5},10,\n")
+            with mock.patch('builtins.print') as mock_print:
+                assert run.main([path, '--recorded-class', 'db.r5.4xlarge', '--low-periods', '3']) == 0
+        assert '"shrink": 2' in mock_print.call_args[0][0]
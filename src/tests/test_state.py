@@ -0,0 +1,148 @@
+import json
+from unittest import TestCase, mock
+
+from src import state
+from src.clients import clear_clients, set_client
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class TestState(TestCase):
+
+    def setUp(self):
+        clear_clients()
+        self.dynamodb = mock.Mock()
+        self.dynamodb.exceptions.ConditionalCheckFailedException = ConditionalCheckFailedException
+        set_client('dynamodb', self.dynamodb)
+        state.clear_handled_events()
+
+    def tearDown(self):
+        clear_clients()
+        state.clear_handled_events()
+
+    def item(self, value, version, expires_at):
+        return {'Item': {'pk': {'S': 'key'}, 'version': {'N': str(version)}, 'value': {'S': json.dumps(value)},
+                         'expiresAt': {'N': str(expires_at)}}}
+
+    @mock.patch('src.state.time.time')
+    def test_get_state(self, mock_time):
+        mock_time.return_value = 1000
+        self.dynamodb.get_item.return_value = self.item({'flowRate': 4}, 3, 1500)
+        assert state.get_state('key') == ({'flowRate': 4}, 3)
+        self.dynamodb.get_item.assert_called_once_with(TableName=state.STATE_TABLE, Key={'pk': {'S': 'key'}},
+                                                       ConsistentRead=True)
+
+    @mock.patch('src.state.time.time')
+    def test_get_state_expired(self, mock_time):
+        mock_time.return_value = 2000
+        self.dynamodb.get_item.return_value = self.item({'flowRate': 4}, 3, 1500)
+        assert state.get_state('key') == (None, 3)
+
+    def test_get_state_missing(self):
+        self.dynamodb.get_item.return_value = {}
+        assert state.get_state('key') == (None, 0)
+
+    @mock.patch('src.state.time.time')
+    def test_put_state(self, mock_time):
+        mock_time.return_value = 1000
+        assert state.put_state('key', {'flowRate': 2}, 3, 60) is True
+        self.dynamodb.put_item.assert_called_once_with(
+            TableName=state.STATE_TABLE,
+            Item={'pk': {'S': 'key'}, 'version': {'N': '4'}, 'value': {'S': '{"flowRate": 2}'},
+                  'expiresAt': {'N': '1060'}},
+            ConditionExpression='version = :version',
+            ExpressionAttributeValues={':version': {'N': '3'}})
+
+    def test_put_state_new(self):
+        assert state.put_state('key', {'flowRate': 2}, 0, 60) is True
+        kwargs = self.dynamodb.put_item.call_args[1]
+        assert kwargs['ConditionExpression'] == 'attribute_not_exists(pk)'
+        assert 'ExpressionAttributeValues' not in kwargs
+
+    def test_put_state_conflict(self):
+        self.dynamodb.put_item.side_effect = ConditionalCheckFailedException()
+        assert state.put_state('key', {'flowRate': 2}, 3, 60) is False
+
+    def test_clear_state(self):
+        state.clear_state('key')
+        self.dynamodb.delete_item.assert_called_once_with(TableName=state.STATE_TABLE, Key={'pk': {'S': 'key'}})
+
+    def test_suppression_reason(self):
+        history = [{'action': 'grow', 'at': 100.0}, {'action': 'shrink', 'at': 1000.0}]
+        assert state.suppression_reason([], 'grow', 60, 600, 1010.0) is None
+        assert state.suppression_reason(history, 'shrink', 60, 600, 1030.0) is not None
+        assert state.suppression_reason(history, 'shrink', 60, 600, 1060.0) is None
+        assert state.suppression_reason(history, 'grow', 60, 600, 1300.0) is not None
+        assert state.suppression_reason(history, 'grow', 60, 600, 1600.0) is None
+
+    def test_append_action(self):
+        history = [{'action': 'grow', 'at': float(x)} for x in range(state.ACTION_HISTORY_LENGTH)]
+        result = state.append_action(history, 'shrink', 99.0)
+        assert len(result) == state.ACTION_HISTORY_LENGTH
+        assert result[0]['at'] == 1.0
+        assert result[-1] == {'action': 'shrink', 'at': 99.0}
+        assert state.append_action(None, 'grow', 1.0) == [{'action': 'grow', 'at': 1.0}]
+
+    @mock.patch('src.state.time.time')
+    def test_record_action(self, mock_time):
+        mock_time.return_value = 1000
+        self.dynamodb.get_item.return_value = self.item({'history': [{'action': 'grow', 'at': 900}]}, 2, 5000)
+        assert state.record_action('key', 'shrink', 60, 600) is False
+        self.dynamodb.put_item.assert_not_called()
+        assert state.record_action('key', 'grow', 60, 600) is True
+        item = self.dynamodb.put_item.call_args[1]['Item']
+        assert json.loads(item['value']['S']) == {
+            'history': [{'action': 'grow', 'at': 900}, {'action': 'grow', 'at': 1000}]}
+        assert item['expiresAt']['N'] == '1600'
+
+    @mock.patch('src.state.time.time')
+    def test_forget_action(self, mock_time):
+        mock_time.return_value = 1000
+        history = [{'action': 'shrink', 'at': 100}, {'action': 'grow', 'at': 900}]
+        self.dynamodb.get_item.return_value = self.item({'history': history}, 2, 5000)
+        assert state.forget_action('key', 'grow', 900, 60, 600) is True
+        item = self.dynamodb.put_item.call_args[1]['Item']
+        assert json.loads(item['value']['S']) == {'history': [{'action': 'shrink', 'at': 100}]}
+        # Something else was recorded since
+        self.dynamodb.put_item.reset_mock()
+        assert state.forget_action('key', 'grow', 800, 60, 600) is False
+        self.dynamodb.put_item.assert_not_called()
+
+    def test_get_event_key(self):
+        alarm = {'id': 'abc', 'detail': {'alarmName': 'alarm', 'state': {'value': 'ALARM', 'timestamp': 't1'}}}
+        assert state.get_event_key(alarm) == 'event#alarm#t1'
+        assert state.get_event_key({'id': 'abc', 'detail': {}}) == 'event#abc'
+        assert state.get_event_key({}) is None
+
+    def test_claim_event(self):
+        event = {'id': 'abc'}
+        assert state.claim_event(event) is True
+        assert state.claim_event(event) is False
+        self.dynamodb.put_item.assert_called_once()
+        assert self.dynamodb.put_item.call_args[1]['ConditionExpression'] == 'attribute_not_exists(pk)'
+
+    def test_claim_event_conflict(self):
+        self.dynamodb.put_item.side_effect = ConditionalCheckFailedException()
+        assert state.claim_event({'id': 'abc'}) is False
+
+    def test_claim_event_without_key(self):
+        assert state.claim_event({}) is True
+        self.dynamodb.put_item.assert_not_called()
+
+    def test_handle_once(self):
+        handler = mock.Mock(return_value='done')
+        wrapped = state.handle_once(handler)
+        assert wrapped({'id': 'abc'}, None) == 'done'
+        assert wrapped({'id': 'abc'}, None) is None
+        handler.assert_called_once_with({'id': 'abc'}, None)
+
+    def test_handle_once_releases_on_failure(self):
+        handler = mock.Mock(side_effect=[Exception('boom'), 'done'])
+        wrapped = state.handle_once(handler)
+        with self.assertRaises(Exception):
+            wrapped({'id': 'abc'}, None)
+        self.dynamodb.delete_item.assert_called_once_with(TableName=state.STATE_TABLE,
+                                                          Key={'pk': {'S': 'event#abc'}})
+        assert wrapped({'id': 'abc'}, None) == 'done'
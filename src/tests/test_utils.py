@@ -1,11 +1,15 @@
+import datetime
 import os
 from unittest import TestCase, mock
 
+from src.clients import clear_clients
 from src import handler
 from src.handler import TRIGGER, STAGES, DB
-from src.utils import enable_lambda_trigger, disable_lambda_trigger, purge_queue, stop_db_cluster, start_db_cluster, \
-    describe_db_clusters, get_capture_db_secret_key, get_capture_db_cluster_identifier, \
-    get_capture_db_instance_identifier
+from src.utils import enable_lambda_trigger, disable_lambda_trigger, wait_for_lambda_trigger, drain_lambda_trigger, \
+    get_lambda_concurrent_executions, get_flow_signals, warm_up_lambda_trigger, get_trigger_concurrency_cap, \
+    purge_queue, stop_db_cluster, start_db_cluster, describe_db_clusters, get_db_cluster_status, \
+    get_capture_db_secret_key, get_capture_db_cluster_identifier, get_capture_db_instance_identifier, \
+    TriggerTimeoutError, DRAIN_TIMEOUT_SECONDS
 
 
 class TestUtils(TestCase):
@@ -38,6 +42,7 @@ class TestUtils(TestCase):
     }
 
     def setUp(self):
+        clear_clients()
         self.initial_execution_arn = 'arn:aws:states:us-south-10:98877654311:blah:a17h83j-p84321'
         self.state_machine_start_input = {
             'Record': {'eventVersion': '2.1', 'eventSource': 'aws:s3'}
@@ -46,9 +51,13 @@ class TestUtils(TestCase):
         self.context = {'element': 'lithium'}
 
     @mock.patch.dict('src.utils.os.environ', mock_env_vars)
-    @mock.patch('src.utils.boto3', autospec=True)
+    @mock.patch('src.clients.boto3', autospec=True)
     def test_start_capture_db_nothing_to_start(self, mock_boto):
+        client = mock_boto.client.return_value
         for stage in STAGES:
+            client.describe_db_clusters.return_value = {
+                'DBClusters': [{'DBClusterIdentifier': DB[stage], 'Status': 'available'}]
+            }
             os.environ['STAGE'] = stage
             result = handler.start_capture_db(self.initial_event, self.context)
             assert result['statusCode'] == 200
@@ -58,77 +67,278 @@ class TestUtils(TestCase):
         with self.assertRaises(Exception) as context:
             handler.start_capture_db(self.initial_event, self.context)
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_enable_lambda_trigger(self, mock_boto):
         client = mock.Mock()
         mock_boto.return_value = client
-        client.list_event_source_mappings.return_value = self.mock_event_source_mapping
-        client.get_event_source_mapping.return_value = {"State": "Disabled"}
+        client.list_event_source_mappings.return_value = {
+            'EventSourceMappings': [{'UUID': 'string', 'State': 'Disabled'}]
+        }
         result = enable_lambda_trigger(["my_function_name"])
         assert result is True
         mock_boto.assert_called_with("lambda", "us-west-2")
         client.list_event_source_mappings.assert_called_with(FunctionName='my_function_name')
+        client.get_event_source_mapping.assert_not_called()
         client.update_event_source_mapping.assert_called_with(UUID='string', Enabled=True)
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_enable_lambda_trigger_already_enabled(self, mock_boto):
         client = mock.Mock()
         mock_boto.return_value = client
-        client.list_event_source_mappings.return_value = self.mock_event_source_mapping
-        client.get_event_source_mapping.return_value = {"State": "Enabled"}
+        client.list_event_source_mappings.return_value = {
+            'EventSourceMappings': [{'UUID': 'string', 'State': 'Enabled'}]
+        }
         result = enable_lambda_trigger(["my_function_name"])
         assert result is False
         mock_boto.assert_called_with("lambda", "us-west-2")
         client.list_event_source_mappings.assert_called_with(FunctionName='my_function_name')
+        client.get_event_source_mapping.assert_not_called()
         client.update_event_source_mapping.assert_not_called()
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_disable_lambda_trigger(self, mock_boto):
         client = mock.Mock()
         mock_boto.return_value = client
-        client.list_event_source_mappings.return_value = self.mock_event_source_mapping
-        client.get_event_source_mapping.return_value = {"State": "Enabled"}
+        client.list_event_source_mappings.return_value = {
+            'EventSourceMappings': [{'UUID': 'string', 'State': 'Enabled'}]
+        }
         result = disable_lambda_trigger(["my_function_name"])
         assert result is True
         mock_boto.assert_called_with("lambda", "us-west-2")
         client.list_event_source_mappings.assert_called_with(FunctionName='my_function_name')
+        client.get_event_source_mapping.assert_not_called()
         client.update_event_source_mapping.assert_called_with(UUID='string', Enabled=False)
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_disable_lambda_trigger_already_disabled(self, mock_boto):
         client = mock.Mock()
         mock_boto.return_value = client
-        client.list_event_source_mappings.return_value = self.mock_event_source_mapping
-        client.get_event_source_mapping.return_value = {"State": "Disabled"}
+        client.list_event_source_mappings.return_value = {
+            'EventSourceMappings': [{'UUID': 'string', 'State': 'Disabled'}]
+        }
         result = disable_lambda_trigger(["my_function_name"])
         assert result is False
         mock_boto.assert_called_with("lambda", "us-west-2")
         client.list_event_source_mappings.assert_called_with(FunctionName='my_function_name')
+        client.get_event_source_mapping.assert_not_called()
+        client.update_event_source_mapping.assert_not_called()
+
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_disable_lambda_trigger_many_functions(self, mock_boto):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        client.list_event_source_mappings.side_effect = lambda FunctionName: {
+            'EventSourceMappings': [
+                {'UUID': f"{FunctionName}-1", 'State': 'Enabled'},
+                {'UUID': f"{FunctionName}-2", 'State': 'Disabled'}
+            ]
+        }
+        result = disable_lambda_trigger(["one", "two", "three"])
+        assert result is True
+        self.assertEqual(client.list_event_source_mappings.call_count, 3)
+        self.assertCountEqual(
+            [x.kwargs['UUID'] for x in client.update_event_source_mapping.call_args_list], ['one-1', 'two-1', 'three-1'])
+
+    @mock.patch('src.utils.time.sleep')
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_wait_for_lambda_trigger(self, mock_boto, mock_sleep):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        client.list_event_source_mappings.side_effect = [
+            {'EventSourceMappings': [{'UUID': 'string', 'State': 'Disabling'}]},
+            {'EventSourceMappings': [{'UUID': 'string', 'State': 'Disabling'}]},
+            {'EventSourceMappings': [{'UUID': 'string', 'State': 'Disabled'}]}
+        ]
+        elapsed = wait_for_lambda_trigger(["my_function_name"], False)
+        assert elapsed >= 0
+        self.assertEqual([x.args[0] for x in mock_sleep.call_args_list], [1, 2])
+
+    @mock.patch('src.utils.time.monotonic')
+    @mock.patch('src.utils.time.sleep')
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_wait_for_lambda_trigger_timeout(self, mock_boto, mock_sleep, mock_monotonic):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        mock_monotonic.side_effect = [0, 0, 1, 3, 7, 15, 23, 31, 39, 47, 55, 63]
+        client.list_event_source_mappings.return_value = {
+            'EventSourceMappings': [{'UUID': 'string', 'State': 'Enabling'}]
+        }
+        with self.assertRaises(TriggerTimeoutError):
+            wait_for_lambda_trigger(["my_function_name"], True)
         client.update_event_source_mapping.assert_not_called()
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_warm_up_lambda_trigger(self, mock_boto):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        client.get_function_concurrency.side_effect = [
+            {'ReservedConcurrentExecutions': 10}, {}, {'ReservedConcurrentExecutions': 1}]
+        assert warm_up_lambda_trigger(['one', 'two', 'three'], concurrency=2) == ['one', 'two']
+        client.put_function_concurrency.assert_has_calls([
+            mock.call(FunctionName='one', ReservedConcurrentExecutions=2),
+            mock.call(FunctionName='two', ReservedConcurrentExecutions=2)])
+        assert client.put_function_concurrency.call_count == 2
+
+    @mock.patch('src.utils.get_trigger_concurrency_cap')
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_warm_up_lambda_trigger_capped(self, mock_boto, mock_cap):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        client.get_function_concurrency.return_value = {'ReservedConcurrentExecutions': 10}
+        mock_cap.return_value = 4
+        warm_up_lambda_trigger(['one'], 'my_cluster', concurrency=10)
+        mock_cap.assert_called_once_with('my_cluster')
+        client.put_function_concurrency.assert_called_once_with(FunctionName='one', ReservedConcurrentExecutions=4)
+
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_get_trigger_concurrency_cap(self, mock_boto):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        client.describe_db_clusters.return_value = {'DBClusters': [{'DBClusterMembers': [
+            {'DBInstanceIdentifier': 'reader', 'IsClusterWriter': False},
+            {'DBInstanceIdentifier': 'writer', 'IsClusterWriter': True}]}]}
+        client.describe_db_instances.return_value = {'DBInstances': [{'DBInstanceClass': 'db.r5.xlarge'}]}
+        assert get_trigger_concurrency_cap('my_cluster') == 8
+        client.describe_db_instances.assert_called_once_with(DBInstanceIdentifier='writer')
+        client.describe_db_instances.return_value = {'DBInstances': [{'DBInstanceClass': 'db.r5.4xlarge'}]}
+        assert get_trigger_concurrency_cap('my_cluster') == 13
+        client.describe_db_instances.return_value = {'DBInstances': [{'DBInstanceClass': 'db.serverless'}]}
+        assert get_trigger_concurrency_cap('my_cluster') is None
+        client.describe_db_clusters.return_value = {'DBClusters': [{'DBClusterMembers': []}]}
+        assert get_trigger_concurrency_cap('my_cluster') is None
+
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_get_flow_signals(self, mock_boto):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        client.get_metric_data.return_value = {'MetricDataResults': [
+            {'Id': 'messages', 'Values': [1200.0, 900.0]},
+            {'Id': 'oldestageseconds', 'Values': []},
+            {'Id': 'cpu', 'Values': [41.5]}
+        ]}
+        assert get_flow_signals('my_queue', 'my_cluster') == {
+            'messages': 1200.0, 'oldestAgeSeconds': None, 'cpu': 41.5, 'connections': None}
+        queries = client.get_metric_data.call_args[1]['MetricDataQueries']
+        assert [x['MetricStat']['Metric']['MetricName'] for x in queries] == \
+            ['ApproximateNumberOfMessagesVisible', 'ApproximateAgeOfOldestMessage', 'CPUUtilization',
+             'DatabaseConnections']
+        assert queries[2]['MetricStat']['Metric']['Dimensions'] == [
+            {'Name': 'DBClusterIdentifier', 'Value': 'my_cluster'}, {'Name': 'Role', 'Value': 'WRITER'}]
+
+        # Everything the health score uses still comes from the one call
+        client.get_metric_data.reset_mock()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        minute = datetime.timedelta(minutes=1)
+        client.get_metric_data.return_value = {'MetricDataResults': [
+            {'Id': 'throttles', 'Values': [12.0], 'Timestamps': [now]},
+            {'Id': 'deadletters', 'Values': [1500.0, 1400.0, 1300.0],
+             'Timestamps': [now, now - minute, now - 2 * minute]}
+        ]}
+        signals = get_flow_signals('my_queue', 'my_cluster', 'my_trigger', 'my_error_handler', 'my_dlq')
+        client.get_metric_data.assert_called_once()
+        assert signals == {'messages': None, 'oldestAgeSeconds': None, 'cpu': None, 'connections': None,
+                           'throttles': 12.0, 'errors': None, 'deadLetters': 100.0}
+        queries = client.get_metric_data.call_args[1]['MetricDataQueries']
+        assert [(x['Id'], x['MetricStat']['Metric']['Dimensions'][0]['Value']) for x in queries[4:]] == [
+            ('throttles', 'my_trigger'), ('errors', 'my_error_handler'), ('deadletters', 'my_dlq')]
+
+        # A standing error queue, however deep, is not new dead letters
+        client.get_metric_data.return_value = {'MetricDataResults': [
+            {'Id': 'deadletters', 'Values': [5000.0, 5000.0], 'Timestamps': [now, now - minute]}]}
+        assert get_flow_signals('my_queue', 'my_cluster', dead_letter_queue_name='my_dlq')['deadLetters'] == 0
+        client.get_metric_data.return_value = {'MetricDataResults': [
+            {'Id': 'deadletters', 'Values': [5000.0], 'Timestamps': [now]}]}
+        assert get_flow_signals('my_queue', 'my_cluster', dead_letter_queue_name='my_dlq')['deadLetters'] is None
+
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_get_lambda_concurrent_executions(self, mock_boto):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        now = datetime.datetime.now(datetime.timezone.utc)
+        minute = datetime.timedelta(minutes=1)
+        client.get_metric_data.return_value = {'MetricDataResults': [
+            {'Values': [3.0, 10.0], 'Timestamps': [now - minute, now - 2 * minute]}]}
+        assert get_lambda_concurrent_executions('my_function_name') == 3.0
+        client.get_metric_data.return_value = {'MetricDataResults': [{'Values': [], 'Timestamps': []}]}
+        assert get_lambda_concurrent_executions('my_function_name') == 0
+        # Idle for the last two minutes, so there is no datapoint for them and the one before is out of date
+        client.get_metric_data.return_value = {'MetricDataResults': [
+            {'Values': [10.0], 'Timestamps': [now - 3 * minute]}]}
+        assert get_lambda_concurrent_executions('my_function_name') == 0
+
+    @mock.patch('src.utils.time.sleep')
+    @mock.patch('src.utils.get_lambda_concurrent_executions')
+    @mock.patch('src.utils.wait_for_lambda_trigger')
+    @mock.patch('src.utils.disable_lambda_trigger')
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_drain_lambda_trigger(self, mock_boto, mock_disable, mock_wait, mock_executions, mock_sleep):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        client.get_queue_url.return_value = {'QueueUrl': 'my_queue_url'}
+        client.get_queue_attributes.side_effect = [
+            {'Attributes': {'ApproximateNumberOfMessagesNotVisible': '4'}},
+            {'Attributes': {'ApproximateNumberOfMessagesNotVisible': '0'}},
+            {'Attributes': {'ApproximateNumberOfMessagesNotVisible': '0'}}
+        ]
+        mock_executions.side_effect = [2, 0]
+        drained, elapsed = drain_lambda_trigger(['my_function_name'], 'my_queue')
+        assert drained is True
+        mock_disable.assert_called_once_with(['my_function_name'])
+        mock_wait.assert_called_once()
+        self.assertEqual(mock_executions.call_count, 2)
+        self.assertEqual(mock_sleep.call_count, 2)
+        client.get_queue_url.assert_called_once_with(QueueName='my_queue')
+
+    @mock.patch('src.utils.time.monotonic')
+    @mock.patch('src.utils.time.sleep')
+    @mock.patch('src.utils.get_lambda_concurrent_executions')
+    @mock.patch('src.utils.wait_for_lambda_trigger')
+    @mock.patch('src.utils.disable_lambda_trigger')
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_drain_lambda_trigger_timeout(self, mock_boto, mock_disable, mock_wait, mock_executions, mock_sleep,
+                                          mock_monotonic):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        mock_monotonic.side_effect = [0, 40, 100, 200, 296]
+        client.get_queue_url.return_value = {'QueueUrl': 'my_queue_url'}
+        client.get_queue_attributes.return_value = {'Attributes': {'ApproximateNumberOfMessagesNotVisible': '1'}}
+        drained, elapsed = drain_lambda_trigger(['my_function_name'], 'my_queue')
+        assert drained is False
+        assert elapsed == 296
+        mock_executions.assert_not_called()
+        # Settling the trigger comes out of the same budget
+        mock_wait.assert_called_once_with(['my_function_name'], False, DRAIN_TIMEOUT_SECONDS - 40)
+
+        # A trigger that does not settle in time is a drain that timed out too
+        mock_monotonic.side_effect = [0, 0, DRAIN_TIMEOUT_SECONDS]
+        mock_wait.side_effect = TriggerTimeoutError('still waiting')
+        assert drain_lambda_trigger(['my_function_name'], 'my_queue') == (False, DRAIN_TIMEOUT_SECONDS)
+
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_purge_queue(self, mock_boto):
         client = mock.Mock()
         mock_boto.return_value = client
         client.get_queue_url.return_value = {"QueueUrl": "my_queue_url"}
-        purge_queue("foo")
+        purge_queue(["foo", "bar"])
         client.purge_queue.assert_called_with(QueueUrl="my_queue_url")
+        self.assertEqual(client.purge_queue.call_count, 2)
+        mock_boto.assert_called_once()
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_stop_db_cluster(self, mock_boto):
         client = mock.Mock()
         mock_boto.return_value = client
         stop_db_cluster("foo")
         client.stop_db_cluster.assert_called_with(DBClusterIdentifier="foo")
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_start_db_cluster(self, mock_boto):
         client = mock.Mock()
         mock_boto.return_value = client
         start_db_cluster("foo")
         client.start_db_cluster.assert_called_with(DBClusterIdentifier="foo")
 
-    @mock.patch('src.utils.boto3.client', autospec=True)
+    @mock.patch('src.clients.boto3.client', autospec=True)
     def test_describe_db_clusters(self, mock_boto):
         client = mock.Mock()
         mock_boto.return_value = client
@@ -143,6 +353,37 @@ class TestUtils(TestCase):
         describe_db_clusters("stop")
         client.describe_db_clusters.assert_called_once_with()
 
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_describe_db_clusters_follows_marker(self, mock_boto):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        client.describe_db_clusters.side_effect = [
+            {'DBClusters': [{'DBClusterIdentifier': 'foo', 'Status': 'available'}], 'Marker': 'page2'},
+            {'DBClusters': [{'DBClusterIdentifier': 'bar', 'Status': 'stopped'}]}
+        ]
+        result = describe_db_clusters("start")
+        assert result == ['bar']
+        client.describe_db_clusters.assert_called_with(Marker='page2')
+        self.assertEqual(client.describe_db_clusters.call_count, 2)
+
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_get_db_cluster_status(self, mock_boto):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        client.describe_db_clusters.return_value = {
+            'DBClusters': [{'DBClusterIdentifier': 'foo', 'Status': 'stopped'}]
+        }
+        assert get_db_cluster_status('foo') == 'stopped'
+        client.describe_db_clusters.assert_called_once_with(DBClusterIdentifier='foo')
+
+    @mock.patch('src.clients.boto3.client', autospec=True)
+    def test_get_db_cluster_status_not_found(self, mock_boto):
+        client = mock.Mock()
+        mock_boto.return_value = client
+        client.exceptions.DBClusterNotFoundFault = type('DBClusterNotFoundFault', (Exception,), {})
+        client.describe_db_clusters.side_effect = client.exceptions.DBClusterNotFoundFault()
+        assert get_db_cluster_status('foo') is None
+
     def test_get_capture_db_secret_key(self):
         key = get_capture_db_secret_key('DEV')
         assert key == 'NWCAPTURE-DB-DEV'
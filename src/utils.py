@@ -1,6 +1,11 @@
+import datetime
 import os
-import boto3
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.clients import get_client
+from src.state import clear_state, FLOW_RATE_STATE
 
 log_level = os.getenv('LOG_LEVEL', logging.ERROR)
 logger = logging.getLogger(__name__)
@@ -8,6 +13,37 @@ logger.setLevel(log_level)
 
 DEFAULT_DB_INSTANCE_CLASS = 'db.r5.4xlarge'
 
+# Event source mapping calls are fanned out on a small thread pool; boto3 clients are safe to share across threads.
+TRIGGER_POOL_SIZE = 8
+TRIGGER_SETTLE_TIMEOUT_SECONDS = 60
+TRIGGER_POLL_INITIAL_DELAY_SECONDS = 1
+TRIGGER_POLL_MAX_DELAY_SECONDS = 8
+# Upper bound on how long we wait for in-flight capture work after the trigger is off.  This used to be a fixed sleep.
+DRAIN_TIMEOUT_SECONDS = 300
+DRAIN_POLL_SECONDS = 5
+# ConcurrentExecutions has no datapoint for a minute the function did not run in, so the latest datapoint only says
+# how many are running now if it is for this minute or the one before, which CloudWatch may not have published yet.
+CONCURRENT_EXECUTIONS_MAX_AGE_SECONDS = 120
+# Reserved concurrency the capture trigger is re-enabled at after a start or resize.  The circuit breaker's scheduled
+# ticks step it back up while the database CPU and the error rate stay healthy.
+TRIGGER_WARMUP_CONCURRENCY = int(os.getenv('TRIGGER_WARMUP_CONCURRENCY', 2))
+
+# Aurora PostgreSQL's default max_connections, LEAST(DBInstanceClassMemory / 9531392, 5000), per instance class.
+MAX_CONNECTIONS = {
+    'db.r5.large': 1660,
+    'db.r5.xlarge': 3320,
+    'db.r5.2xlarge': 5000,
+    'db.r5.4xlarge': 5000,
+    'db.r5.8xlarge': 5000,
+    'db.r5.12xlarge': 5000,
+    'db.r5.16xlarge': 5000,
+    'db.r5.24xlarge': 5000
+}
+# Connections one concurrent trigger execution's capture workflow can hold open, and the share of max_connections
+# the trigger may use; the rest is left for the ETL jobs and everything else.
+CONNECTIONS_PER_TRIGGER_EXECUTION = int(os.getenv('CONNECTIONS_PER_TRIGGER_EXECUTION', 300))
+TRIGGER_CONNECTION_SHARE = float(os.getenv('TRIGGER_CONNECTION_SHARE', 0.8))
+
 STAGE = os.getenv('STAGE', 'TEST')
 
 CAPTURE_INSTANCE_TAGS = [
@@ -38,10 +74,16 @@ OBSERVATION_INSTANCE_TAGS = [
 ]
 
 def describe_db_clusters(action):
-    # Get all the instances
-    my_rds = boto3.client('rds', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
-    response = my_rds.describe_db_clusters()
-    all_dbs = response['DBClusters']
+    # Get all the instances, following the Marker so accounts with more than one page of clusters are covered
+    my_rds = get_client('rds')
+    all_dbs = []
+    kwargs = {}
+    while True:
+        response = my_rds.describe_db_clusters(**kwargs)
+        all_dbs.extend(response['DBClusters'])
+        if not response.get('Marker'):
+            break
+        kwargs['Marker'] = response['Marker']
     if action == "start":
         # Filter on the one that are not running yet
         rds_cluster_identifiers = [x['DBClusterIdentifier'] for x in all_dbs if x['Status'] != 'available']
@@ -53,8 +95,21 @@ def describe_db_clusters(action):
         return rds_cluster_identifiers
 
 
+def get_db_cluster_status(cluster_identifier):
+    """
+    Look up a single cluster by identifier instead of listing every cluster in the account.
+    :return: the cluster status (e.g. 'available', 'stopped') or None if the cluster does not exist
+    """
+    my_rds = get_client('rds')
+    try:
+        response = my_rds.describe_db_clusters(DBClusterIdentifier=cluster_identifier)
+    except my_rds.exceptions.DBClusterNotFoundFault:
+        return None
+    return response['DBClusters'][0]['Status']
+
+
 def start_db_cluster(cluster_identifier):
-    my_rds = boto3.client('rds', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
+    my_rds = get_client('rds')
     my_rds.start_db_cluster(
         DBClusterIdentifier=cluster_identifier
     )
@@ -62,7 +117,7 @@ def start_db_cluster(cluster_identifier):
 
 
 def stop_db_cluster(cluster_identifier):
-    my_rds = boto3.client('rds', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
+    my_rds = get_client('rds')
     my_rds.stop_db_cluster(
         DBClusterIdentifier=cluster_identifier
     )
@@ -70,45 +125,283 @@ def stop_db_cluster(cluster_identifier):
 
 
 def stop_observations_db_instance(instance_identifier):
-    my_rds = boto3.client('rds', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
+    my_rds = get_client('rds')
     my_rds.stop_db_instance(DBInstanceIdentifier=instance_identifier)
 
 
 def purge_queue(queue_names):
+    sqs = get_client('sqs')
     for queue_name in queue_names:
-        sqs = boto3.client('sqs', os.getenv('AWS_DEPLOYMENT_REGION'))
         queue_info = sqs.get_queue_url(QueueName=queue_name)
         sqs.purge_queue(QueueUrl=queue_info['QueueUrl'])
 
 
+def _fan_out(func, items):
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(len(items), TRIGGER_POOL_SIZE)) as executor:
+        return list(executor.map(func, items))
+
+
+def _list_event_source_mappings(my_lambda, function_names):
+    """
+    list_event_source_mappings already carries each mapping's State, so there is no need to get them one by one.
+    :return: a list of (function name, event source mapping) pairs
+    """
+    responses = _fan_out(lambda function_name: my_lambda.list_event_source_mappings(FunctionName=function_name),
+                         function_names)
+    return [(function_name, item)
+            for function_name, response in zip(function_names, responses)
+            for item in response['EventSourceMappings']]
+
+
+def _toggle_lambda_trigger(function_names, enabled, from_states):
+    my_lambda = get_client('lambda')
+    to_update = [(function_name, item) for function_name, item in _list_event_source_mappings(my_lambda, function_names)
+                 if item['State'] in from_states]
+
+    def update(mapping):
+        function_name, item = mapping
+        response = my_lambda.update_event_source_mapping(UUID=item['UUID'], Enabled=enabled)
+        logger.info(f"Trigger should be {'enabled' if enabled else 'disabled'}.  "
+                    f"function name: {function_name} item: {response}")
+
+    _fan_out(update, to_update)
+    return len(to_update) > 0
+
+
 def disable_lambda_trigger(function_names):
-    my_lambda = boto3.client('lambda', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
-    return_value = False
-    for function_name in function_names:
-        response = my_lambda.list_event_source_mappings(FunctionName=function_name)
-        for item in response['EventSourceMappings']:
-            response = my_lambda.get_event_source_mapping(UUID=item['UUID'])
-            if response['State'] in ('Enabled', 'Enabling', 'Updating', 'Creating'):
-                my_lambda.update_event_source_mapping(UUID=item['UUID'], Enabled=False)
-                response = my_lambda.get_event_source_mapping(UUID=item['UUID'])
-                return_value = True
-                logger.info(f"Trigger should be disabled.  function name: {function_name} item: {response}")
-    return return_value
+    return _toggle_lambda_trigger(function_names, False, ('Enabled', 'Enabling', 'Updating', 'Creating'))
 
 
 def enable_lambda_trigger(function_names):
-    my_lambda = boto3.client('lambda', os.getenv('AWS_DEPLOYMENT_REGION', 'us-west-2'))
-    return_value = False
+    return _toggle_lambda_trigger(function_names, True, ('Disabled', 'Disabling', 'Updating', 'Creating'))
+
+
+def get_writer_instance_class(cluster_identifier):
+    """
+    :return: the instance class of the cluster's writer, or None if there is no cluster or it has no writer
+    """
+    my_rds = get_client('rds')
+    try:
+        cluster = my_rds.describe_db_clusters(DBClusterIdentifier=cluster_identifier)['DBClusters'][0]
+    except my_rds.exceptions.DBClusterNotFoundFault:
+        return None
+    writers = [x['DBInstanceIdentifier'] for x in cluster.get('DBClusterMembers', []) if x['IsClusterWriter']]
+    if not writers:
+        return None
+    return my_rds.describe_db_instances(DBInstanceIdentifier=writers[0])['DBInstances'][0]['DBInstanceClass']
+
+
+def max_trigger_concurrency(instance_class):
+    """
+    The most trigger concurrency whose connections fit in the instance class's max_connections.
+    :return: at least 1, or None for a class that is not in MAX_CONNECTIONS
+    """
+    if instance_class is None:
+        return None
+    if instance_class not in MAX_CONNECTIONS:
+        logger.warning(f"No max_connections known for {instance_class}, not capping trigger concurrency")
+        return None
+    return max(int(MAX_CONNECTIONS[instance_class] * TRIGGER_CONNECTION_SHARE // CONNECTIONS_PER_TRIGGER_EXECUTION), 1)
+
+
+def get_trigger_concurrency_cap(cluster_identifier):
+    """
+    max_trigger_concurrency for the cluster's live writer.
+    """
+    return max_trigger_concurrency(get_writer_instance_class(cluster_identifier))
+
+
+def warm_up_lambda_trigger(function_names, cluster_identifier=None, concurrency=TRIGGER_WARMUP_CONCURRENCY):
+    """
+    Lower the trigger functions' reserved concurrency to concurrency before they are enabled, so a backlog does not
+    hit a cold database all at once.  Functions already at or below it are left alone.
+    :param cluster_identifier: if given, also keep to what the cluster writer's max_connections can take, since a
+        resize may have just moved it to a smaller class
+    :return: the function names that were lowered
+    """
+    cap = get_trigger_concurrency_cap(cluster_identifier) if cluster_identifier is not None else None
+    if cap is not None:
+        concurrency = min(concurrency, cap)
+    my_lambda = get_client('lambda')
+    lowered = []
     for function_name in function_names:
-        response = my_lambda.list_event_source_mappings(FunctionName=function_name)
-        for item in response['EventSourceMappings']:
-            response = my_lambda.get_event_source_mapping(UUID=item['UUID'])
-            if response['State'] in ('Disabled', 'Disabling', 'Updating', 'Creating'):
-                my_lambda.update_event_source_mapping(UUID=item['UUID'], Enabled=True)
-                response = my_lambda.get_event_source_mapping(UUID=item['UUID'])
-                logger.info(f"Trigger should be enabled.  function name: {function_name} item: {response}")
-                return_value = True
-    return return_value
+        current = my_lambda.get_function_concurrency(FunctionName=function_name).get('ReservedConcurrentExecutions')
+        if current is None or current > concurrency:
+            my_lambda.put_function_concurrency(FunctionName=function_name, ReservedConcurrentExecutions=concurrency)
+            logger.info(f"Warming up {function_name} at reserved concurrency {concurrency}, was {current}")
+            lowered.append(function_name)
+    if lowered:
+        clear_state(FLOW_RATE_STATE)
+    return lowered
+
+
+class TriggerTimeoutError(Exception):
+    """
+    The trigger's event source mappings did not settle within the timeout.
+    """
+    pass
+
+
+def wait_for_lambda_trigger(function_names, enabled, timeout=TRIGGER_SETTLE_TIMEOUT_SECONDS):
+    """
+    Poll the event source mappings with exponential backoff until every one of them is Enabled (or Disabled).
+    :return: the number of seconds it took for the trigger to settle
+    :raises TriggerTimeoutError: if they have not settled after timeout seconds
+    """
+    my_lambda = get_client('lambda')
+    target_state = 'Enabled' if enabled else 'Disabled'
+    delay = TRIGGER_POLL_INITIAL_DELAY_SECONDS
+    start = time.monotonic()
+    while True:
+        pending = [item['UUID'] for function_name, item in _list_event_source_mappings(my_lambda, function_names)
+                   if item['State'] != target_state]
+        elapsed = time.monotonic() - start
+        if not pending:
+            logger.info(f"Trigger {function_names} is {target_state} after {elapsed:.1f} seconds")
+            return elapsed
+        if elapsed + delay > timeout:
+            raise TriggerTimeoutError(f"Trigger {function_names} did not become {target_state} within {timeout:.0f} "
+                                      f"seconds, still waiting on {pending}")
+        time.sleep(delay)
+        delay = min(delay * 2, TRIGGER_POLL_MAX_DELAY_SECONDS)
+
+
+def get_lambda_concurrent_executions(function_name):
+    """
+    Most recent one minute maximum of the function's ConcurrentExecutions, or 0 if it has not been running for the
+    last CONCURRENT_EXECUTIONS_MAX_AGE_SECONDS.
+    """
+    cloudwatch = get_client('cloudwatch')
+    now = datetime.datetime.now(datetime.timezone.utc)
+    response = cloudwatch.get_metric_data(
+        MetricDataQueries=[
+            {
+                'Id': 'concurrentExecutions',
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': 'AWS/Lambda',
+                        'MetricName': 'ConcurrentExecutions',
+                        'Dimensions': [{'Name': 'FunctionName', 'Value': function_name}]
+                    },
+                    'Period': 60,
+                    'Stat': 'Maximum',
+                }
+            }
+        ],
+        StartTime=now - datetime.timedelta(minutes=3),
+        EndTime=now,
+        ScanBy='TimestampDescending'
+    )
+    result = response['MetricDataResults'][0]
+    values, timestamps = result['Values'], result['Timestamps']
+    if not values or now - timestamps[0] > datetime.timedelta(seconds=CONCURRENT_EXECUTIONS_MAX_AGE_SECONDS):
+        return 0
+    return values[0]
+
+
+def get_flow_signals(queue_name, cluster_identifier, trigger_name=None, error_handler_name=None,
+                     dead_letter_queue_name=None):
+    """
+    What the flow controller steers by, from one get_metric_data call: the trigger queue's visible messages and the
+    age of its oldest message, and the capture writer's CPU and connections.  Given their names, also the trigger's
+    throttles, the error handler's invocations and how fast the dead letter queue is filling.  Each is the most
+    recent one minute datapoint, or None if there is none (the queue metrics stop when the queue is idle, and the
+    database metrics stop when the database does).  deadLetters is the growth in the dead letter queue's visible
+    messages per minute over the window instead, since its depth is a standing level that only a purge brings down.
+    :return: dict with messages, oldestAgeSeconds, cpu and connections, and throttles, errors and deadLetters for
+        the names given
+    """
+    cloudwatch = get_client('cloudwatch')
+    now = datetime.datetime.utcnow()
+    queue = [{'Name': 'QueueName', 'Value': queue_name}]
+    writer = [{'Name': 'DBClusterIdentifier', 'Value': cluster_identifier}, {'Name': 'Role', 'Value': 'WRITER'}]
+    signals = [
+        ('messages', 'AWS/SQS', 'ApproximateNumberOfMessagesVisible', queue, 'Maximum'),
+        ('oldestAgeSeconds', 'AWS/SQS', 'ApproximateAgeOfOldestMessage', queue, 'Maximum'),
+        ('cpu', 'AWS/RDS', 'CPUUtilization', writer, 'Average'),
+        ('connections', 'AWS/RDS', 'DatabaseConnections', writer, 'Maximum')
+    ]
+    if trigger_name is not None:
+        signals.append(('throttles', 'AWS/Lambda', 'Throttles', [{'Name': 'FunctionName', 'Value': trigger_name}],
+                        'Sum'))
+    if error_handler_name is not None:
+        signals.append(('errors', 'AWS/Lambda', 'Invocations',
+                        [{'Name': 'FunctionName', 'Value': error_handler_name}], 'Sum'))
+    if dead_letter_queue_name is not None:
+        signals.append(('deadLetters', 'AWS/SQS', 'ApproximateNumberOfMessagesVisible',
+                        [{'Name': 'QueueName', 'Value': dead_letter_queue_name}], 'Maximum'))
+    response = cloudwatch.get_metric_data(
+        MetricDataQueries=[
+            {
+                'Id': name.lower(),
+                'MetricStat': {
+                    'Metric': {'Namespace': namespace, 'MetricName': metric, 'Dimensions': dimensions},
+                    'Period': 60,
+                    'Stat': stat,
+                }
+            } for name, namespace, metric, dimensions, stat in signals
+        ],
+        StartTime=now - datetime.timedelta(minutes=5),
+        EndTime=now,
+        ScanBy='TimestampDescending'
+    )
+    results = {x['Id']: x for x in response['MetricDataResults']}
+    flow_signals = {name: (results.get(name.lower(), {}).get('Values') or [None])[0] for name, *_ in signals}
+    if dead_letter_queue_name is not None:
+        flow_signals['deadLetters'] = _growth_per_minute(results.get('deadletters'))
+    return flow_signals
+
+
+def _growth_per_minute(result):
+    """
+    :param result: a get_metric_data result, newest first
+    :return: how much the metric rose per minute between its oldest and newest datapoints, 0 if it did not rise, or
+        None with fewer than two datapoints
+    """
+    if result is None or len(result['Values']) < 2:
+        return None
+    values, timestamps = result['Values'], result['Timestamps']
+    minutes = max((timestamps[0] - timestamps[-1]).total_seconds() / 60, 1)
+    return max(values[0] - values[-1], 0) / minutes
+
+
+def get_queue_messages_in_flight(queue_url):
+    sqs = get_client('sqs')
+    response = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['ApproximateNumberOfMessagesNotVisible'])
+    return int(response['Attributes']['ApproximateNumberOfMessagesNotVisible'])
+
+
+def drain_lambda_trigger(function_names, queue_name, timeout=DRAIN_TIMEOUT_SECONDS):
+    """
+    Disable the trigger, then wait until the trigger functions have no concurrent executions and the trigger queue
+    has no messages in flight, instead of sleeping for a fixed time.
+    :return: (drained, elapsed seconds).  drained is False if we gave up after timeout seconds, which covers the
+        trigger settling as well.
+    """
+    start = time.monotonic()
+    disable_lambda_trigger(function_names)
+    try:
+        wait_for_lambda_trigger(function_names, False, timeout - (time.monotonic() - start))
+    except TriggerTimeoutError as e:
+        elapsed = time.monotonic() - start
+        logger.warning(f"Trigger {function_names} not drained after {elapsed:.1f} seconds, giving up: {e}")
+        return False, elapsed
+    queue_url = get_client('sqs').get_queue_url(QueueName=queue_name)['QueueUrl']
+    while True:
+        in_flight = get_queue_messages_in_flight(queue_url)
+        executions = max(get_lambda_concurrent_executions(x) for x in function_names) if in_flight == 0 else None
+        elapsed = time.monotonic() - start
+        if in_flight == 0 and executions == 0:
+            logger.info(f"Trigger {function_names} drained after {elapsed:.1f} seconds")
+            return True, elapsed
+        if elapsed + DRAIN_POLL_SECONDS > timeout:
+            logger.warning(f"Trigger {function_names} not drained after {elapsed:.1f} seconds, {in_flight} messages "
+                           f"in flight and {executions} concurrent executions, giving up")
+            return False, elapsed
+        time.sleep(DRAIN_POLL_SECONDS)
 
 
 def get_capture_db_cluster_identifier(stage):